@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""CONTAIN规则匹配基准测试
+
+对比逐条 ``pattern in content`` 与Aho-Corasick自动机的匹配耗时
+
+    python benchmarks/contain_rules.py
+    python benchmarks/contain_rules.py --patterns 1000 10000 --messages 2000
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os
+import random
+import sys
+import timeit
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "wechat_django.tests.settings")
+django.setup()
+
+from wechat_django.utils.ahocorasick import Automaton  # noqa: E402
+
+CHARSET = "abcdefghijklmnopqrstuvwxyz0123456789优惠券领取活动客服价格地址"
+
+
+def random_text(rnd, min_length, max_length):
+    length = rnd.randint(min_length, max_length)
+    return "".join(rnd.choice(CHARSET) for _ in range(length))
+
+
+def linear_scan(patterns, content):
+    """原有逻辑: 按优先级逐条匹配,返回首个匹配的下标"""
+    for index, pattern in enumerate(patterns):
+        if pattern in content:
+            return index
+
+
+def automaton_scan(automaton, content):
+    return min(automaton.iter(content), default=None)
+
+
+def run(pattern_count, message_count, repeat, seed=0):
+    rnd = random.Random(seed)
+    patterns = [random_text(rnd, 3, 8) for _ in range(pattern_count)]
+    messages = [random_text(rnd, 5, 60) for _ in range(message_count)]
+    # 部分消息命中关键字
+    for i in range(0, message_count, 4):
+        messages[i] += rnd.choice(patterns)
+
+    build = timeit.default_timer()
+    automaton = Automaton()
+    for index, pattern in enumerate(patterns):
+        automaton.add(pattern, index)
+    automaton.build()
+    build = timeit.default_timer() - build
+
+    for message in messages:
+        assert linear_scan(patterns, message)\
+            == automaton_scan(automaton, message)
+
+    linear = min(timeit.repeat(
+        lambda: [linear_scan(patterns, m) for m in messages],
+        number=1, repeat=repeat))
+    aho = min(timeit.repeat(
+        lambda: [automaton_scan(automaton, m) for m in messages],
+        number=1, repeat=repeat))
+
+    print("patterns: {0:>6}  build: {1:8.2f}ms  "
+          "linear: {2:8.2f}us/msg  aho-corasick: {3:8.2f}us/msg  "
+          "speedup: {4:6.1f}x".format(
+              pattern_count, build * 1e3,
+              linear / message_count * 1e6, aho / message_count * 1e6,
+              linear / aho))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--patterns", type=int, nargs="+",
+                        default=[1000, 10000])
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for pattern_count in args.patterns:
+        run(pattern_count, args.messages, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+"""消息处理基准测试
+
+以测试配置(sqlite内存数据库,微信接口由tests.interceptors拦截)生成含N个
+不同类型规则的消息处理器的公众号,经Handler重放文本,关注及菜单点击消息,
+以JSON输出各规模下的吞吐量及各阶段耗时的p50/p99,用于版本间对比
+
+    python benchmarks/handler.py
+    python benchmarks/handler.py --handlers 10 100 1000 --messages 2000
+    python benchmarks/handler.py --output result.json
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "wechat_django.tests.settings")
+django.setup()
+
+from django.db import connection  # noqa: E402
+from django.test import Client  # noqa: E402
+from django.test.utils import setup_test_environment  # noqa: E402
+from django.urls import reverse  # noqa: E402
+from django.utils.http import urlencode  # noqa: E402
+from wechatpy.utils import WeChatSigner  # noqa: E402
+
+import wechat_django  # noqa: E402
+from wechat_django import message_handler, settings, timing  # noqa: E402
+from wechat_django.models import (MessageHandler, Reply, Rule,  # noqa: E402
+                                  WeChatApp)
+from wechat_django.models import messagelog, user  # noqa: E402
+from wechat_django.tests.interceptors import (wechatapi,  # noqa: E402
+                                              wechatapi_accesstoken)
+
+STAGES = ("signature", "nonce", "parse", "match", "reply", "render",
+          "encrypt", "total", "request")
+"""Handler各阶段耗时,total为Handler内总耗时,request为经测试客户端的请求耗时"""
+
+TEXT = """<xml>
+<ToUserName><![CDATA[gh_bench]]></ToUserName>
+<FromUserName><![CDATA[{openid}]]></FromUserName>
+<CreateTime>{time}</CreateTime>
+<MsgType><![CDATA[text]]></MsgType>
+<Content><![CDATA[{content}]]></Content>
+<MsgId>{msg_id}</MsgId>
+</xml>"""
+
+EVENT = """<xml>
+<ToUserName><![CDATA[gh_bench]]></ToUserName>
+<FromUserName><![CDATA[{openid}]]></FromUserName>
+<CreateTime>{time}</CreateTime>
+<MsgType><![CDATA[event]]></MsgType>
+<Event><![CDATA[{event}]]></Event>
+<EventKey><![CDATA[{key}]]></EventKey>
+</xml>"""
+
+
+@message_handler
+def custom_reply(message_info):
+    return "custom"
+
+
+def create_app(handler_count, seed=0):
+    """创建含handler_count个消息处理器的公众号,规则类型按比例混合"""
+    rnd = random.Random(seed)
+    app = WeChatApp.objects.create(
+        title="bench", name="bench{0}".format(handler_count),
+        appid="wxbench{0}".format(handler_count), appsecret="secret",
+        token="token")
+    keywords = []
+    for i in range(handler_count):
+        kind = i % 10
+        if kind < 3:
+            keyword = "keyword{0}".format(i)
+            keywords.append(keyword)
+            rule = Rule(type=Rule.Type.EQUAL, pattern=keyword)
+        elif kind < 6:
+            keyword = "contain{0}x".format(i)
+            keywords.append(keyword)
+            rule = Rule(type=Rule.Type.CONTAIN, pattern=keyword)
+        elif kind < 8:
+            rule = Rule(type=Rule.Type.REGEX,
+                        pattern=r"^order{0}-\d+$".format(i))
+        elif kind == 8:
+            rule = Rule(type=Rule.Type.EVENTKEY,
+                        event=MessageHandler.EventType.CLICK,
+                        key="menu{0}".format(i))
+        else:
+            rule = Rule(type=Rule.Type.MSGTYPE,
+                        msg_type=rnd.choice(("image", "voice", "video")))
+        if i % 20 == 0:
+            reply = Reply(type=Reply.MsgType.CUSTOM,
+                          program="__main__.custom_reply")
+        else:
+            reply = Reply(type=Reply.MsgType.TEXT,
+                          content="reply {0}".format(i))
+        MessageHandler.objects.create_handler(
+            app=app, name="handler{0}".format(i), weight=rnd.randint(0, 10),
+            rules=[rule], replies=[reply])
+    MessageHandler.objects.create_handler(
+        app=app, name="subscribe",
+        rules=[Rule(type=Rule.Type.EVENT,
+                    event=MessageHandler.EventType.SUBSCRIBE)],
+        replies=[Reply(type=Reply.MsgType.TEXT, content="welcome")])
+    return app, keywords
+
+
+def create_corpus(handler_count, keywords, count, seed=0):
+    """文本(命中,包含,正则,未命中),菜单点击及关注消息"""
+    rnd = random.Random(seed)
+    now = int(time.time())
+    corpus = []
+    for i in range(count):
+        openid = "openid{0}".format(rnd.randint(0, 999))
+        kind = rnd.random()
+        if kind < 0.6:
+            if kind < 0.2 and keywords:
+                content = rnd.choice(keywords)
+            elif kind < 0.35 and keywords:
+                content = "请问" + rnd.choice(keywords) + "怎么领取"
+            elif kind < 0.45:
+                content = "order{0}-{1}".format(
+                    rnd.randrange(6, max(handler_count, 7), 10),
+                    rnd.randint(1, 9999))
+            else:
+                content = "没有匹配的消息 {0}".format(i)
+            xml = TEXT.format(openid=openid, time=now, content=content,
+                              msg_id=i + 1)
+        elif kind < 0.85:
+            xml = EVENT.format(
+                openid=openid, time=now + i, event="CLICK",
+                key="menu{0}".format(
+                    rnd.randrange(8, max(handler_count, 9), 10)))
+        else:
+            xml = EVENT.format(openid=openid, time=now + i,
+                               event="subscribe", key="")
+        corpus.append(xml)
+    return corpus
+
+
+def sign(token, timestamp, nonce):
+    signer = WeChatSigner()
+    signer.add_data(token, timestamp, nonce)
+    return signer.signature
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return None
+
+    def pick(p):
+        return samples[min(int(len(samples) * p), len(samples) - 1)]
+
+    return dict(count=len(samples), mean=sum(samples) / len(samples),
+                p50=pick(0.5), p99=pick(0.99), max=samples[-1])
+
+
+WRITERS = (messagelog.writer, user.subscription_writer, user.user_refresher)
+
+
+def flush():
+    for writer in WRITERS:
+        writer.flush()
+
+
+def run(client, handler_count, message_count, seed=0):
+    app, keywords = create_app(handler_count, seed)
+    corpus = create_corpus(handler_count, keywords, message_count, seed)
+    url = reverse("wechat_django:handler", kwargs=dict(appname=app.name))
+
+    samples = dict((stage, []) for stage in STAGES)
+
+    def collect(app, message_info, timing):
+        for stage, elapsed in timing.stages.items():
+            samples.setdefault(stage, []).append(elapsed)
+        samples["total"].append(timing.total)
+
+    def post(xml, nonce):
+        timestamp = str(int(time.time()))
+        query = dict(timestamp=timestamp, nonce=nonce,
+                     signature=sign(app.token, timestamp, nonce))
+        start = time.perf_counter()
+        resp = client.generic("POST", url + "?" + urlencode(query), xml,
+                              content_type="text/xml")
+        assert resp.status_code == 200, resp.status_code
+        return (time.perf_counter() - start) * 1000
+
+    # 预热 构建匹配表
+    timing._sinks = []
+    for i, xml in enumerate(corpus[:50]):
+        post(xml, "warmup{0}".format(i))
+
+    timing._sinks = [collect]
+    start = time.perf_counter()
+    for i, xml in enumerate(corpus):
+        samples["request"].append(post(xml, "nonce{0}".format(i)))
+    elapsed = time.perf_counter() - start
+    flush()
+
+    return dict(
+        handlers=handler_count,
+        messages=message_count,
+        seconds=elapsed,
+        throughput=message_count / elapsed,
+        stages=dict(
+            (stage, percentiles(values))
+            for stage, values in samples.items() if values)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--handlers", type=int, nargs="+",
+                        default=[10, 100, 1000])
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="写入JSON结果的文件,默认输出至stdout")
+    args = parser.parse_args()
+
+    settings.MESSAGETIMING = True
+    # 重放的消息不视为微信重试
+    settings.MESSAGENOREPEATNONCE = False
+    setup_test_environment()
+    # 内存数据库不支持多线程写入 后台写入改为每轮结束后在主线程中写入
+    for writer in WRITERS:
+        writer.max_size = sys.maxsize
+        writer.interval = 3600
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        with wechatapi_accesstoken(), wechatapi(
+                "/cgi-bin/user/info/batchget", {"user_info_list": []}):
+            client = Client()
+            results = [
+                run(client, handler_count, args.messages, args.seed)
+                for handler_count in args.handlers
+            ]
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    report = dict(
+        benchmark="handler",
+        version=wechat_django.__version__,
+        python=platform.python_version(),
+        django=django.get_version(),
+        created_at=int(time.time()),
+        unit="ms",
+        results=results
+    )
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""消息解析基准测试
+
+对比wechatpy.parse_message(xmltodict)与wechat_django.parser的解析耗时,
+分别测试明文消息及安全模式下解密加解析的耗时
+
+    python benchmarks/parse_message.py
+    python benchmarks/parse_message.py --number 20000
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os
+import sys
+import timeit
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "wechat_django.tests.settings")
+django.setup()
+
+from wechatpy import parse_message as wechatpy_parse_message  # noqa: E402
+from wechatpy.crypto import WeChatCrypto  # noqa: E402
+from wechatpy.utils import WeChatSigner  # noqa: E402
+
+from wechat_django.parser import parse_envelope, parse_message  # noqa: E402
+
+TOKEN = "token"
+APPID = "wx1234567890abcdef"
+ENCODING_AES_KEY = "abcdefghijklmnopqrstuvwxyz0123456789ABCDEFG"
+
+MESSAGES = {
+    "text": """<xml>
+    <ToUserName><![CDATA[gh_1234567890ab]]></ToUserName>
+    <FromUserName><![CDATA[oABCD1234567890abcdefghijklm]]></FromUserName>
+    <CreateTime>1577836800</CreateTime>
+    <MsgType><![CDATA[text]]></MsgType>
+    <Content><![CDATA[你好,请问优惠券怎么领取]]></Content>
+    <MsgId>1234567890123456</MsgId>
+    </xml>""",
+    "click": """<xml>
+    <ToUserName><![CDATA[gh_1234567890ab]]></ToUserName>
+    <FromUserName><![CDATA[oABCD1234567890abcdefghijklm]]></FromUserName>
+    <CreateTime>1577836800</CreateTime>
+    <MsgType><![CDATA[event]]></MsgType>
+    <Event><![CDATA[CLICK]]></Event>
+    <EventKey><![CDATA[menu_coupon]]></EventKey>
+    </xml>""",
+    "subscribe_scan": """<xml>
+    <ToUserName><![CDATA[gh_1234567890ab]]></ToUserName>
+    <FromUserName><![CDATA[oABCD1234567890abcdefghijklm]]></FromUserName>
+    <CreateTime>1577836800</CreateTime>
+    <MsgType><![CDATA[event]]></MsgType>
+    <Event><![CDATA[subscribe]]></Event>
+    <EventKey><![CDATA[qrscene_123123]]></EventKey>
+    <Ticket><![CDATA[TICKET]]></Ticket>
+    </xml>""",
+}
+
+
+def encrypt(crypto, xml, timestamp, nonce):
+    """构建微信推送的安全模式消息体及msg_signature"""
+    encrypted = crypto.encrypt_message(xml, nonce, timestamp)
+    encrypt = parse_envelope(encrypted)["Encrypt"]
+    signer = WeChatSigner()
+    signer.add_data(TOKEN, timestamp, nonce, encrypt)
+    body = ("<xml><ToUserName><![CDATA[gh_1234567890ab]]></ToUserName>"
+            "<Encrypt><![CDATA[{0}]]></Encrypt></xml>").format(encrypt)
+    return body.encode(), signer.signature
+
+
+def compare(name, baseline, current, number):
+    before = min(timeit.repeat(baseline, number=number, repeat=3))
+    after = min(timeit.repeat(current, number=number, repeat=3))
+    print("{0:<28} wechatpy: {1:7.2f}us/msg  wechat_django: {2:7.2f}us/msg  "
+          "speedup: {3:5.1f}x".format(
+              name, before / number * 1e6, after / number * 1e6,
+              before / after))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=10000)
+    args = parser.parse_args()
+
+    crypto = WeChatCrypto(TOKEN, ENCODING_AES_KEY, APPID)
+    timestamp, nonce = "1577836800", "123456"
+
+    for type, xml in MESSAGES.items():
+        raw = xml.encode()
+        assert wechatpy_parse_message(raw)._data == parse_message(raw)._data
+        compare("plain " + type,
+                lambda: wechatpy_parse_message(raw),
+                lambda: parse_message(raw),
+                args.number)
+
+    for type, xml in MESSAGES.items():
+        body, signature = encrypt(crypto, xml, timestamp, nonce)
+
+        def baseline():
+            return wechatpy_parse_message(crypto.decrypt_message(
+                body, signature, timestamp, nonce))
+
+        def current():
+            return parse_message(crypto.decrypt_message(
+                parse_envelope(body) or body, signature, timestamp, nonce))
+
+        assert baseline()._data == current()._data
+        compare("safe " + type, baseline, current, args.number)
+
+
+if __name__ == "__main__":
+    main()
@@ -64,6 +64,17 @@ class RuleInline(admin.StackedInline):
             model = Rule
             fields = ("type", "weight")
 
+        def clean(self):
+            cleaned_data = super(RuleInline.RuleForm, self).clean()
+            if cleaned_data:
+                rule = Rule(type=cleaned_data["type"],
+                            **cleaned_data[self.content_field])
+                try:
+                    rule.validate()
+                except ValueError as e:
+                    self.add_error("pattern", str(e))
+            return cleaned_data
+
         def allowed_fields(self, type, cleaned_data):
             if type in (Rule.Type.CONTAIN, Rule.Type.REGEX, Rule.Type.EQUAL):
                 fields = ("pattern",)
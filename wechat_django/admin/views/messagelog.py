@@ -16,6 +16,9 @@ class MessageLogAdmin(WeChatModelAdmin):
     list_display = (
         "msg_id", foreignkey("user"), "type", "content", "created_at")
     list_filter = ("type", )
+    # 按日期范围查询以使用(app, created_at)索引,并避免全表计数
+    date_hierarchy = "created_at"
+    show_full_result_count = False
     search_fields = (
         "=user__openid", "=user__unionid", "user__nickname", "user__comment",
         "content")
@@ -6,12 +6,13 @@ from django import forms
 from django.apps import apps
 from django.contrib import admin
 from django.template.defaultfilters import truncatechars
-from django.utils.html import mark_safe
+from django.utils.html import format_html, format_html_join, mark_safe
 from django.utils.translation import gettext_lazy as _
 
 from ..constants import AppType
 from ..models import MsgLogFlag, WeChatApp
 from ..models.permission import get_user_permissions
+from ..ratelimit import daily_usage, get_limit, RateLimit
 from .base import has_wechat_permission
 
 
@@ -29,9 +30,18 @@ class WeChatAppForm(forms.ModelForm):
     accesstoken_url = forms.URLField(
         label=_("accesstoken url"), required=False,
         help_text=_("获取accesstoken的url,不填直接从微信取"))
+    api_base_url = forms.URLField(
+        label=_("api base url"), required=False,
+        help_text=_("微信接口的基础url,用于代理或本地压测桩服务,"
+                    "不填直接请求微信"))
     oauth_url = forms.URLField(
         label=_("oauth url"), required=False,
         help_text=_("授权重定向的url,用于第三方网页授权换取code,默认直接微信授权"))
+    rate_limits = forms.JSONField(
+        label=_("rate limits"), required=False,
+        help_text=_('各接口的调用限额,如{"message/custom/send": '
+                    '{"rate": 50, "burst": 100, "daily": 500000}},'
+                    "rate为每秒调用数,daily为每日调用量"))
 
     class Meta(object):
         model = WeChatApp
@@ -51,10 +61,23 @@ class WeChatAppForm(forms.ModelForm):
             initial["wechat_https"] = inst.site_https
             initial["accesstoken_url"] = inst.configurations.get(
                 "ACCESSTOKEN_URL", "")
+            initial["api_base_url"] = inst.configurations.get(
+                "API_BASE_URL", "")
             initial["oauth_url"] = inst.configurations.get("OAUTH_URL", "")
+            initial["rate_limits"] = inst.configurations.get("RATELIMITS")
             kwargs["initial"] = initial
         return super(WeChatAppForm, self).__init__(*args, **kwargs)
 
+    def clean_rate_limits(self):
+        rate_limits = self.cleaned_data.get("rate_limits") or {}
+        try:
+            for endpoint, conf in rate_limits.items():
+                limit = RateLimit(**conf)
+                limit.rate and limit.window
+        except (AttributeError, TypeError, ZeroDivisionError):
+            raise forms.ValidationError(_("invalid rate limits"))
+        return rate_limits
+
     def clean(self):
         cleaned_data = super(WeChatAppForm, self).clean()
         if cleaned_data.get("log_message"):
@@ -71,8 +94,12 @@ class WeChatAppForm(forms.ModelForm):
             self.cleaned_data.get("wechat_https", None)
         self.instance.configurations["ACCESSTOKEN_URL"] =\
             self.cleaned_data.get("accesstoken_url", "")
+        self.instance.configurations["API_BASE_URL"] =\
+            self.cleaned_data.get("api_base_url", "")
         self.instance.configurations["OAUTH_URL"] =\
             self.cleaned_data.get("oauth_url", "")
+        self.instance.configurations["RATELIMITS"] =\
+            self.cleaned_data.get("rate_limits") or {}
         return super(WeChatAppForm, self).save(commit)
 
 
@@ -93,9 +120,10 @@ class WeChatAppAdmin(admin.ModelAdmin):
         "title", "name", "appid", "appsecret", "type", "abilities", "token",
         "encoding_aes_key", "encoding_mode", "desc", "log_message",
         "callback", "wechat_host", "wechat_https", "accesstoken_url",
-        "oauth_url", "created_at", "updated_at"
+        "api_base_url", "oauth_url", "rate_limits", "api_usage", "created_at",
+        "updated_at"
     )
-    readonly_fields = ("abilities",)
+    readonly_fields = ("abilities", "api_usage")
 
     @mark_safe
     def abilities(self, obj):
@@ -121,6 +149,20 @@ class WeChatAppAdmin(admin.ModelAdmin):
         return "".join(map(lambda o: tpl.format(style_str, o), abilities))
     abilities.short_description = _("abilities")
 
+    def api_usage(self, obj):
+        rows = []
+        for endpoint, count in sorted(daily_usage(obj).items()):
+            limit = get_limit(obj, endpoint)
+            rows.append((endpoint, count, limit and limit.daily or "-"))
+        if not rows:
+            return "-"
+        return format_html(
+            "<table><tr><th>{0}</th><th>{1}</th><th>{2}</th></tr>{3}</table>",
+            _("api"), _("today"), _("daily quota"),
+            format_html_join("", "<tr><td>{0}</td><td>{1}</td>"
+                             "<td>{2}</td></tr>", rows))
+    api_usage.short_description = _("api usage")
+
     def short_desc(self, obj):
         return truncatechars(obj.desc, 35)
     short_desc.short_description = _("description")
@@ -147,6 +189,7 @@ class WeChatAppAdmin(admin.ModelAdmin):
     def get_fields(self, request, obj=None):
         fields = list(super(WeChatAppAdmin, self).get_fields(request, obj))
         if not obj:
+            fields.remove("api_usage")
             fields.remove("callback")
             fields.remove("created_at")
             fields.remove("updated_at")
@@ -2,13 +2,45 @@
 from __future__ import unicode_literals
 
 import logging
+import random
+import re
+import threading
+import time
+import weakref
 
+from django.core.cache import cache
 from django.utils.module_loading import import_string
+from six.moves.urllib.parse import urlsplit
 from wechatpy import exceptions as excs, WeChatClient as _Client
 from wechatpy.constants import WeChatErrorCode
 from wechatpy.client import api
 
-from . import settings
+from . import ratelimit, settings
+from .transport import get_session
+
+
+INVALID_TOKEN_ERRCODES = (
+    WeChatErrorCode.INVALID_CREDENTIAL.value,
+    WeChatErrorCode.INVALID_ACCESS_TOKEN.value,
+    WeChatErrorCode.EXPIRED_ACCESS_TOKEN.value
+)
+"""accesstoken失效的错误码"""
+
+FREQ_LIMIT_ERRCODES = (
+    WeChatErrorCode.OUT_OF_API_FREQ_LIMIT.value,
+    45011
+)
+"""接口调用频率超限的错误码"""
+
+_errcode_re = re.compile(br'"errcode"\s*:\s*(-?\d+)')
+
+
+def _errcode(res):
+    if isinstance(res, dict):
+        return res.get("errcode")
+    content = getattr(res, "content", None)
+    match = isinstance(content, bytes) and _errcode_re.search(content)
+    return int(match.group(1)) if match else None
 
 
 class WeChatMaterial(api.WeChatMaterial):
@@ -35,9 +67,26 @@ class WeChatMessage(api.WeChatMessage):
             raise
 
 
+class WeChatJSAPI(api.WeChatJSAPI):
+    def get_jsapi_ticket(self):
+        """获取jsapi ticket,临近过期时只有一个worker刷新"""
+        return self._client._get_or_refresh(
+            "{0}_jsapi_ticket".format(self.appid), self._refresh_jsapi_ticket)
+
+    def _refresh_jsapi_ticket(self):
+        ticket_key = "{0}_jsapi_ticket".format(self.appid)
+        result = self.get_ticket("jsapi")
+        expires_in = int(result["expires_in"])
+        self.session.set(ticket_key, result["ticket"], expires_in)
+        self.session.set(ticket_key + "_expires_at",
+                         int(time.time()) + expires_in, expires_in)
+
+
 class WeChatClient(_Client):
-    """继承原有WeChatClient添加日志功能 追加accesstoken url获取"""
+    """继承原有WeChatClient添加日志功能 追加accesstoken url获取
+    及接口基础url配置 使用进程内共享的连接池"""
     # 增加raw_get方法
+    jsapi = WeChatJSAPI()
     material = WeChatMaterial()
     message = WeChatMessage()
 
@@ -51,15 +100,142 @@ class WeChatClient(_Client):
         self.app = app
         if app.configurations.get("ACCESSTOKEN_URL"):
             self.ACCESSTOKEN_URL = app.configurations["ACCESSTOKEN_URL"]
+        if app.configurations.get("API_BASE_URL"):
+            # 指向代理或本地的桩服务
+            self.API_BASE_URL = app.configurations["API_BASE_URL"]
+        # accesstoken失效由_request刷新后重试
         super(WeChatClient, self).__init__(
-            app.appid, app.appsecret, session=session)
+            app.appid, app.appsecret, session=session, auto_retry=False)
+        self._http = get_session()
+        self._limits = dict()
+        token_refresher.register(self)
+
+    @property
+    def access_token_key(self):
+        """可在configurations["ACCESSTOKEN_KEY"]中指定,如桩服务的accesstoken
+        不可覆盖真实的accesstoken"""
+        return self.app.configurations.get("ACCESSTOKEN_KEY")\
+            or super(WeChatClient, self).access_token_key
+
+    @property
+    def access_token(self):
+        """临近过期时只有一个worker刷新accesstoken"""
+        return self._get_or_refresh(
+            self.access_token_key, self.fetch_access_token)
+
+    def refresh_tokens(self):
+        """accesstoken及用过的jsapi ticket临近过期时刷新"""
+        self.access_token
+        if self.session.get("{0}_jsapi_ticket".format(self.appid)):
+            self.jsapi.get_jsapi_ticket()
 
     def _fetch_access_token(self, url, params):
         """自定义accesstoken url"""
-        return super(WeChatClient, self)._fetch_access_token(
+        result = super(WeChatClient, self)._fetch_access_token(
             self.ACCESSTOKEN_URL or url, params)
+        expires_in = result.get("expires_in", 7200)
+        self.session.set(self.access_token_key + "_expires_at",
+                         self.expires_at, expires_in)
+        return result
+
+    def _get_or_refresh(self, key, refresh):
+        """单飞刷新session中的accesstoken或ticket
+
+        值距过期(记录于{key}_expires_at)超过WECHAT_CLIENTTOKENREFRESHAHEAD秒时
+        直接返回;否则以django cache加锁,获得锁的worker刷新,其余worker继续
+        使用未过期的旧值,旧值已过期时等待刷新完成
+        """
+        lock_key = "wx:l:" + key
+        timeout = settings.CLIENTTOKENLOCKTIMEOUT
+        deadline = time.time() + timeout
+        while True:
+            # 先取过期时间 两级存储中值的进程内缓存不超过其有效期
+            expires_at = self.session.get(key + "_expires_at")
+            value = self.session.get(key)
+            now = time.time()
+            # 没有过期时间的值由外部设置 以session的过期为准
+            if value and (not expires_at or expires_at - now
+                          > settings.CLIENTTOKENREFRESHAHEAD):
+                return value
+            if cache.add(lock_key, 1, timeout):
+                try:
+                    refresh()
+                finally:
+                    cache.delete(lock_key)
+                return self.session.get(key)
+            if value and expires_at > now:
+                return value
+            if now >= deadline:
+                # 等待超时 可能持有锁的worker已退出
+                refresh()
+                return self.session.get(key)
+            time.sleep(0.05)
 
     def _request(self, method, url_or_endpoint, **kwargs):
+        """accesstoken失效时刷新后重试一次;调用频率超限时以带随机抖动的
+        指数退避重试,连续超限达到WECHAT_CLIENTBREAKERTHRESHOLD次后
+        熔断该公众号的该接口WECHAT_CLIENTBREAKERCOOLDOWN秒.每次调用前
+        取得公众号配置的接口限额,参见wechat_django.ratelimit
+
+        :raises: wechatpy.exceptions.APILimitedException 熔断中或超出限额
+        """
+        endpoint = self._endpoint(url_or_endpoint, kwargs)
+        breaker = get_breaker(self.app.name, endpoint)
+        if not breaker.allow():
+            raise excs.APILimitedException(
+                breaker.errcode, "circuit breaker open", client=self)
+
+        if endpoint not in self._limits:
+            self._limits[endpoint] = ratelimit.get_limit(self.app, endpoint)
+        limit = self._limits[endpoint]
+
+        token_retried = False
+        limit_retries = 0
+        while True:
+            ratelimit.acquire(self.app, endpoint, limit)
+            params = kwargs.get("params")
+            token = None
+            if params is None or isinstance(params, dict)\
+                    and "access_token" not in params:
+                token = self.access_token
+                params = dict(params or {}, access_token=token)
+            try:
+                rv = self._send(method, url_or_endpoint,
+                                **dict(kwargs, params=params))
+            except excs.WeChatClientException as e:
+                if e.errcode in INVALID_TOKEN_ERRCODES and token\
+                        and not token_retried:
+                    token_retried = True
+                    breaker.record("token_retries")
+                    self._renew_access_token(token)
+                    continue
+                if e.errcode in FREQ_LIMIT_ERRCODES:
+                    if breaker.failure(e.errcode)\
+                            or limit_retries >= settings.CLIENTFREQRETRIES:
+                        raise
+                    breaker.record("limit_retries")
+                    time.sleep(random.uniform(
+                        0, settings.CLIENTFREQBACKOFF * 2 ** limit_retries))
+                    limit_retries += 1
+                    continue
+                raise
+            breaker.success()
+            return rv
+
+    def _renew_access_token(self, token):
+        """接口返回accesstoken失效,由一个worker刷新"""
+        if self.session.get(self.access_token_key) == token:
+            # 标记为已过期 其他worker等待刷新完成
+            self.session.set(self.access_token_key + "_expires_at", 1)
+        self.access_token
+
+    def _endpoint(self, url_or_endpoint, kwargs):
+        if not url_or_endpoint.startswith(("http://", "https://")):
+            url_or_endpoint = kwargs.get(
+                "api_base_url", self.API_BASE_URL) + url_or_endpoint
+        return urlsplit(url_or_endpoint).path
+
+    def _send(self, method, url_or_endpoint, **kwargs):
         self._update_log(method=method, url=url_or_endpoint, **kwargs)
         try:
             rv = super(WeChatClient, self)._request(
@@ -76,6 +252,11 @@ class WeChatClient(_Client):
     def _handle_result(self, res, method=None, url=None, *args, **kwargs):
         resp = res.content if hasattr(res, "content") else res
         self._update_log(resp=resp)
+        if _errcode(res) in INVALID_TOKEN_ERRCODES\
+                and hasattr(self.session, "invalidate"):
+            # 进程内缓存的accesstoken可能已被其他进程刷新
+            self.session.invalidate(
+                self.access_token_key, self.access_token_key + "_expires_at")
         return super(WeChatClient, self)._handle_result(
             res, method, url, *args, **kwargs)
 
@@ -96,3 +277,130 @@ class WeChatClient(_Client):
             kwargs["exc_info"] = True
         self.app.logger("api").log(level, msg)
         self._log_kwargs.clear()
+
+
+class TokenRefresher(object):
+    """后台线程每隔interval秒检查进程内的client,在accesstoken及jsapi ticket
+    过期前WECHAT_CLIENTTOKENREFRESHAHEAD秒内刷新,避免请求中同步刷新
+
+    :param interval: 检查间隔(秒),为0时不启动后台线程
+    """
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self._clients = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def register(self, client):
+        """:type client: wechat_django.client.WeChatClient"""
+        if not self.interval:
+            return
+        with self._lock:
+            self._clients[client.appid] = client
+            if not self._thread or not self._thread.is_alive():
+                # fork后的子进程中线程不存在 需要重新启动
+                self._thread = threading.Thread(
+                    target=self._run, name="wechat-token-refresher")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def refresh(self):
+        for client in list(self._clients.values()):
+            try:
+                client.refresh_tokens()
+            except Exception:
+                client.app.logger("client").warning(
+                    "refresh tokens failed", exc_info=True)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.refresh()
+
+
+token_refresher = TokenRefresher(settings.CLIENTTOKENREFRESHINTERVAL)
+
+
+class CircuitBreaker(object):
+    """单个公众号单个接口的熔断器,连续threshold次调用频率超限后熔断
+    cooldown秒,熔断结束后再次超限立即熔断,调用成功时复位
+
+    :param threshold: 熔断的连续超限次数,为0时不熔断
+    :param cooldown: 熔断秒数
+    """
+
+    def __init__(self, threshold=5, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.errcode = None
+        self.failures = 0
+        self.opened_until = 0
+        self.counters = dict(token_retries=0, limit_retries=0, trips=0,
+                             rejections=0)
+        self._lock = threading.Lock()
+
+    def allow(self):
+        if self.opened_until <= time.time():
+            return True
+        self.record("rejections")
+        return False
+
+    def failure(self, errcode):
+        """记录一次频率超限,返回是否熔断"""
+        with self._lock:
+            self.errcode = errcode
+            self.failures += 1
+            if not self.threshold or self.failures < self.threshold:
+                return False
+            self.opened_until = time.time() + self.cooldown
+            self.counters["trips"] += 1
+            return True
+
+    def success(self):
+        if self.failures:
+            with self._lock:
+                self.failures = 0
+                self.opened_until = 0
+
+    def record(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, failures=self.failures,
+                        open=self.opened_until > time.time())
+
+
+_breakers = dict()
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(appname, endpoint):
+    """
+    :rtype: wechat_django.client.CircuitBreaker
+    """
+    key = (appname, endpoint)
+    breaker = _breakers.get(key)
+    if not breaker:
+        with _breakers_lock:
+            breaker = _breakers.get(key)
+            if not breaker:
+                breaker = _breakers[key] = CircuitBreaker(
+                    settings.CLIENTBREAKERTHRESHOLD,
+                    settings.CLIENTBREAKERCOOLDOWN)
+    return breaker
+
+
+def api_stats():
+    """各公众号各接口的重试,熔断次数及熔断状态
+
+        {"appname": {"/cgi-bin/message/custom/send": {
+            "token_retries": 1, "limit_retries": 2, "trips": 0,
+            "rejections": 0, "failures": 0, "open": False}}}
+    """
+    rv = dict()
+    for (appname, endpoint), breaker in list(_breakers.items()):
+        rv.setdefault(appname, dict())[endpoint] = breaker.stats()
+    return rv
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+"""消息转发
+
+同一host的转发共用requests.Session连接池并限制并发连接数,超时时间为回复微信
+剩余的时间.记录各转发目标的耗时分布及错误数
+"""
+
+from __future__ import unicode_literals
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from six.moves.urllib.parse import urlsplit
+
+from . import settings
+
+__all__ = ("forward", "forward_async", "forward_stats", "Upstream")
+
+
+class Upstream(object):
+    """转发目标host,持有连接池及耗时统计"""
+
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 4, 5)
+    """耗时分布的分桶上限(秒)"""
+
+    def __init__(self, host, max_connections):
+        self.host = host
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=max_connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._semaphore = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self.histogram = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.
+
+    def post(self, url, data, params=None, deadline=None):
+        """
+        :param deadline: 截止时间戳,超时时间为剩余时间
+        :raises: requests.exceptions.RequestException
+        """
+        if not self._semaphore.acquire(timeout=_remaining(deadline)):
+            self._record(None)
+            raise requests.exceptions.ConnectTimeout(
+                "too many connections to {0}".format(self.host))
+        start = time.time()
+        try:
+            resp = self.session.post(url, data, params=params,
+                                     timeout=_remaining(deadline))
+            resp.raise_for_status()
+        except requests.exceptions.RequestException:
+            self._record(None)
+            raise
+        finally:
+            self._semaphore.release()
+        self._record(time.time() - start)
+        return resp
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                count=self.count,
+                errors=self.errors,
+                total_time=self.total_time,
+                buckets=dict(zip(self.buckets + ("+Inf",), self.histogram))
+            )
+
+    def _record(self, elapsed):
+        with self._lock:
+            self.count += 1
+            if elapsed is None:
+                self.errors += 1
+                return
+            self.total_time += elapsed
+            for i, bucket in enumerate(self.buckets):
+                if elapsed <= bucket:
+                    break
+            else:
+                i = len(self.buckets)
+            self.histogram[i] += 1
+
+
+_upstreams = dict()
+_lock = threading.Lock()
+_executor = None
+_pid = None
+
+
+def _get_executor():
+    global _executor, _pid
+    if not _executor or _pid != os.getpid():
+        with _lock:
+            if not _executor or _pid != os.getpid():
+                # fork后的子进程中线程不存在 需要重新创建线程池
+                _executor = ThreadPoolExecutor(
+                    settings.MESSAGEFORWARDWORKERS,
+                    thread_name_prefix="wechat-forward")
+                _pid = os.getpid()
+    return _executor
+
+
+def get_upstream(url):
+    """
+    :rtype: wechat_django.forward.Upstream
+    """
+    host = urlsplit(url).netloc
+    upstream = _upstreams.get(host)
+    if not upstream:
+        with _lock:
+            upstream = _upstreams.get(host)
+            if not upstream:
+                upstream = _upstreams[host] = Upstream(
+                    host, settings.MESSAGEFORWARDMAXCONNECTIONS)
+    return upstream
+
+
+def forward(urls, data, params=None, deadline=None):
+    """转发消息,有多个转发目标时同时转发,返回首个成功的响应
+
+    :rtype: requests.Response
+    :raises: requests.exceptions.RequestException
+    """
+    def post(url):
+        return get_upstream(url).post(url, data, params, deadline)
+
+    if len(urls) == 1:
+        return post(urls[0])
+
+    pending = set(_get_executor().submit(post, url) for url in urls)
+    error = None
+    while pending:
+        done, pending = wait(pending, timeout=_remaining(deadline),
+                             return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error or requests.exceptions.Timeout("forward timeout")
+
+
+async def forward_async(urls, data, params=None, deadline=None):
+    """异步转发消息,请求在转发线程池中执行,不阻塞事件循环
+
+    :rtype: requests.Response
+    :raises: requests.exceptions.RequestException
+    """
+    def post(url):
+        return get_upstream(url).post(url, data, params, deadline)
+
+    pending = set(asyncio.wrap_future(_get_executor().submit(post, url))
+                  for url in urls)
+    error = None
+    while pending:
+        done, pending = await asyncio.wait(
+            pending, timeout=_remaining(deadline),
+            return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    for future in pending:
+        future.cancel()
+    raise error or requests.exceptions.Timeout("forward timeout")
+
+
+def forward_stats():
+    """各转发目标的请求数,错误数,耗时及耗时分布
+
+        {"example.com": {"count": 10, "errors": 1, "total_time": 1.2,
+                         "buckets": {0.05: 3, 0.1: 6, ..., "+Inf": 0}}}
+    """
+    return {host: upstream.stats() for host, upstream in _upstreams.items()}
+
+
+def _remaining(deadline):
+    if deadline is None:
+        return settings.MESSAGEDEADLINE
+    # 超时的请求仍给予最短的超时时间以便立即失败
+    return max(deadline - time.time(), 0.001)
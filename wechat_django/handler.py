@@ -4,16 +4,22 @@
 
 from __future__ import unicode_literals
 
-from contextlib import contextmanager
-from functools import wraps
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from copy import copy
+from functools import partial, wraps
 import logging
+import os
+import threading
 import time
 
+from django.conf import settings as django_settings
 from django.core.cache import cache
 from django.http import response
 from django.utils.datastructures import MultiValueDictKeyError
+from django.utils.module_loading import import_string
 import six
-from wechatpy import parse_message, replies
+from wechatpy import replies
 from wechatpy.events import BaseEvent
 from wechatpy.exceptions import InvalidSignatureException
 from wechatpy.utils import check_signature
@@ -21,10 +27,14 @@ import xmltodict
 
 from . import settings, signals
 from .exceptions import BadMessageRequest, MessageHandleError
+from .parser import parse_envelope, parse_message
 from .sites.wechat import default_site, WeChatInfo, WeChatView
+from .timing import emit, NullTiming, Timing
+from .utils.aio import markcoroutinefunction, run_sync
+from .utils.executor import close_connections
 
-__all__ = ("handle_subscribe_events", "Handler", "message_handler",
-           "message_rule", "WeChatMessageInfo")
+__all__ = ("AsyncHandler", "get_program", "handle_subscribe_events",
+           "Handler", "message_handler", "message_rule", "WeChatMessageInfo")
 
 
 class WeChatMessageInfo(WeChatInfo):
@@ -37,18 +47,65 @@ class WeChatMessageInfo(WeChatInfo):
     @property
     def user(self):
         """
+        惰性加载的用户,访问openid以外的属性时才读取数据库,
+        库中不存在的用户在后台同步,不在回复消息时请求微信接口
         :rtype: wechat_django.models.WeChatUser
         """
-        local_user = None
-        if hasattr(self, "_local_user"):
-            local_user = self.local_user
         if not hasattr(self, "_user"):
-            self._user = self.app.user_by_openid(
-                self.message.source, ignore_errors=True)
-            if hasattr(local_user, "first_subscribe"):
-                self._user.first_subscribe = local_user.first_subscribe
+            if hasattr(self, "_local_user"):
+                self._user = self._local_user
+            else:
+                self._user = self.app.lazy_user_by_openid(self.openid)
         return self._user
 
+    @property
+    def local_user(self):
+        """同user,不在回复消息时请求微信接口
+        :rtype: wechat_django.models.WeChatUser
+        """
+        return self.user
+
+    @property
+    def received_at(self):
+        """收到请求的时间戳"""
+        if not hasattr(self, "_received_at"):
+            self._received_at = time.time()
+        return self._received_at
+
+    first_subscribe = None
+    """关注事件中用户是否首次关注,其他消息为None"""
+
+    _late_reply = False
+
+    @property
+    def deadline(self):
+        """须回复微信的截止时间戳,自收到请求起计算.可能以客服消息发送的回复
+        不受被动回复时限约束,以WECHAT_MESSAGELATEREPLYDEADLINE为准
+        """
+        if self._late_reply:
+            return self.received_at + settings.MESSAGELATEREPLYDEADLINE
+        return self.received_at + settings.MESSAGEDEADLINE
+
+    def late_reply(self):
+        """可能以客服消息发送回复的消息
+        :rtype: wechat_django.handler.WeChatMessageInfo
+        """
+        if self._late_reply:
+            return self
+        message_info = copy(self)
+        message_info._late_reply = True
+        return message_info
+
+    @property
+    def timing(self):
+        """各阶段耗时,未开启WECHAT_MESSAGETIMING时不记录
+        :rtype: wechat_django.timing.Timing
+        """
+        if not hasattr(self, "_timing"):
+            timing_class = Timing if settings.MESSAGETIMING else NullTiming
+            self._timing = timing_class()
+        return self._timing
+
     @property
     def message(self):
         """
@@ -59,13 +116,15 @@ class WeChatMessageInfo(WeChatInfo):
             app = self.app
             request = self.request
             if app.crypto:
-                self._raw = app.crypto.decrypt_message(
-                    self.raw,
-                    request.GET["msg_signature"],
-                    request.GET["timestamp"],
-                    request.GET["nonce"]
-                )
-            self._message = parse_message(self.raw)
+                with self.timing.stage("decrypt"):
+                    self._raw = app.crypto.decrypt_message(
+                        parse_envelope(self.raw) or self.raw,
+                        request.GET["msg_signature"],
+                        request.GET["timestamp"],
+                        request.GET["nonce"]
+                    )
+            with self.timing.stage("parse"):
+                self._message = parse_message(self.raw)
         return self._message
 
     @property
@@ -78,12 +137,30 @@ class WeChatMessageInfo(WeChatInfo):
         return self.request.body
 
 
+_PENDING_REPLY = 0
+"""处理中的消息在回复缓存中的占位,回复缓存中存放加密后的回复"""
+
+
 @default_site.register
 class Handler(WeChatView):
     url_pattern = r"^$"
     url_name = "handler"
 
+    _expires = None
+    _repeat_nonce = False
+
     def initial(self, request, appname):
+        self._verify(request)
+        # 防重放检查
+        if settings.MESSAGENOREPEATNONCE:
+            with request.wechat.timing.stage("nonce"):
+                self._repeat_nonce = not self._add_nonce(
+                    request.GET["signature"], request.GET["nonce"])
+
+    def _verify(self, request):
+        """校验时间戳及签名"""
+        request.wechat.received_at  # 开始计时
+        timing = request.wechat.timing
         try:
             timestamp = int(request.GET["timestamp"])
         except ValueError:
@@ -96,8 +173,7 @@ class Handler(WeChatView):
         if abs(time_diff) > settings.MESSAGETIMEOFFSET:
             raise BadMessageRequest("invalid time")
 
-        # 防重放检查及签名检查
-        with self._no_repeat_nonces(sign, nonce, time_diff):
+        with timing.stage("signature"):
             check_signature(
                 request.wechat.app.token,
                 sign,
@@ -105,11 +181,20 @@ class Handler(WeChatView):
                 nonce
             )
 
+        if settings.MESSAGENOREPEATNONCE:
+            self._expires = int(settings.MESSAGETIMEOFFSET + time_diff)
+
     def finalize_response(self, request, resp, *args, **kwargs):
         if not isinstance(resp, response.HttpResponseNotFound):
             self.log(logging.DEBUG, "receive a message")
-        return super(Handler, self).finalize_response(
+        resp = super(Handler, self).finalize_response(
             request, resp, *args, **kwargs)
+        timing = getattr(request.wechat, "_timing", None)
+        if timing and timing.enabled:
+            if django_settings.DEBUG:
+                resp["Server-Timing"] = timing.server_timing()
+            emit(request.wechat.app, request.wechat, timing)
+        return resp
 
     def handle_exception(self, exc):
         if isinstance(exc, MultiValueDictKeyError):
@@ -138,56 +223,165 @@ class Handler(WeChatView):
 
     def post(self, request, appname):
         message_info = request.wechat
+        timing = message_info.timing
+        reply_key = None
+        if settings.MESSAGENOREPEATNONCE:
+            reply_key = self._reply_key(message_info)
+            with timing.stage("nonce"):
+                added = not self._repeat_nonce and cache.add(
+                    reply_key, _PENDING_REPLY, self.expires)
+            if not added:
+                return self._retry_response(self._wait_reply(reply_key))
+
         signals.message_received.send(request.wechat.app.staticname,
-                                      message_info=message_info)
+                                      message_info=message_info,
+                                      timing=timing)
+        try:
+            xml = self._reply_in_time(message_info)
+        except Exception:
+            if reply_key:
+                self._release(reply_key)
+            raise
+        with timing.stage("encrypt"):
+            body = self._encrypt(xml) if xml else ""
+        if reply_key:
+            with timing.stage("nonce"):
+                cache.set(reply_key, body, self.expires)
+        return self._response(body)
+
+    def _reply_in_time(self, message_info):
+        """处理消息并渲染回复,开启WECHAT_MESSAGEREPLYTIMEOUT时于后台处理,
+        超时未完成的先回复空消息,完成后以客服消息发送回复
+        :rtype: str
+        """
+        if not settings.MESSAGEREPLYTIMEOUT:
+            return self._process(message_info)[1]
+
+        # 超时的回复仍需完成 转发等不以被动回复的截止时间为限
+        future = _get_replier().submit(close_connections(self._process),
+                                message_info.late_reply())
+        try:
+            return future.result(self._reply_timeout(message_info))[1]
+        except TimeoutError:
+            self.log(logging.WARNING,
+                     "reply timeout, send the reply by customer service")
+            future.add_done_callback(
+                partial(self._send_late_reply, message_info))
+            return ""
+
+    def _process(self, message_info):
+        """处理消息并渲染回复
+        :rtype: (wechatpy.replies.BaseReply, str)
+        """
+        app = message_info.app
+        timing = message_info.timing
         try:
             reply = self._handle(message_info)
-            signals.message_handled.send(request.wechat.app.staticname,
+            signals.message_handled.send(app.staticname,
                                          message_info=message_info,
-                                         reply=reply)
-            if reply:
-                xml = reply.render()
-                if request.wechat.app.crypto:
-                    xml = request.wechat.app.crypto.encrypt_message(
-                        xml, request.GET["nonce"], request.GET["timestamp"])
-                return response.HttpResponse(xml, content_type="text/xml")
+                                         reply=reply, timing=timing)
+            with timing.stage("render"):
+                xml = reply.render() if reply else ""
         except Exception as exc:
-            signals.message_error.send(request.wechat.app.staticname,
+            signals.message_error.send(app.staticname,
                                        message_info=message_info, exc=exc)
             raise
-        return ""
+        return reply, xml
+
+    def _reply_timeout(self, message_info):
+        elapsed = time.time() - message_info.received_at
+        return max(settings.MESSAGEREPLYTIMEOUT - elapsed, 0)
+
+    def _send_late_reply(self, message_info, future):
+        """以客服消息发送超时的回复"""
+        from .models import Reply
+
+        try:
+            reply = future.result()[0]
+            funcname, kwargs = Reply.reply2send(reply)
+            if funcname:
+                getattr(message_info.app.client.message, funcname)(**kwargs)
+        except Exception:
+            self.log(logging.ERROR, "send a late reply failed", exc_info=True)
 
     def _update_wechat_info(self, request, *args, **kwargs):
         return WeChatMessageInfo.from_wechat_info(request.wechat)
 
-    @contextmanager
-    def _no_repeat_nonces(self, sign, nonce, time_diff):
-        """nonce防重放"""
-        nonce_key = "wx:m:n:{0}".format(sign)
-        if settings.MESSAGENOREPEATNONCE:
-            if cache.get(nonce_key) == nonce:
-                raise BadMessageRequest("repeat nonce string")
-            try:
-                yield
-                expires = settings.MESSAGETIMEOFFSET + time_diff
-                cache.set(nonce_key, nonce, expires)
-            finally:
-                pass
+    def _add_nonce(self, sign, nonce):
+        """原子地记录nonce,已存在时返回False"""
+        return cache.add(self._nonce_key(sign), nonce, self.expires)
+
+    def _nonce_key(self, sign):
+        return "wx:m:n:{0}".format(sign)
+
+    def _release(self, reply_key):
+        """处理失败的消息允许微信以相同的签名及nonce重试"""
+        cache.delete_many(
+            [reply_key, self._nonce_key(self.request.GET["signature"])])
+
+    @property
+    def expires(self):
+        """防重放记录的有效期"""
+        return self._expires or settings.MESSAGETIMEOFFSET
+
+    def _reply_key(self, message_info):
+        """以MsgId标识消息,事件无MsgId,以发送者,发送时间及事件类型标识"""
+        message = message_info.message
+        if message.id:
+            fingerprint = message.id
         else:
-            yield
+            fingerprint = "{0}:{1}:{2}".format(
+                message.source, message.time,
+                getattr(message, "event", message.type))
+        return "wx:m:r:{0}:{1}".format(message_info.app.id, fingerprint)
+
+    def _retry_response(self, body):
+        """微信重试的消息直接返回首次处理的回复,首次请求仍在处理中时等待其结果"""
+        if body is None and self._repeat_nonce:
+            # 签名重复但并非已处理过的消息
+            raise BadMessageRequest("repeat nonce string")
+        if body == _PENDING_REPLY:
+            self.log(logging.WARNING, "wait for a pending reply timeout")
+            return ""
+        self.log(logging.DEBUG, "reply a retried message")
+        return self._response(body)
+
+    def _wait_reply(self, reply_key):
+        deadline = time.time() + settings.MESSAGEREPLYWAITTIMEOUT
+        while True:
+            body = cache.get(reply_key)
+            if body != _PENDING_REPLY or time.time() >= deadline:
+                return body
+            time.sleep(0.05)
+
+    def _encrypt(self, xml):
+        app = self.request.wechat.app
+        if app.crypto:
+            xml = app.crypto.encrypt_message(
+                xml, self.request.GET["nonce"], self.request.GET["timestamp"])
+        return xml
+
+    def _response(self, body):
+        if not body:
+            return ""
+        return response.HttpResponse(body, content_type="text/xml")
 
     def _handle(self, message_info):
         """处理消息"""
         from .models import MessageHandler, MessageLog
 
-        handlers = MessageHandler.matches(message_info)
+        timing = message_info.timing
+        with timing.stage("match"):
+            handlers = MessageHandler.matches(message_info)
         if not handlers:
             return None
 
         handler = handlers[0]
-        reply = handler.reply(message_info)
+        with timing.stage("reply"):
+            reply = handler.reply(message_info)
         if handler.log_message or message_info.app.log_message:
-            MessageLog.from_message_info(message_info)
+            with timing.stage("log"):
+                MessageLog.log_message_info(message_info)
         if not reply or isinstance(reply, replies.EmptyReply):
             return None
         return reply
@@ -202,6 +396,178 @@ class Handler(WeChatView):
         return self._log
 
 
+@default_site.register
+class AsyncHandler(Handler):
+    """异步消息处理器,匹配规则及回复与Handler一致
+
+    签名校验,解密及解析在事件循环中完成,数据库及缓存操作经run_sync在有界
+    线程池中执行,自定义回复可为``async def``,转发回复不占用请求线程.
+    须以ASGI部署,将微信消息推送地址配置为``{appname}/async/``
+    """
+    url_pattern = r"^async/$"
+    url_name = "async_handler"
+
+    @classmethod
+    def as_view(cls, **initKwargs):
+        view = super(AsyncHandler, cls).as_view(**initKwargs)
+        return markcoroutinefunction(view)
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = await run_sync(
+            self.initialize_request, request, *args, **kwargs)
+        self.request = request
+
+        try:
+            await self.initial(request, *args, **kwargs)
+            method = request.method.lower()
+            if method in self.http_method_names:
+                handler = getattr(self, method, self.http_method_not_allowed)
+            else:
+                handler = self.http_method_not_allowed
+            response = handler(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args,
+                                               **kwargs)
+        return self.response
+
+    async def initial(self, request, appname):
+        self._verify(request)
+        # 防重放检查
+        if settings.MESSAGENOREPEATNONCE:
+            with request.wechat.timing.stage("nonce"):
+                self._repeat_nonce = not await run_sync(
+                    self._add_nonce,
+                    request.GET["signature"], request.GET["nonce"])
+
+    async def get(self, request, appname):
+        return request.GET["echostr"]
+
+    async def post(self, request, appname):
+        message_info = request.wechat
+        timing = message_info.timing
+        reply_key = None
+        if settings.MESSAGENOREPEATNONCE:
+            reply_key = self._reply_key(message_info)
+            with timing.stage("nonce"):
+                added = not self._repeat_nonce and await run_sync(
+                    cache.add, reply_key, _PENDING_REPLY, self.expires)
+            if not added:
+                body = await self._wait_reply(reply_key)
+                return self._retry_response(body)
+
+        await run_sync(
+            signals.message_received.send, request.wechat.app.staticname,
+            message_info=message_info, timing=timing)
+        try:
+            xml = await self._reply_in_time(message_info)
+        except Exception:
+            if reply_key:
+                await run_sync(self._release, reply_key)
+            raise
+        with timing.stage("encrypt"):
+            body = self._encrypt(xml) if xml else ""
+        if reply_key:
+            with timing.stage("nonce"):
+                await run_sync(cache.set, reply_key, body, self.expires)
+        return self._response(body)
+
+    async def _reply_in_time(self, message_info):
+        if not settings.MESSAGEREPLYTIMEOUT:
+            return (await self._process(message_info))[1]
+
+        task = asyncio.ensure_future(
+            self._process(message_info.late_reply()))
+        try:
+            reply, xml = await asyncio.wait_for(
+                asyncio.shield(task), self._reply_timeout(message_info))
+            return xml
+        except asyncio.TimeoutError:
+            self.log(logging.WARNING,
+                     "reply timeout, send the reply by customer service")
+            late = asyncio.ensure_future(
+                self._send_late_reply_async(message_info, task))
+            # 保持引用 避免未完成的任务被回收
+            _late_replies.add(late)
+            late.add_done_callback(_late_replies.discard)
+            return ""
+
+    async def _process(self, message_info):
+        app = message_info.app
+        timing = message_info.timing
+        try:
+            reply = await self._handle(message_info)
+            await run_sync(
+                signals.message_handled.send, app.staticname,
+                message_info=message_info, reply=reply, timing=timing)
+            with timing.stage("render"):
+                xml = reply.render() if reply else ""
+        except Exception as exc:
+            await run_sync(
+                signals.message_error.send, app.staticname,
+                message_info=message_info, exc=exc)
+            raise
+        return reply, xml
+
+    async def _send_late_reply_async(self, message_info, task):
+        await asyncio.wait([task])
+        await run_sync(self._send_late_reply, message_info, task)
+
+    async def _wait_reply(self, reply_key):
+        deadline = time.time() + settings.MESSAGEREPLYWAITTIMEOUT
+        while True:
+            body = await run_sync(cache.get, reply_key)
+            if body != _PENDING_REPLY or time.time() >= deadline:
+                return body
+            await asyncio.sleep(0.05)
+
+    async def _handle(self, message_info):
+        """处理消息"""
+        from .models import MessageHandler, MessageLog
+
+        timing = message_info.timing
+        with timing.stage("match"):
+            handlers = await run_sync(MessageHandler.matches, message_info)
+        if not handlers:
+            return None
+
+        handler = handlers[0]
+        with timing.stage("reply"):
+            reply = await handler.reply_async(message_info)
+        if handler.log_message or message_info.app.log_message:
+            with timing.stage("log"):
+                await run_sync(MessageLog.log_message_info, message_info)
+        if not reply or isinstance(reply, replies.EmptyReply):
+            return None
+        return reply
+
+
+_replier = None
+"""开启WECHAT_MESSAGEREPLYTIMEOUT时处理消息的线程池"""
+_replier_pid = None
+_replier_lock = threading.Lock()
+
+
+def _get_replier():
+    global _replier, _replier_pid
+    if not _replier or _replier_pid != os.getpid():
+        with _replier_lock:
+            if not _replier or _replier_pid != os.getpid():
+                # fork后的子进程中线程不存在 需要重新创建线程池
+                _replier = ThreadPoolExecutor(
+                    settings.MESSAGEREPLYWORKERS,
+                    thread_name_prefix="wechat-replier")
+                _replier_pid = os.getpid()
+    return _replier
+
+_late_replies = set()
+
+
 def message_handler(names_or_func=None):
     """
     自定义回复业务需加装该装饰器
@@ -220,6 +586,15 @@ def message_handler(names_or_func=None):
         @message_handler(("app_a", "app_b"))
         def app_ab_only_business(message):
             # ...
+
+    亦可为``async def``,由AsyncHandler在事件循环中直接执行,由Handler执行时
+    以async_to_sync执行.异步业务中访问数据库(包括message.user)须经过
+    ``wechat_django.utils.aio.run_sync``
+
+        @message_handler
+        async def async_business(message):
+            user = await run_sync(lambda: message.user.nickname)
+            # ...
     """
     return _decorator("message_handler", names_or_func)
 
@@ -243,13 +618,50 @@ def message_rule(names_or_func=None):
     return _decorator("message_rule", names_or_func)
 
 
+_programs = dict()
+"""已解析的自定义规则及自定义回复,以dotted path为键"""
+
+_missing_programs = set()
+
+
+def get_program(path):
+    """根据dotted path取得自定义规则或自定义回复,优先从已注册的程序中取,
+    否则导入并缓存.不存在的程序只记录一次日志
+
+    :rtype: callable or None
+    """
+    try:
+        return _programs[path]
+    except KeyError:
+        pass
+    if path in _missing_programs:
+        return None
+    try:
+        func = import_string(path)
+    except ImportError:
+        _missing_programs.add(path)
+        logging.getLogger("wechat.handler").warning(
+            "custom program %s not found", path, exc_info=True)
+        return None
+    _programs[path] = func
+    return func
+
+
 def _decorator(property, names_or_func):
     def decorator(view_func):
-        @wraps(view_func)
-        def decorated_view(message):
-            return view_func(message)
+        if asyncio.iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def decorated_view(message):
+                return await view_func(message)
+        else:
+            @wraps(view_func)
+            def decorated_view(message):
+                return view_func(message)
         setattr(decorated_view, property, names or True)
 
+        path = "{0}.{1}".format(view_func.__module__, view_func.__qualname__)
+        _programs[path] = decorated_view
+        _missing_programs.discard(path)
         return decorated_view
 
     if isinstance(names_or_func, six.text_type):
@@ -262,19 +674,16 @@ def _decorator(property, names_or_func):
 
 
 def handle_subscribe_events(sender, message_info, **kwargs):
-    """处理关注,取关"""
+    """处理关注,取关,关注状态在后台写入"""
     message = message_info.message
     if isinstance(message, BaseEvent):
+        app = message_info.app
         # 关注事件
         if message.event in ("subscribe", "subscribe_scan"):
-            # 首次订阅
-            first_subscribe = message_info.local_user.subscribe is None
-            message_info.local_user.first_subscribe = first_subscribe
-            message_info.local_user.subscribe = True
-            message_info.local_user.subscribe_time = time.time()
-            message_info.local_user.save()
+            message_info.first_subscribe = app.subscribe_user(
+                message.source, True, message.time)
+            message_info.user.first_subscribe = message_info.first_subscribe
 
         # 取关事件
         if message.event == "unsubscribe":
-            message_info.local_user.subscribe = False
-            message_info.local_user.save()
+            app.subscribe_user(message.source, False, message.time)
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ...models import WeChatApp
+
+
+class Command(BaseCommand):
+    help = ("汇总消息日志每日统计,并删除(或归档后删除)超过保留天数的消息日志."
+            "建议每日定时执行")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days", type=int, default=None,
+            help="消息日志保留天数,不填只汇总不删除")
+        parser.add_argument(
+            "--archive", default=None, metavar="DIR",
+            help="删除前归档至该目录,按公众号及日期存为jsonl.gz文件")
+        parser.add_argument(
+            "--app", action="append", dest="apps", metavar="APPNAME",
+            help="只处理指定公众号,可重复指定")
+        parser.add_argument(
+            "--batch-size", type=int, default=1000,
+            help="每批删除的日志数")
+
+    def handle(self, *args, **options):
+        days = options["days"]
+        if days is not None and days < 1:
+            raise CommandError("--days must be a positive integer")
+
+        apps = WeChatApp.objects.all()
+        if options["apps"]:
+            apps = apps.filter(name__in=options["apps"])
+
+        today = timezone.localdate()
+        for app in apps:
+            stats = app.rollup_message_logs(until=today)
+            self.stdout.write("{0}: {1} daily statistics updated".format(
+                app.name, len(stats)))
+
+            if days is not None:
+                count = app.prune_message_logs(
+                    today - timedelta(days=days),
+                    archive_dir=options["archive"],
+                    batch_size=options["batch_size"])
+                self.stdout.write("{0}: {1} message logs {2}".format(
+                    app.name, count,
+                    "archived" if options["archive"] else "deleted"))
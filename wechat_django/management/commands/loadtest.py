@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import random
+import signal
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import NoReverseMatch, reverse
+import requests
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import urlsplit
+from wechatpy.utils import random_string, WeChatSigner
+
+from ...client import WeChatClient
+from ...models import MessageHandler, Rule, WeChatApp
+from ...parser import parse_envelope
+
+TEXT = """<xml>
+<ToUserName><![CDATA[{to}]]></ToUserName>
+<FromUserName><![CDATA[{openid}]]></FromUserName>
+<CreateTime>{time}</CreateTime>
+<MsgType><![CDATA[text]]></MsgType>
+<Content><![CDATA[{content}]]></Content>
+<MsgId>{msg_id}</MsgId>
+</xml>"""
+
+EVENT = """<xml>
+<ToUserName><![CDATA[{to}]]></ToUserName>
+<FromUserName><![CDATA[{openid}]]></FromUserName>
+<CreateTime>{time}</CreateTime>
+<MsgType><![CDATA[event]]></MsgType>
+<Event><![CDATA[{event}]]></Event>
+<EventKey><![CDATA[{key}]]></EventKey>
+</xml>"""
+
+KINDS = ("text", "click", "subscribe", "retry")
+
+STUB_CONFIGURATIONS = ("ACCESSTOKEN_URL", "API_BASE_URL", "ACCESSTOKEN_KEY")
+"""压测期间指向桩服务的公众号配置"""
+
+
+class MessageFactory(object):
+    """按公众号的token及加密方式生成带签名的推送消息"""
+
+    def __init__(self, app, keywords, menu_keys, users=1000, seed=None):
+        self.app = app
+        self.keywords = keywords or ["hello"]
+        self.menu_keys = menu_keys or ["menu"]
+        self.users = users
+        self.random = random.Random(seed)
+        self._msg_id = int(time.time() * 1000000)
+        self._sent = deque(maxlen=100)
+
+    def build(self, kind):
+        """
+        :returns: (query, body)
+        """
+        if kind == "retry" and self._sent:
+            # 原样重发 与微信超时重试相同 由nonce防重放处理
+            return self.random.choice(self._sent)
+
+        now = int(time.time())
+        openid = "loadtest{0}".format(self.random.randrange(self.users))
+        if kind == "subscribe":
+            xml = EVENT.format(to=self.app.appid, openid=openid, time=now,
+                               event="subscribe", key="")
+        elif kind == "click":
+            xml = EVENT.format(to=self.app.appid, openid=openid, time=now,
+                               event="CLICK",
+                               key=self.random.choice(self.menu_keys))
+        else:
+            self._msg_id += 1
+            xml = TEXT.format(to=self.app.appid, openid=openid, time=now,
+                              content=self.random.choice(self.keywords),
+                              msg_id=self._msg_id)
+        rv = self.sign(xml, str(now), random_string(16))
+        self._sent.append(rv)
+        return rv
+
+    def sign(self, xml, timestamp, nonce):
+        signer = WeChatSigner()
+        signer.add_data(self.app.token, timestamp, nonce)
+        query = dict(timestamp=timestamp, nonce=nonce,
+                     signature=signer.signature)
+        crypto = self.app.crypto
+        if crypto:
+            encrypted = parse_envelope(
+                crypto.encrypt_message(xml, nonce, timestamp))
+            query.update(encrypt_type="aes",
+                         msg_signature=encrypted["MsgSignature"])
+            xml = "<xml><ToUserName><![CDATA[{0}]]></ToUserName>"\
+                "<Encrypt><![CDATA[{1}]]></Encrypt></xml>".format(
+                    self.app.appid, encrypted["Encrypt"])
+        return query, xml.encode("utf-8")
+
+
+class Stats(object):
+    def __init__(self):
+        self.latencies = []
+        self.statuses = Counter()
+        self.errors = Counter()
+        self.kinds = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, kind, latency, status=None, error=None):
+        with self._lock:
+            self.kinds[kind] += 1
+            self.latencies.append(latency)
+            if error:
+                self.errors[error] += 1
+            else:
+                self.statuses[status] += 1
+
+    def report(self, elapsed, rate):
+        latencies = sorted(self.latencies)
+
+        def pick(p):
+            if not latencies:
+                return None
+            return latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+
+        failed = sum(self.errors.values()) + sum(
+            count for status, count in self.statuses.items() if status >= 400)
+        return dict(
+            sent=len(latencies),
+            seconds=elapsed,
+            target_rps=rate,
+            rps=len(latencies) / elapsed if elapsed else 0,
+            errors=failed,
+            statuses=dict((str(k), v) for k, v in self.statuses.items()),
+            exceptions=dict(self.errors),
+            kinds=dict(self.kinds),
+            unit="ms",
+            latency=dict(p50=pick(0.5), p90=pick(0.9), p99=pick(0.99),
+                         max=latencies[-1] if latencies else None)
+        )
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """模拟微信接口,accesstoken及批量获取用户信息返回固定数据,其余返回成功"""
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.respond()
+
+    def respond(self):
+        path = urlsplit(self.path).path
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if path.endswith("/token"):
+            data = dict(access_token="loadtest", expires_in=7200)
+        elif path.endswith("/user/info/batchget"):
+            openids = [
+                user["openid"]
+                for user in json.loads(body.decode("utf-8"))["user_list"]
+            ]
+            data = dict(user_info_list=[
+                dict(subscribe=1, openid=openid, nickname=openid)
+                for openid in openids
+            ])
+        else:
+            data = dict(errcode=0, errmsg="ok")
+        content = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class Command(BaseCommand):
+    help = ("按目标速率向本地运行的服务发送带签名(安全模式下加密)的推送消息,"
+            "压测公众号的消息处理接口,输出实际RPS,错误数及延迟分位数")
+
+    def add_arguments(self, parser):
+        parser.add_argument("appname")
+        parser.add_argument(
+            "--url", default=None,
+            help="消息处理接口地址,默认为--host加上handler的路径")
+        parser.add_argument(
+            "--host", default="http://127.0.0.1:8000",
+            help="本地运行的服务地址")
+        parser.add_argument(
+            "--rate", type=float, default=50, help="目标每秒请求数")
+        parser.add_argument(
+            "--duration", type=float, default=10, help="持续秒数")
+        parser.add_argument(
+            "--concurrency", type=int, default=20, help="最大并发请求数")
+        parser.add_argument(
+            "--mix", default="text=50,click=20,subscribe=20,retry=10",
+            help="各类消息的权重,可选text,click,subscribe,retry")
+        parser.add_argument(
+            "--burst", type=int, default=10,
+            help="每次关注事件同时发送的消息数")
+        parser.add_argument(
+            "--keyword", action="append", dest="keywords",
+            help="文本消息内容,可重复指定,默认取公众号的关键字规则")
+        parser.add_argument(
+            "--menu-key", action="append", dest="menu_keys",
+            help="菜单点击的key,可重复指定,默认取公众号的菜单事件规则")
+        parser.add_argument(
+            "--users", type=int, default=1000, help="模拟的用户数")
+        parser.add_argument(
+            "--timeout", type=float, default=5, help="请求超时秒数")
+        parser.add_argument(
+            "--stub", default=None, metavar="HOST:PORT",
+            help="在该地址启动模拟微信接口的桩服务,压测期间公众号的"
+                 "ACCESSTOKEN_URL及API_BASE_URL指向桩服务")
+        parser.add_argument("--seed", type=int, default=None)
+        parser.add_argument(
+            "--json", action="store_true", help="以json格式输出结果")
+
+    def handle(self, *args, **options):
+        try:
+            app = WeChatApp.objects.get_by_name(options["appname"])
+        except WeChatApp.DoesNotExist:
+            raise CommandError("app not found: " + options["appname"])
+        if options["rate"] <= 0 or options["duration"] <= 0:
+            raise CommandError("--rate and --duration must be positive")
+
+        url = options["url"]
+        if not url:
+            try:
+                url = options["host"].rstrip("/") + reverse(
+                    "wechat_django:handler", kwargs=dict(appname=app.name))
+            except NoReverseMatch:
+                raise CommandError("handler url not found, please use --url")
+
+        mix = self.parse_mix(options["mix"])
+        factory = MessageFactory(
+            app, options["keywords"] or self.get_keywords(app),
+            options["menu_keys"] or self.get_menu_keys(app),
+            options["users"], options["seed"])
+
+        if self.restore_stub(app):
+            self.stderr.write(
+                "restored configurations left by an interrupted stub")
+
+        stub = options["stub"] and self.start_stub(app, options["stub"])
+        # 被终止时同样还原配置
+        sigterm = signal.signal(signal.SIGTERM, self.terminate)
+        try:
+            report = self.run(url, factory, mix, options)
+        finally:
+            signal.signal(signal.SIGTERM, sigterm)
+            if stub:
+                self.stop_stub(app, stub)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+        else:
+            self.write_report(report)
+
+    def run(self, url, factory, mix, options):
+        stats = Stats()
+        local = threading.local()
+        rnd = random.Random(options["seed"])
+        kinds, weights = zip(*mix.items())
+        interval = 1. / options["rate"]
+        total = int(options["rate"] * options["duration"])
+
+        def send(kind, scheduled, query, body):
+            if not hasattr(local, "session"):
+                local.session = requests.Session()
+            try:
+                resp = local.session.post(
+                    url, body, params=query, timeout=options["timeout"],
+                    headers={"Content-Type": "text/xml"})
+                latency = (time.time() - scheduled) * 1000
+                stats.record(kind, latency, resp.status_code)
+            except requests.exceptions.RequestException as e:
+                latency = (time.time() - scheduled) * 1000
+                stats.record(kind, latency, error=type(e).__name__)
+
+        start = time.time()
+        with ThreadPoolExecutor(options["concurrency"]) as pool:
+            i = 0
+            while i < total:
+                # 开环发送 延迟自计划发送时间起算 含排队等待时间
+                scheduled = start + i * interval
+                delay = scheduled - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                kind = rnd.choices(kinds, weights)[0]
+                count = options["burst"] if kind == "subscribe" else 1
+                for _ in range(min(count, total - i)):
+                    query, body = factory.build(kind)
+                    pool.submit(send, kind, scheduled, query, body)
+                    i += 1
+        return stats.report(time.time() - start, options["rate"])
+
+    def parse_mix(self, value):
+        mix = dict()
+        try:
+            for item in value.split(","):
+                kind, weight = item.split("=")
+                mix[kind.strip()] = float(weight)
+        except ValueError:
+            raise CommandError("invalid --mix: " + value)
+        unknown = set(mix) - set(KINDS)
+        if unknown or not any(mix.values()):
+            raise CommandError("invalid --mix: " + value)
+        return dict((k, v) for k, v in mix.items() if v > 0)
+
+    def get_keywords(self, app):
+        rules = Rule.objects.filter(
+            handler__app=app, type__in=(Rule.Type.EQUAL, Rule.Type.CONTAIN))
+        return [rule.content["pattern"] for rule in rules]
+
+    def get_menu_keys(self, app):
+        rules = Rule.objects.filter(handler__app=app, type=Rule.Type.EVENTKEY)
+        return [
+            rule.content["key"] for rule in rules
+            if rule.content.get("event", "").lower()
+            == MessageHandler.EventType.CLICK.lower()
+        ]
+
+    def start_stub(self, app, address):
+        """启动桩服务,并将公众号接口指向桩服务,原配置记录于
+        configurations["LOADTEST_STUB"],进程被强行终止时在下次压测前还原
+        """
+        host, _, port = address.rpartition(":")
+        try:
+            server = StubServer((host or "127.0.0.1", int(port)), StubHandler)
+        except (ValueError, OSError) as e:
+            raise CommandError("can not start stub server: {0}".format(e))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        base_url = "http://{0}:{1}/cgi-bin/".format(*server.server_address)
+        app.configurations["LOADTEST_STUB"] = {
+            key: app.configurations.get(key) for key in STUB_CONFIGURATIONS
+        }
+        app.configurations["ACCESSTOKEN_URL"] = base_url + "token"
+        app.configurations["API_BASE_URL"] = base_url
+        # 桩服务的accesstoken不覆盖真实的accesstoken
+        app.configurations["ACCESSTOKEN_KEY"] =\
+            "{0}_loadtest_access_token".format(app.appid)
+        app.save()
+        return server
+
+    def stop_stub(self, app, server):
+        self.restore_stub(app)
+        server.shutdown()
+        server.server_close()
+
+    def restore_stub(self, app):
+        """还原桩服务修改的配置并清除桩服务的accesstoken
+        :returns: 是否有需还原的配置
+        """
+        app.refresh_from_db(fields=["configurations"])
+        original = app.configurations.pop("LOADTEST_STUB", None)
+        if original is None:
+            return False
+        token_key = app.configurations.get("ACCESSTOKEN_KEY")
+        for key, value in original.items():
+            if value is None:
+                app.configurations.pop(key, None)
+            else:
+                app.configurations[key] = value
+        app.save()
+        if token_key:
+            session = WeChatClient(app).session
+            session.delete(token_key)
+            session.delete(token_key + "_expires_at")
+        return True
+
+    def terminate(self, signum, frame):
+        raise SystemExit(128 + signum)
+
+    def write_report(self, report):
+        latency = report["latency"]
+        self.stdout.write(
+            "sent: {sent}  errors: {errors}  seconds: {seconds:.2f}  "
+            "rps: {rps:.1f} (target {target_rps:g})".format(**report))
+        if report["statuses"]:
+            self.stdout.write("statuses: " + " ".join(
+                "{0}={1}".format(k, v)
+                for k, v in sorted(report["statuses"].items())))
+        if report["exceptions"]:
+            self.stdout.write("exceptions: " + " ".join(
+                "{0}={1}".format(k, v)
+                for k, v in sorted(report["exceptions"].items())))
+        self.stdout.write("kinds: " + " ".join(
+            "{0}={1}".format(k, v) for k, v in sorted(report["kinds"].items())))
+        if latency["max"] is not None:
+            self.stdout.write(
+                "latency(ms): p50={p50:.2f} p90={p90:.2f} p99={p99:.2f} "
+                "max={max:.2f}".format(**latency))
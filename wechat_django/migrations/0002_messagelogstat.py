@@ -0,0 +1,29 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat_django', '0001_init'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageLogStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='date')),
+                ('type', models.CharField(choices=[('event', 'EVENT'), ('image', 'IMAGE'), ('link', 'LINK'), ('location', 'LOCATION'), ('shortvideo', 'SHORTVIDEO'), ('text', 'TEXT'), ('video', 'VIDEO'), ('voice', 'VOICE')], max_length=24, verbose_name='message type')),
+                ('direct', models.BooleanField(default=False, verbose_name='direct')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='count')),
+                ('app', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='message_log_stats', to='wechat_django.wechatapp')),
+            ],
+            options={
+                'verbose_name': 'message statistic',
+                'verbose_name_plural': 'message statistics',
+                'ordering': ('app', '-date', 'type'),
+                'unique_together': {('app', 'date', 'type', 'direct')},
+            },
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat_django', '0002_messagelogstat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wechatuser',
+            name='unsubscribe_time',
+            field=models.IntegerField(null=True, verbose_name='unsubscribe time'),
+        ),
+    ]
@@ -5,6 +5,7 @@ from __future__ import unicode_literals
 from .constants import MsgLogFlag, MsgType
 
 from .app import WeChatApp
+from . import appcache
 from .permission import permissions
 from .base import WeChatModel, appmethod
 from .template import Template
@@ -15,6 +16,7 @@ from .article import Article
 from .messagehandler import MessageHandler
 from .reply import Reply
 from .rule import Rule
-from .messagelog import MessageLog
+from . import dispatcher
+from .messagelog import MessageLog, MessageLogStat
 from .menu import Menu
 from .session import Session
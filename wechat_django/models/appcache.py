@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""公众号进程内缓存
+
+按名称缓存WeChatApp实例,连同实例上的client,crypto,oauth等对象在请求间复用,
+在公众号或其商户号变更时失效.开启WECHAT_APPCACHEVERSION时版本号存放于
+缓存中以保证多进程一致
+"""
+
+from __future__ import unicode_literals
+
+import threading
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db import models as m, transaction
+from django.dispatch import receiver
+
+from .. import settings
+from . import WeChatApp
+
+__all__ = ("expire_app", "expire_app_on_commit", "get_app")
+
+
+_apps = dict()
+"""{name: {(manager class, model): (version, app)}}"""
+_lock = threading.Lock()
+
+
+def _version_key(name):
+    return "wx:app:v:{0}".format(name)
+
+
+def get_app(app_queryset, name):
+    """按名称取得公众号,app_queryset为manager时从进程内缓存中取
+    :type app_queryset: wechat_django.models.app.WeChatAppManager
+    :rtype: wechat_django.models.WeChatApp
+    :raises: WeChatApp.DoesNotExist
+    """
+    if not settings.APPCACHE or not isinstance(app_queryset, m.Manager):
+        # 自定义的查询集合可能带有过滤条件 不缓存
+        return app_queryset.get_by_name(name)
+
+    version = None
+    if settings.APPCACHEVERSION:
+        version = cache.get(_version_key(name))
+        if version is None:
+            version = expire_app(name)
+
+    key = (type(app_queryset), app_queryset.model)
+    entry = _apps.get(name, {}).get(key)
+    if entry and entry[0] == version:
+        return entry[1]
+
+    # 先读版本号再读库,读取期间发生的变更会在下次请求时重新读取
+    app = app_queryset.get_by_name(name)
+    with _lock:
+        _apps.setdefault(name, {})[key] = (version, app)
+    return app
+
+
+def expire_app(name=None):
+    """使公众号缓存失效,不传name时清空本进程所有缓存"""
+    with _lock:
+        if name is None:
+            _apps.clear()
+            return
+        _apps.pop(name, None)
+    if settings.APPCACHEVERSION:
+        version = uuid4().hex
+        cache.set(_version_key(name), version, None)
+        return version
+
+
+def expire_app_on_commit(name):
+    expire_app(name)
+    # 事务提交前读取的是旧数据
+    transaction.on_commit(lambda: expire_app(name))
+
+
+@receiver(m.signals.post_save)
+@receiver(m.signals.post_delete)
+def app_changed(sender, instance, *args, **kwargs):
+    # 代理类的信号sender为代理类
+    if isinstance(instance, WeChatApp):
+        expire_app_on_commit(instance.name)
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+"""消息处理器匹配表
+
+将公众号下所有消息处理器及其规则编译为按消息类型及事件分组的匹配表,
+连同处理器的回复及预渲染的回复模板常驻进程内存,在消息处理器,规则,回复
+或素材变更时失效
+"""
+
+from __future__ import unicode_literals
+
+from collections import defaultdict
+import logging
+import re
+import threading
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db import models as m, transaction
+from django.dispatch import receiver
+from six import text_type
+
+from ..utils.ahocorasick import Automaton
+from . import Article, Material, MessageHandler, Reply, Rule
+from .rule import compile_pattern
+
+__all__ = ("expire_dispatcher", "get_dispatcher", "MessageDispatcher")
+
+
+class MessageDispatcher(object):
+    """编译后的消息处理器匹配表
+
+    ALL, MSGTYPE, EVENT, EVENTKEY, EQUAL规则以哈希表索引,CONTAIN规则编译为
+    一个Aho-Corasick自动机,可合并的REGEX规则编译为一个正则,其余规则按处理器
+    顺序保存于有序列表中逐条匹配.匹配结果与按处理器顺序逐个匹配一致
+    """
+
+    def __init__(self, handlers):
+        """
+        :param handlers: 按匹配优先级排列的处理器,须预取rules
+        """
+        self.handlers = list(handlers)
+        self._all = []
+        self._msg_types = defaultdict(list)
+        self._events = defaultdict(list)
+        self._event_keys = defaultdict(list)
+        self._equals = defaultdict(list)
+        self._contains = Automaton()
+        self._regexes = []
+        self._rules = []
+
+        for index, handler in enumerate(self.handlers):
+            for rule in handler.rules.all():
+                self._compile(index, rule)
+        self._contains.build()
+        self._regex = self._combine(self._regexes)
+
+    def match(self, message_info):
+        """
+        :type message_info: wechat_django.models.WeChatMessageInfo
+        :rtype: wechat_django.models.MessageHandler
+        """
+        message = message_info.message
+        candidates = set(self._all)
+        candidates.update(self._msg_types.get(message.type, ()))
+        if message.type == Rule.ReceiveMsgType.EVENT\
+            and (self._events or self._event_keys):
+            has_key = hasattr(message, "key")
+            for event in self._events_of(message):
+                candidates.update(self._events.get(event, ()))
+                if has_key:
+                    candidates.update(self._lookup(
+                        self._event_keys, (event, message.key)))
+        elif message.type == Rule.ReceiveMsgType.TEXT:
+            if self._equals:
+                candidates.update(
+                    self._lookup(self._equals, message.content))
+            if len(self._contains):
+                candidates.update(self._contains.iter(message.content))
+            if self._regex:
+                index = self._search(message.content)
+                if index is not None:
+                    candidates.add(index)
+
+        best = None
+        for index in sorted(candidates):
+            if self.handlers[index].available:
+                best = index
+                break
+
+        # 有序列表中只需匹配优先级高于当前结果的规则
+        for index, rule in self._rules:
+            if best is not None and index >= best:
+                break
+            if self.handlers[index].available and rule.match(message_info):
+                best = index
+                break
+
+        return None if best is None else self.handlers[best]
+
+    def _compile(self, index, rule):
+        content = rule.content
+        try:
+            if rule.type == Rule.Type.ALL:
+                self._all.append(index)
+            elif rule.type == Rule.Type.MSGTYPE:
+                self._msg_types[content["msg_type"]].append(index)
+            elif rule.type == Rule.Type.EVENT:
+                self._events[content["event"].lower()].append(index)
+            elif rule.type == Rule.Type.EVENTKEY:
+                key = (content["event"].lower(), content["key"])
+                self._event_keys[key].append(index)
+            elif rule.type == Rule.Type.EQUAL:
+                self._equals[content["pattern"]].append(index)
+            elif rule.type == Rule.Type.CONTAIN:
+                if not isinstance(content["pattern"], text_type):
+                    raise TypeError
+                self._contains.add(content["pattern"], index)
+            elif rule.type == Rule.Type.REGEX:
+                pattern = compile_pattern(content["pattern"])
+                if self._mergeable(pattern):
+                    self._regexes.append((index, pattern))
+                else:
+                    self._rules.append((index, rule))
+            elif rule.type == Rule.Type.CUSTOM:
+                self._rules.append((index, rule))
+        except re.error:
+            # 保存时已校验 仅历史数据可能出现
+            self.handlers[index].app.logger("handler").log(
+                logging.WARNING, "invalid regex rule %s" % rule.id,
+                exc_info=True)
+        except (AttributeError, KeyError, TypeError):
+            # 内容不完整的规则交由规则本身匹配
+            self._rules.append((index, rule))
+
+    def _search(self, content):
+        """匹配合并的正则,返回优先级最高的可用处理器下标"""
+        match = self._regex.match(content)
+        if not match:
+            return None
+        position = int(match.lastgroup[1:])
+        index = self._regexes[position][0]
+        if self.handlers[index].available:
+            return index
+        # 命中的处理器不可用 逐条匹配之后的规则
+        for index, pattern in self._regexes[position + 1:]:
+            if self.handlers[index].available and pattern.search(content):
+                return index
+        return None
+
+    @staticmethod
+    def _mergeable(pattern):
+        """合并后分组编号会改变,含引用,命名分组或全局标记的正则不合并"""
+        return not (pattern.groupindex
+                    or pattern.flags & ~re.UNICODE
+                    or _backreference.search(pattern.pattern))
+
+    @staticmethod
+    def _combine(regexes):
+        """
+        各规则置于锚定在开头的前瞻中,按优先级依次尝试,
+        首个成功的分支即为优先级最高的匹配规则
+        """
+        if not regexes:
+            return None
+        return re.compile("|".join(
+            r"(?=[\s\S]*?(?P<r{0}>{1}))".format(position, pattern.pattern)
+            for position, (_, pattern) in enumerate(regexes)
+        ))
+
+    @staticmethod
+    def _events_of(message):
+        event = message.event.lower()
+        if event == "subscribe_scan":
+            # wechatpy对eventtype进行了二次封装
+            return (event, MessageHandler.EventType.SUBSCRIBE)
+        return (event,)
+
+    @staticmethod
+    def _lookup(table, key):
+        try:
+            return table.get(key, ())
+        except TypeError:
+            return ()
+
+
+_backreference = re.compile(r"\\\d|\(\?P=|\(\?\(")
+
+_dispatchers = dict()
+_lock = threading.Lock()
+
+
+def _version_key(app_id):
+    return "wx:h:v:{0}".format(app_id)
+
+
+def get_dispatcher(app):
+    """取得公众号的匹配表,版本号存放于缓存中以保证多进程一致
+    :type app: wechat_django.models.WeChatApp
+    :rtype: wechat_django.models.dispatcher.MessageDispatcher
+    """
+    version = cache.get(_version_key(app.id))
+    if version is None:
+        version = expire_dispatcher(app.id)
+
+    entry = _dispatchers.get(app.id)
+    if entry and entry[0] == version:
+        return entry[1]
+
+    # 先读版本号再读库,构建期间发生的变更会在下次请求时重建
+    handlers = app.message_handlers.prefetch_related("rules", "replies").all()
+    dispatcher = MessageDispatcher(handlers)
+    with _lock:
+        _dispatchers[app.id] = (version, dispatcher)
+    return dispatcher
+
+
+def expire_dispatcher(app_id=None):
+    """使公众号的匹配表失效,不传app_id时清空本进程所有匹配表"""
+    with _lock:
+        if app_id is None:
+            _dispatchers.clear()
+            return
+        _dispatchers.pop(app_id, None)
+    version = uuid4().hex
+    cache.set(_version_key(app_id), version, None)
+    return version
+
+
+def _expire_on_commit(app_id):
+    if app_id is None:
+        return
+    expire_dispatcher(app_id)
+    # 事务提交前重建的匹配表读到的是旧数据
+    transaction.on_commit(lambda: expire_dispatcher(app_id))
+
+
+@receiver(m.signals.post_save, sender=MessageHandler)
+@receiver(m.signals.post_delete, sender=MessageHandler)
+def handler_changed(sender, instance, *args, **kwargs):
+    _expire_on_commit(instance.app_id)
+
+
+@receiver(m.signals.post_save, sender=Rule)
+@receiver(m.signals.post_delete, sender=Rule)
+@receiver(m.signals.post_save, sender=Reply)
+@receiver(m.signals.post_delete, sender=Reply)
+def rule_or_reply_changed(sender, instance, *args, **kwargs):
+    if sender.handler.is_cached(instance):
+        app_id = instance.handler.app_id
+    else:
+        app_id = (MessageHandler.objects.filter(pk=instance.handler_id)
+                  .values_list("app_id", flat=True).first())
+    _expire_on_commit(app_id)
+
+
+@receiver(m.signals.post_save, sender=Material)
+@receiver(m.signals.post_delete, sender=Material)
+def material_changed(sender, instance, *args, **kwargs):
+    # 图文回复的模板中含有素材内容
+    _expire_on_commit(instance.app_id)
+
+
+@receiver(m.signals.post_save, sender=Article)
+@receiver(m.signals.post_delete, sender=Article)
+def article_changed(sender, instance, *args, **kwargs):
+    if Article.material.is_cached(instance):
+        app_id = instance.material.app_id
+    else:
+        app_id = (Material.objects.filter(pk=instance.material_id)
+                  .values_list("app_id", flat=True).first())
+    _expire_on_commit(app_id)
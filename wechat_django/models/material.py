@@ -11,6 +11,7 @@ import requests
 from wechatpy.constants import WeChatErrorCode
 from wechatpy.exceptions import WeChatClientException
 
+from ..ratelimit import throttle
 from ..utils.model import enum2choices, model_fields
 from . import appmethod, WeChatApp, WeChatModel
 
@@ -110,20 +111,22 @@ class Material(WeChatModel):
                 type=type, media_id=id, **data)
         else:
             updated = []
-            for type, _ in enum2choices(cls.Type):
-                with transaction.atomic():
-                    updates = cls.sync_type(app, type)
-                    updated.extend(updates)
+            with throttle():
+                for type, _ in enum2choices(cls.Type):
+                    with transaction.atomic():
+                        updates = cls.sync_type(app, type)
+                        updated.extend(updates)
             return updated
 
     @appmethod("migrate_materials")
     def migrate(cls, app, src):
         migrated = []
-        for type, _ in enum2choices(cls.Type):
-            if type != cls.Type.NEWS:  # 不建议迁移图文 一天只能调10次
-                with transaction.atomic():
-                    migrates = app.migrate_type_materials(type, src)
-                    migrated.extend(migrates)
+        with throttle():
+            for type, _ in enum2choices(cls.Type):
+                if type != cls.Type.NEWS:  # 不建议迁移图文 一天只能调10次
+                    with transaction.atomic():
+                        migrates = app.migrate_type_materials(type, src)
+                        migrated.extend(migrates)
         return migrated
 
     @appmethod("sync_type_materials")
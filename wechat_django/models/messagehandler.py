@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from copy import copy
 import logging
 import random
 
@@ -9,7 +10,10 @@ from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from wechatpy.exceptions import WeChatClientException
 
+from .. import settings
 from ..exceptions import MessageHandleError
+from ..utils.aio import run_sync
+from ..utils.executor import SerialExecutor
 from ..utils.model import enum2choices
 from ..utils.web import get_ip
 from . import appmethod, MsgLogFlag, WeChatApp, WeChatModel
@@ -18,6 +22,8 @@ from . import appmethod, MsgLogFlag, WeChatApp, WeChatModel
 class MessageHandlerManager(m.Manager):
     def create_handler(self, rules=None, replies=None, **kwargs):
         """:rtype: wechat_django.models.MessageHandler"""
+        for rule in rules or ():
+            rule.validate()
         handler = self.create(**kwargs)
         if rules:
             for rule in rules:
@@ -27,6 +33,10 @@ class MessageHandlerManager(m.Manager):
             for reply in replies:
                 reply.handler = handler
             handler.replies.bulk_create(replies)
+        if rules:
+            # bulk_create不触发信号
+            from .dispatcher import expire_dispatcher
+            expire_dispatcher(handler.app_id)
         return handler
 
 
@@ -106,11 +116,15 @@ class MessageHandler(WeChatModel):
         """
         :type message_info: wechat_django.models.WeChatMessageInfo
         """
-        handlers = message_info.app.message_handlers\
-            .prefetch_related("rules").all()
-        for handler in handlers:
-            if handler.is_match(message_info):
-                return (handler, )
+        from .dispatcher import get_dispatcher
+
+        app = message_info.app
+        handler = get_dispatcher(app).match(message_info)
+        if handler:
+            # 匹配表中的处理器为进程共享,返回绑定当前app的副本
+            handler = copy(handler)
+            handler.app = app
+            return (handler, )
 
     def is_match(self, message_info):
         if self.available:
@@ -123,6 +137,22 @@ class MessageHandler(WeChatModel):
         :type message_info: wechat_django.models.WeChatMessageInfo
         :rtype: wechatpy.replies.BaseReply
         """
+        reply = self._pick_reply(message_info)
+        return reply and reply.reply(message_info)
+
+    async def reply_async(self, message_info):
+        """异步的被动回复
+        :type message_info: wechat_django.models.WeChatMessageInfo
+        :rtype: wechatpy.replies.BaseReply
+        """
+        reply = await run_sync(self._pick_reply, message_info)
+        return reply and await reply.reply_async(message_info)
+
+    def _pick_reply(self, message_info):
+        """按回复策略选出被动回复,回复全部时其余回复以客服消息发送,
+        开启WECHAT_MESSAGEREPLYALLINORDER时全部回复依次以客服消息发送
+        :rtype: wechat_django.models.Reply
+        """
         reply = ""
         if self.strategy == self.ReplyStrategy.NONE:
             pass
@@ -131,23 +161,39 @@ class MessageHandler(WeChatModel):
             if not replies:
                 pass
             elif self.strategy == self.ReplyStrategy.REPLYALL:
-                for reply in replies[:-1]:
-                    try:
-                        reply.send(message_info)
-                    except Exception as e:
-                        # 发送异常 继续处理其他程序
-                        log = self.handlerlog(message_info.request)
-                        msg = "an unexcepted error occurred when send msg"
-                        level = logging.WARNING\
-                            if isinstance(e, WeChatClientException)\
-                            else logging.ERROR
-                        log(level, msg, exc_info=True)
-                reply = replies[-1]
+                if len(replies) > 1:
+                    # 被动回复先于客服消息送达 需保持顺序时不被动回复
+                    in_order = settings.MESSAGEREPLYALLINORDER
+                    sends = replies if in_order else replies[:-1]
+                    # 客服消息在后台发送,不阻塞被动回复,同一用户的消息依次发送
+                    sender.submit(
+                        (self.app_id, message_info.openid),
+                        self._send_replies, message_info, sends)
+                    if not in_order:
+                        reply = replies[-1]
+                else:
+                    reply = replies[0]
             elif self.strategy == self.ReplyStrategy.RANDOM:
                 reply = random.choice(replies)
             else:
                 raise MessageHandleError("incorrect reply strategy")
-        return reply and reply.reply(message_info)
+        return reply
+
+    def _send_replies(self, message_info, replies):
+        """以客服消息依次发送回复"""
+        for reply in replies:
+            try:
+                reply.send(message_info)
+            except Exception as e:
+                log = self.handlerlog(message_info.request)
+                msg = "an unexcepted error occurred when send msg"
+                level = logging.WARNING\
+                    if isinstance(e, WeChatClientException)\
+                    else logging.ERROR
+                log(level, msg, exc_info=True)
+                if self.flags & self.Flag.TERMINALONEXCEPTION:
+                    # 中断其他回复
+                    break
 
     @appmethod("sync_message_handlers")
     def sync(cls, app):
@@ -252,3 +298,9 @@ class MessageHandler(WeChatModel):
 
     def __str__(self):
         return "{0}".format(self.name)
+
+
+sender = SerialExecutor(
+    settings.MESSAGESENDWORKERS, name="wechat-message-sender",
+    logger=logging.getLogger("wechat.handler"))
+"""后台发送回复全部策略中的客服消息"""
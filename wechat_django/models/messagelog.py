@@ -1,15 +1,28 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from datetime import datetime, time
+from functools import partial
+import gzip
+import json
+import logging
+import os
+import shutil
+import tempfile
+
 from django.core.serializers.json import DjangoJSONEncoder
-from django.db import models as m
+from django.db import models as m, transaction
+from django.db.models.functions import TruncDate
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.db.models import JSONField
 from wechatpy.events import BaseEvent
+from wechatpy.exceptions import WeChatClientException
 
+from .. import settings
 from ..utils.model import enum2choices
-from . import Rule, WeChatApp, WeChatModel, WeChatUser
+from ..utils.writer import BatchWriter
+from . import appmethod, Rule, WeChatApp, WeChatModel, WeChatUser
 
 
 class MessageLog(WeChatModel):
@@ -50,8 +63,22 @@ class MessageLog(WeChatModel):
             # message_info.raw
         )
 
+    @classmethod
+    def log_message_info(cls, message_info):
+        """将消息放入缓冲,由后台线程批量写入
+        :type message_info: wechat_django.models.WeChatMessageInfo
+        """
+        message = message_info.message
+        kwargs = cls._message_kwargs(message)
+        writer.put((message_info.app, message.source, kwargs))
+
     @classmethod
     def _from_message(cls, message, app, user, raw=""):
+        kwargs = cls._message_kwargs(message, raw)
+        return cls.objects.create(app=app, user=user, **kwargs)
+
+    @classmethod
+    def _message_kwargs(cls, message, raw=""):
         content = {
             key: getattr(message, key)
             for key in message._fields
@@ -62,8 +89,6 @@ class MessageLog(WeChatModel):
             content["event"] = message.event
 
         kwargs = dict(
-            app=app,
-            user=user,
             msg_id=message.id,
             type=message.type,
             content=content,
@@ -73,7 +98,36 @@ class MessageLog(WeChatModel):
         if message.time:
             kwargs["created_at"] = timezone.datetime.fromtimestamp(
                 message.time)
-        return cls.objects.create(**kwargs)
+        return kwargs
+
+    @classmethod
+    def _bulk_create(cls, records):
+        """
+        :param records: (app, openid, kwargs)组成的列表
+        """
+        users = dict()
+        apps = dict()
+        for app, openid, _ in records:
+            apps.setdefault(app.id, (app, set()))[1].add(openid)
+        for app, openids in apps.values():
+            for user in app.users.filter(openid__in=openids):
+                users[(app.id, user.openid)] = user
+            for openid in openids:
+                if (app.id, openid) in users:
+                    continue
+                try:
+                    users[(app.id, openid)] = app.user_by_openid(
+                        openid, ignore_errors=True)
+                except WeChatClientException:
+                    app.logger("handler").warning(
+                        "drop message logs of invalid user %s" % openid,
+                        exc_info=True)
+
+        return cls.objects.bulk_create(
+            cls(app=app, user=users[(app.id, openid)], **kwargs)
+            for app, openid, kwargs in records
+            if (app.id, openid) in users
+        )
 
     @classmethod
     def from_reply(cls, reply, app, user):
@@ -97,8 +151,157 @@ class MessageLog(WeChatModel):
                 reply.time)
         return cls.objects.create(**kwargs)
 
+    @appmethod("prune_message_logs")
+    def prune(cls, app, before, archive_dir=None, batch_size=1000):
+        """删除before日期(不含)之前的消息日志
+        :param archive_dir: 删除前按日归档为{archive_dir}/{appname}/{date}.jsonl.gz
+        :returns: 删除的日志数
+        """
+        queryset = (cls.objects.filter(app=app,
+                                       created_at__lt=_day_start(before))
+                    .order_by("created_at", "id"))
+        if archive_dir:
+            queryset = queryset.select_related("user")
+        count = 0
+        while True:
+            logs = list(queryset[:batch_size])
+            if not logs:
+                return count
+            archives = cls._archive(app, logs, archive_dir)\
+                if archive_dir else ()
+            try:
+                with transaction.atomic():
+                    cls.objects.filter(
+                        id__in=[log.id for log in logs]).delete()
+                    # 删除提交后才写入归档 回滚时不留下重复的日志
+                    for tmp, filename in archives:
+                        transaction.on_commit(
+                            partial(_commit_archive, tmp, filename))
+            except Exception:
+                for tmp, filename in archives:
+                    os.remove(tmp)
+                raise
+            count += len(logs)
+
+    @classmethod
+    def _archive(cls, app, logs, archive_dir):
+        """将日志按日写入归档目录下的临时文件
+        :returns: [(临时文件, 归档文件)]
+        """
+        days = dict()
+        for log in logs:
+            day = timezone.localtime(log.created_at).date()
+            days.setdefault(day, []).append(log)
+
+        path = os.path.join(archive_dir, app.name)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        rv = []
+        for day, day_logs in days.items():
+            filename = os.path.join(
+                path, "{0}.jsonl.gz".format(day.isoformat()))
+            fd, tmp = tempfile.mkstemp(
+                suffix=".tmp", prefix=os.path.basename(filename) + ".",
+                dir=path)
+            rv.append((tmp, filename))
+            with os.fdopen(fd, "wb") as fp, gzip.GzipFile(
+                    fileobj=fp, mode="wb") as f:
+                for log in day_logs:
+                    line = json.dumps(log.serialize(), cls=DjangoJSONEncoder,
+                                      ensure_ascii=False)
+                    f.write((line + "\n").encode("utf-8"))
+        return rv
+
+    def serialize(self):
+        return dict(
+            id=self.id,
+            msg_id=self.msg_id,
+            openid=self.user.openid,
+            type=self.type,
+            content=self.content,
+            direct=self.direct,
+            raw=self.raw,
+            created_at=self.created_at
+        )
+
     def __str__(self):
         return _("%(type)s消息: %(msg_id)s") % dict(
             type=self.type,
             msg_id=self.msg_id
         )
+
+
+def _commit_archive(tmp, filename):
+    """将临时文件并入归档,归档不存在时直接重命名"""
+    if not os.path.exists(filename):
+        os.rename(tmp, filename)
+        return
+    # 追加写入多个gzip member,读取时视为一个文件
+    with open(tmp, "rb") as src, open(filename, "ab") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(tmp)
+
+
+class MessageLogStat(WeChatModel):
+    """消息日志按日汇总"""
+    app = m.ForeignKey(
+        WeChatApp, related_name="message_log_stats", on_delete=m.CASCADE)
+
+    date = m.DateField(_("date"))
+    type = m.CharField(
+        _("message type"), max_length=24,
+        choices=enum2choices(Rule.ReceiveMsgType))
+    direct = m.BooleanField(_("direct"), default=MessageLog.Direct.USER2APP)
+    count = m.PositiveIntegerField(_("count"), default=0)
+
+    class Meta(object):
+        verbose_name = _("message statistic")
+        verbose_name_plural = _("message statistics")
+
+        unique_together = (("app", "date", "type", "direct"),)
+        ordering = ("app", "-date", "type")
+
+    @appmethod("rollup_message_logs")
+    def rollup(cls, app, since=None, until=None):
+        """按日汇总[since, until)的消息日志,重复汇总同一日结果不变
+        :param since: 默认从最后一次汇总的日期开始
+        :param until: 默认到今日(不含)
+        """
+        until = until or timezone.localdate()
+        if not since:
+            last = app.message_log_stats.order_by("-date").first()
+            since = last and last.date
+
+        queryset = MessageLog.objects.filter(
+            app=app, created_at__lt=_day_start(until))
+        if since:
+            queryset = queryset.filter(created_at__gte=_day_start(since))
+        rows = (queryset.order_by()
+                .annotate(date=TruncDate("created_at"))
+                .values("date", "type", "direct")
+                .annotate(count=m.Count("id")))
+
+        with transaction.atomic():
+            return [
+                cls.objects.update_or_create(
+                    app=app, date=row["date"], type=row["type"],
+                    direct=row["direct"], defaults=dict(count=row["count"])
+                )[0]
+                for row in rows
+            ]
+
+    def __str__(self):
+        return "{0} {1}: {2}".format(self.date, self.type, self.count)
+
+
+def _day_start(date):
+    return timezone.make_aware(datetime.combine(date, time.min))
+
+
+writer = BatchWriter(
+    MessageLog._bulk_create,
+    max_size=settings.MESSAGELOGBUFFERSIZE,
+    interval=settings.MESSAGELOGFLUSHINTERVAL,
+    logger=logging.getLogger("wechat.handler")
+)
+"""消息日志缓冲写入"""
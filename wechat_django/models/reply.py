@@ -1,18 +1,23 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import asyncio
 from copy import deepcopy
 
 from django.core.serializers.json import DjangoJSONEncoder
+from asgiref.sync import async_to_sync
 from django.db import models as m
-from django.utils.module_loading import import_string
 from django.utils.translation import gettext_lazy as _
 from django.db.models import JSONField
-import requests
+from django.utils.functional import cached_property
 from six import text_type
 from wechatpy import replies
+from wechatpy.utils import to_text
 
 from ..exceptions import MessageHandleError
+from ..forward import forward, forward_async
+from ..handler import get_program
+from ..utils.aio import run_sync
 from ..utils.model import enum2choices, model_fields
 from . import Material, MessageHandler, MsgType as BaseMsgType, WeChatModel
 
@@ -65,9 +70,11 @@ class Reply(WeChatModel):
         """主动回复
         :type message_info: wechat_django.models.WeChatMessageInfo
         """
-        reply = self.reply(message_info)
+        reply = self.reply(message_info.late_reply())
         funcname, kwargs = self.reply2send(reply)
-        func = funcname and getattr(self.app.client.message, funcname)
+        # 匹配表中的回复为进程共享,其handler.app可能已过期,使用消息的app
+        client = message_info.app.client
+        func = funcname and getattr(client.message, funcname)
         return func and func(**kwargs)
 
     def reply(self, message_info):
@@ -86,50 +93,114 @@ class Reply(WeChatModel):
             reply = self.normal_reply(message_info.message)
         return reply
 
+    async def reply_async(self, message_info):
+        """异步的被动回复,供AsyncHandler使用
+        :type message_info: wechat_django.models.WeChatMessageInfo
+        :rtype: wechatpy.replies.BaseReply
+        """
+        if self.type == self.MsgType.FORWARD:
+            reply = await self.reply_forward_async(message_info)
+        elif self.type == self.MsgType.CUSTOM:
+            reply = await self.reply_custom_async(message_info)
+        else:
+            if "template" not in self.__dict__:
+                # 图文回复需读取素材
+                await run_sync(lambda: self.template)
+            reply = self.normal_reply(message_info.message)
+        return reply
+
     def reply_forward(self, message_info):
         """
         :type message_info: wechat_django.models.WeChatMessageInfo
         """
-        resp = requests.post(
-            self.content["url"], message_info.raw,
-            params=message_info.request.GET, timeout=4.5)
-        resp.raise_for_status()
+        resp = forward(self._forward_urls, message_info.raw,
+                       params=message_info.request.GET,
+                       deadline=message_info.deadline)
+        return replies.deserialize_reply(resp.content)
+
+    async def reply_forward_async(self, message_info):
+        """
+        :type message_info: wechat_django.models.WeChatMessageInfo
+        """
+        resp = await forward_async(self._forward_urls, message_info.raw,
+                                   params=message_info.request.GET,
+                                   deadline=message_info.deadline)
         return replies.deserialize_reply(resp.content)
 
+    @property
+    def _forward_urls(self):
+        urls = self.content["url"]
+        if isinstance(urls, text_type):
+            urls = [urls]
+        return urls
+
     def reply_custom(self, message_info):
         """
         :type message_info: wechat_django.models.WeChatMessageInfo
         """
-        try:
-            func = import_string(self.content["program"])
-        except:
-            raise MessageHandleError("custom bussiness not found")
+        func = self._custom_program(message_info)
+        if asyncio.iscoroutinefunction(func):
+            reply = async_to_sync(func)(message_info)
         else:
-            appname = message_info.app.name
-            message = message_info.message
-            if not hasattr(func, "message_handler"):
-                e = "handler must be decorated by wechat_django.handler.message_handler"
-                raise MessageHandleError(e)
-            elif (hasattr(func.message_handler, "__contains__")
-                and appname not in func.message_handler):
-                e = "this handler cannot assigned to {0}".format(appname)
-                raise MessageHandleError(e)
             reply = func(message_info)
-            if not reply:
-                return ""
-            elif isinstance(reply, text_type):
-                reply = replies.TextReply(content=reply)
-            reply.source = message.target
-            reply.target = message.source
-            return reply
+        return self._custom_reply(message_info, reply)
+
+    async def reply_custom_async(self, message_info):
+        """
+        :type message_info: wechat_django.models.WeChatMessageInfo
+        """
+        func = self._custom_program(message_info)
+        if asyncio.iscoroutinefunction(func):
+            reply = await func(message_info)
+        else:
+            reply = await run_sync(func, message_info)
+        return self._custom_reply(message_info, reply)
+
+    def _custom_program(self, message_info):
+        func = get_program(self.content["program"])
+        if not func:
+            raise MessageHandleError("custom bussiness not found")
+        appname = message_info.app.name
+        if not hasattr(func, "message_handler"):
+            e = "handler must be decorated by wechat_django.handler.message_handler"
+            raise MessageHandleError(e)
+        elif (hasattr(func.message_handler, "__contains__")
+            and appname not in func.message_handler):
+            e = "this handler cannot assigned to {0}".format(appname)
+            raise MessageHandleError(e)
+        return func
+
+    def _custom_reply(self, message_info, reply):
+        message = message_info.message
+        if not reply:
+            return ""
+        elif isinstance(reply, text_type):
+            reply = replies.TextReply(content=reply)
+        reply.source = message.target
+        reply.target = message.source
+        return reply
 
     def normal_reply(self, message):
         """
         :type message: wechatpy.messages.BaseMessage
         """
+        template = self.template
+        data = dict(template.data)
+        if "articles" in data:
+            data["articles"] = list(data["articles"])
+        reply = template.klass(message=message, **data)
+        reply._template = template
+        return reply
+
+    @cached_property
+    def template(self):
+        """预渲染的静态回复,随匹配表中的回复一并缓存
+        :rtype: wechat_django.models.reply.ReplyTemplate
+        """
         if self.type == self.MsgType.NEWS:
             klass = replies.ArticlesReply
-            media = self.app.materials.get(media_id=self.content["media_id"])
+            media = Material.objects.get(
+                app_id=self.handler.app_id, media_id=self.content["media_id"])
             # 将media_id转为content
             data = dict(
                 articles=media.articles_json,
@@ -150,7 +221,11 @@ class Reply(WeChatModel):
         else:
             klass = replies.TextReply
             data = dict(content=self.content["content"])
-        return klass(message=message, **data)
+        return ReplyTemplate(klass, data)
+
+    def save(self, *args, **kwargs):
+        self.__dict__.pop("template", None)
+        return super(Reply, self).save(*args, **kwargs)
 
     @staticmethod
     def reply2send(reply):
@@ -256,3 +331,61 @@ class Reply(WeChatModel):
         if self.handler_id:
             return "{0} - {1}".format(self.handler.name, self.type)
         return "{0}".format(self.type)
+
+
+class PrerenderedReply(object):
+    """以预渲染的模板渲染的被动回复,回复内容被修改时按原方式渲染"""
+
+    _template = None
+
+    def render(self):
+        xml = self._template and self._template.render(self)
+        if xml is None:
+            xml = super(PrerenderedReply, self).render()
+        return xml
+
+
+class ReplyTemplate(object):
+    """静态回复预渲染为格式化模板,仅ToUserName,FromUserName及CreateTime
+    在回复时填入
+    """
+
+    _classes = dict()
+    _source = "\x00source\x00"
+    _target = "\x00target\x00"
+    _time = replies.BaseReply._fields["time"].to_xml(0)
+    _dynamic = ("FromUserName", "ToUserName", "CreateTime")
+
+    def __init__(self, klass, data):
+        if klass not in self._classes:
+            self._classes[klass] = type(
+                str(klass.__name__), (PrerenderedReply, klass), dict())
+        self.klass = self._classes[klass]
+        self.data = data
+
+        sample = klass(
+            source=self._source, target=self._target, time=0, **data)
+        self.static = self._static_data(sample)
+        xml = sample.render()
+        if xml.count(self._source) == xml.count(self._target)\
+            == xml.count(self._time) == 1:
+            self.template = (
+                xml.replace("{", "{{").replace("}", "}}")
+                .replace(self._source, "{source}")
+                .replace(self._target, "{target}")
+                .replace(self._time, self._time.replace("0", "{time}")))
+        else:
+            self.template = None
+
+    def render(self, reply):
+        """渲染回复,回复内容与模板不一致时返回None"""
+        if self.template is None or self._static_data(reply) != self.static:
+            return None
+        return self.template.format(
+            source=to_text(reply.source),
+            target=to_text(reply.target),
+            time=int(reply.time))
+
+    @classmethod
+    def _static_data(cls, reply):
+        return {k: v for k, v in reply._data.items() if k not in cls._dynamic}
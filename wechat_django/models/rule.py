@@ -1,18 +1,26 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from functools import lru_cache
 import re
 
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models as m
-from django.utils.module_loading import import_string
 from django.utils.translation import gettext_lazy as _
 from django.db.models import JSONField
 
+from .. import settings
+from ..handler import get_program
 from ..utils.model import enum2choices, model_fields
 from . import MessageHandler, MsgType, WeChatModel
 
 
+@lru_cache(maxsize=settings.MESSAGEREGEXCACHESIZE)
+def compile_pattern(pattern):
+    """编译正则规则,进程内以LRU缓存"""
+    return re.compile(pattern)
+
+
 class Rule(WeChatModel):
     class Type(object):
         MSGTYPE = "msg_type"  # 类型匹配
@@ -73,11 +81,8 @@ class Rule(WeChatModel):
         """
         :type message_info: wechat_django.models.WeChatMessageInfo
         """
-        try:
-            func = import_string(self.content["program"])
-        except ImportError:
-            pass
-        else:
+        func = get_program(self.content["program"])
+        if func:
             appname = message_info.app.name
             if not hasattr(func, "message_rule"):
                 return False
@@ -114,7 +119,8 @@ class Rule(WeChatModel):
                 and message.content == self.content["pattern"])
         elif self.type == self.Type.REGEX:
             return (message.type == self.ReceiveMsgType.TEXT
-                and re.search(self.content["pattern"], message.content))
+                and compile_pattern(self.content["pattern"])
+                    .search(message.content))
         return False
 
     def _event_match(self, message):
@@ -127,6 +133,20 @@ class Rule(WeChatModel):
         else:
             return event == target
 
+    def validate(self):
+        """
+        :raises: ValueError
+        """
+        if self.type == self.Type.REGEX:
+            try:
+                compile_pattern(self.content["pattern"])
+            except (KeyError, TypeError, re.error) as e:
+                raise ValueError("invalid regex pattern: {0}".format(e))
+
+    def save(self, *args, **kwargs):
+        self.validate()
+        return super(Rule, self).save(*args, **kwargs)
+
     @classmethod
     def from_mp(cls, data, handler=None):
         return cls(
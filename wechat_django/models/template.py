@@ -6,6 +6,7 @@ from django.utils.translation import gettext_lazy as _
 
 from ..constants import AppType
 from ..exceptions import WeChatAbilityError
+from ..ratelimit import throttle
 from ..utils.model import model_fields
 from . import appmethod, WeChatApp, WeChatModel
 
@@ -93,13 +94,15 @@ class Template(WeChatModel):
                 for k, v in kwargs.items()
             }
 
-        if self.app.type & AppType.SERVICEAPP:
-            return self._send_service(openid, data, url, appid, pagepath)
-        elif self.app.type & AppType.MINIPROGRAM:
-            return self._send_miniprogram(
-                openid, data, form_id, pagepath, emphasis_keyword)
-        else:
-            raise WeChatAbilityError(WeChatAbilityError.TEMPLATE)
+        # 群发模板消息时等待至限额恢复 每日调用量用尽时仍抛出异常
+        with throttle():
+            if self.app.type & AppType.SERVICEAPP:
+                return self._send_service(openid, data, url, appid, pagepath)
+            elif self.app.type & AppType.MINIPROGRAM:
+                return self._send_miniprogram(
+                    openid, data, form_id, pagepath, emphasis_keyword)
+            else:
+                raise WeChatAbilityError(WeChatAbilityError.TEMPLATE)
 
     def _send_service(
         self, openid, data, url=None, appid=None, pagepath=None):
@@ -1,17 +1,23 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import logging
 import re
+import time
 
+from django.core.cache import cache
 from django.db import models as m, transaction
 from django.utils import timezone as tz
 from django.utils.translation import gettext_lazy as _
-from django.utils.functional import cached_property
+from django.utils.functional import cached_property, SimpleLazyObject
 from wechatpy.constants import WeChatErrorCode
 from wechatpy.exceptions import WeChatClientException
 
+from .. import settings
+from ..ratelimit import throttle
 from ..utils.model import enum2choices, model_fields
 from ..utils.func import next_chunk
+from ..utils.writer import BatchWriter
 from . import appmethod, WeChatApp, WeChatModel
 
 
@@ -65,6 +71,7 @@ class WeChatUser(WeChatModel):
 
     subscribe = m.BooleanField(_("is subscribed"), null=True)
     subscribe_time = m.IntegerField(_("subscribe time"), null=True)
+    unsubscribe_time = m.IntegerField(_("unsubscribe time"), null=True)
     subscribe_scene = m.CharField(
         _("subscribe scene"), max_length=32, null=True,
         choices=enum2choices(SubscribeScene))
@@ -133,6 +140,112 @@ class WeChatUser(WeChatModel):
                 raise
         return app.users.create(openid=openid)
 
+    @appmethod
+    def lazy_user_by_openid(cls, app, openid):
+        """根据openid拿到惰性加载的用户对象,访问openid以外的属性时才从库中读取,
+        库中不存在的用户将先行创建,并在后台从服务器同步用户数据
+        :rtype: wechat_django.models.WeChatUser
+        """
+        return LazyWeChatUser(app, openid)
+
+    @classmethod
+    def _resolve_user(cls, app, openid):
+        user, created = app.users.get_or_create(openid=openid)
+        if created:
+            user_refresher.put((app, openid))
+        return user
+
+    @classmethod
+    def _refresh_users(cls, items):
+        """后台同步用户数据
+        :param items: (app, openid)组成的列表
+        """
+        apps = dict()
+        for app, openid in items:
+            apps.setdefault(app.id, (app, set()))[1].add(openid)
+        for app, openids in apps.values():
+            # 批量接口一次最多拉取100个用户
+            for chunk in next_chunk(openids):
+                try:
+                    cls.fetch_users(app, chunk)
+                except Exception:
+                    app.logger("api").warning(
+                        "refresh users failed: %s" % chunk, exc_info=True)
+
+    @appmethod
+    def subscribe_user(cls, app, openid, subscribe=True, event_time=None):
+        """记录用户关注或取关,关注状态在后台合并写入,以事件时间最后的为准
+        :param event_time: 关注或取关事件的CreateTime
+        :returns: 关注时返回是否首次关注
+        :rtype: bool
+        """
+        first_subscribe = None
+        if subscribe:
+            first_subscribe = cls._first_subscribe(app, openid)
+        event_time = event_time or int(time.time())
+        subscription_writer.put((app, openid, subscribe, event_time))
+        return first_subscribe
+
+    @classmethod
+    def _first_subscribe(cls, app, openid):
+        # 关注状态写入前以缓存标记关注过的用户 缓存失效时以库中数据为准
+        key = "wx:u:s:{0}:{1}".format(app.id, openid)
+        if not cache.add(key, 1, 86400):
+            return False
+        return not app.users.filter(
+            openid=openid, subscribe__isnull=False).exists()
+
+    @classmethod
+    def _write_subscriptions(cls, items):
+        """批量写入关注状态,各进程的批次写入顺序不定,以事件时间判断先后,
+        库中已记录更晚的关注或取关时不再覆盖
+        :param items: (app, openid, subscribe, event_time)组成的列表
+        """
+        apps = dict()
+        for app, openid, subscribe, event_time in items:
+            users = apps.setdefault(app.id, (app, dict()))[1]
+            # 本批次中最后的关注时间及取关时间
+            times = users.setdefault(openid, [None, None])
+            index = 0 if subscribe else 1
+            times[index] = max(times[index] or 0, event_time)
+
+        for app, users in apps.values():
+            with transaction.atomic():
+                existing = set(app.users.filter(
+                    openid__in=users.keys()).values_list("openid", flat=True))
+                created = [openid for openid in users if openid not in existing]
+                app.users.bulk_create([
+                    cls(app=app, openid=openid) for openid in created
+                ], ignore_conflicts=True)
+
+                subscribe_times = dict()
+                states = dict()
+                for openid, (subscribe_time, unsubscribe_time) in users.items():
+                    if subscribe_time:
+                        subscribe_times.setdefault(
+                            subscribe_time, []).append(openid)
+                    # 同一秒内的关注及取关以关注为准
+                    subscribe = (subscribe_time or 0) >= (unsubscribe_time or 0)
+                    event_time = subscribe_time if subscribe\
+                        else unsubscribe_time
+                    states.setdefault(
+                        (subscribe, event_time), []).append(openid)
+
+                for subscribe_time, openids in subscribe_times.items():
+                    app.users.filter(openid__in=openids).exclude(
+                        subscribe_time__gte=subscribe_time
+                    ).update(subscribe_time=subscribe_time)
+                for (subscribe, event_time), openids in states.items():
+                    fields = dict(subscribe=subscribe, updated_at=tz.now())
+                    if not subscribe:
+                        fields["unsubscribe_time"] = event_time
+                    app.users.filter(openid__in=openids).exclude(
+                        subscribe_time__gt=event_time).exclude(
+                        unsubscribe_time__gt=event_time).update(**fields)
+
+            for openid in created:
+                user_refresher.put((app, openid))
+
     @appmethod("sync_users")
     def sync(cls, app, all=False, detail=True):
         """
@@ -146,12 +259,14 @@ class WeChatUser(WeChatModel):
         users = []
         next_openid = not all and app.ext_info.get("last_openid") or None
 
-        iterator = app.client.user.iter_followers(next_openid)
-        for openids in next_chunk(iterator):
-            users.extend(cls.upsert_users(app, openids, detail))
-            # 更新最后更新openid
-            app.ext_info["last_openid"] = openids[-1]
-            app.save()
+        # 超出接口限额时等待而非中断同步
+        with throttle():
+            iterator = app.client.user.iter_followers(next_openid)
+            for openids in next_chunk(iterator):
+                users.extend(cls.upsert_users(app, openids, detail))
+                # 更新最后更新openid
+                app.ext_info["last_openid"] = openids[-1]
+                app.save()
         return users
 
     @appmethod
@@ -254,3 +369,35 @@ class WeChatUser(WeChatModel):
     def __str__(self):
         return "{nickname}({openid})".format(
             nickname=self.nickname or "", openid=self.openid)
+
+
+class LazyWeChatUser(SimpleLazyObject):
+    """只知道openid的用户,读取openid及app时不访问数据库"""
+
+    def __init__(self, app, openid):
+        super(LazyWeChatUser, self).__init__(
+            lambda: WeChatUser._resolve_user(app, openid))
+        self.__dict__["app"] = app
+        self.__dict__["openid"] = openid
+
+    def __setattr__(self, name, value):
+        # 关注事件中设置的首次关注标记不读取数据库
+        if name == "first_subscribe":
+            self.__dict__[name] = value
+        else:
+            super(LazyWeChatUser, self).__setattr__(name, value)
+
+
+user_refresher = BatchWriter(
+    WeChatUser._refresh_users,
+    max_size=settings.USERREFRESHBUFFERSIZE,
+    logger=logging.getLogger("wechat.api")
+)
+"""后台同步用户数据"""
+
+subscription_writer = BatchWriter(
+    WeChatUser._write_subscriptions,
+    max_size=settings.MESSAGESUBSCRIBEBUFFERSIZE,
+    logger=logging.getLogger("wechat.handler")
+)
+"""用户关注状态缓冲写入"""
@@ -5,6 +5,7 @@ from django.utils.http import urlencode
 from wechatpy import WeChatOAuth
 
 from wechat_django.constants import WeChatSNSScope
+from wechat_django.transport import get_session
 
 
 class WeChatOAuthClient(WeChatOAuth):
@@ -15,6 +16,7 @@ class WeChatOAuthClient(WeChatOAuth):
         if app.configurations.get("OAUTH_URL"):
             self.OAUTH_URL = app.configurations["OAUTH_URL"]
         super(WeChatOAuthClient, self).__init__(app.appid, app.appsecret, "")
+        self._http = get_session()
 
     def authorize_url(self, redirect_uri, scope=WeChatSNSScope.BASE, state=""):
         return self.OAUTH_URL + "?" + urlencode(dict(
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""微信推送消息解析
+
+微信推送的消息为一层平铺的xml,以ElementTree单次解析为字典后直接构建wechatpy的
+消息对象,省去xmltodict的逐节点回调.含嵌套节点,属性,重复节点或DTD的消息
+交由wechatpy解析,结果与wechatpy.parse_message一致
+"""
+
+from __future__ import unicode_literals
+
+import re
+from xml.etree import ElementTree
+
+import six
+from wechatpy import parse_message as _parse_message
+from wechatpy.events import EVENT_TYPES
+from wechatpy.messages import MESSAGE_TYPES, UnknownMessage
+from wechatpy.utils import to_binary
+
+__all__ = ("build_message", "parse_envelope", "parse_message")
+
+
+_declaration = re.compile(br"<!(?!\[CDATA\[)")
+
+
+def parse_envelope(xml):
+    """将平铺的消息xml解析为字典,无法按平铺结构解析时返回None
+    :rtype: dict
+    """
+    if not xml:
+        return None
+    xml = to_binary(xml)
+    if _declaration.search(xml):
+        # 不解析DTD及实体声明
+        return None
+    try:
+        root = ElementTree.fromstring(xml)
+    except ElementTree.ParseError:
+        return None
+    if root.tag != "xml":
+        return None
+
+    rv = dict()
+    for node in root:
+        if len(node) or node.attrib or node.tag in rv:
+            return None
+        # 与xmltodict一致 去除首尾空白 空节点为None
+        text = node.text and node.text.strip()
+        rv[node.tag] = text or None
+    return rv
+
+
+def parse_message(xml):
+    """解析微信推送的消息,与wechatpy.parse_message结果一致
+    :rtype: wechatpy.messages.BaseMessage
+    """
+    message = parse_envelope(xml)
+    if not message or not isinstance(message.get("MsgType"), six.text_type):
+        return _parse_message(xml)
+    return build_message(message)
+
+
+def build_message(message):
+    """根据消息字典构建wechatpy的消息对象,同wechatpy.parse_message
+    :type message: dict
+    :rtype: wechatpy.messages.BaseMessage
+    """
+    message_type = message["MsgType"].lower()
+    event_type = None
+    if message_type == "event" or message_type.startswith("device_"):
+        if message.get("Event"):
+            event_type = message["Event"].lower()
+        if event_type is None and message_type.startswith("device_"):
+            event_type = message_type
+        elif message_type.startswith("device_"):
+            event_type = "device_{event}".format(event=event_type)
+
+        if event_type == "subscribe" and message.get("EventKey"):
+            event_key = message["EventKey"]
+            if event_key.startswith(("scanbarcode|", "scanimage|")):
+                event_type = "subscribe_scan_product"
+                message["Event"] = event_type
+            elif event_key.startswith("qrscene_"):
+                # 扫码关注
+                event_type = "subscribe_scan"
+                message["Event"] = event_type
+                message["EventKey"] = event_key[len("qrscene_"):]
+        message_class = EVENT_TYPES.get(event_type, UnknownMessage)
+    else:
+        message_class = MESSAGE_TYPES.get(message_type, UnknownMessage)
+    return message_class(message)
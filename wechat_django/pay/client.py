@@ -51,6 +51,7 @@ class WeChatPayClient(_Pay):
         if pay.mch_app_id:
             kwargs["sub_appid"] = pay.sub_appid
 
+        # 双向证书请求不与其他商户共用连接 每个商户使用各自的requests.Session
         super(WeChatPayClient, self).__init__(**kwargs)
 
     def _request(self, method, url_or_endpoint, **kwargs):
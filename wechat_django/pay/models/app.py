@@ -2,11 +2,13 @@
 from __future__ import unicode_literals
 
 from django.db import models as m
+from django.dispatch import receiver
 from django.utils.functional import cached_property
 from django.utils.module_loading import import_string
 from django.utils.translation import gettext_lazy as _
 
 from wechat_django.models import WeChatApp
+from wechat_django.models.appcache import expire_app_on_commit
 from wechat_django.utils.func import Static
 
 
@@ -68,3 +70,16 @@ class WeChatPay(m.Model):
 
     def __str__(self):
         return "{0} ({1})".format(self.title, self.name)
+
+
+@receiver(m.signals.post_save, sender=WeChatPay)
+@receiver(m.signals.post_delete, sender=WeChatPay)
+def pay_changed(sender, instance, *args, **kwargs):
+    # 公众号缓存中带有商户号
+    if WeChatPay.app.is_cached(instance):
+        name = instance.app.name
+    else:
+        name = (WeChatApp.objects.filter(pk=instance.app_id)
+                .values_list("name", flat=True).first())
+    if name:
+        expire_app_on_commit(name)
@@ -6,10 +6,23 @@ import os
 import six
 from wechatpy import WeChatPay as WeChatPayBaseClient
 
+from wechat_django.sites.wechat import WeChatInfo
 from .base import mock, WeChatPayTestCase
 
 
 class PayTestCase(WeChatPayTestCase):
+    def test_app_cache(self):
+        """测试商户号变更后公众号缓存失效"""
+        app = WeChatInfo(_appname=self.app.name).app
+        self.assertIs(WeChatInfo(_appname=self.app.name).app, app)
+
+        pay = self.app.pay
+        pay.title = "changed"
+        pay.save()
+        another = WeChatInfo(_appname=self.app.name).app
+        self.assertIsNot(another, app)
+        self.assertEqual(another.pay.title, "changed")
+
     def test_client_init(self):
         """测试WeChatPayClient的构建"""
         pay = self.app.pay
@@ -39,6 +52,14 @@ class PayTestCase(WeChatPayTestCase):
                     sub_mch_id=sub_mch_id
                 ))
 
+    def test_client_session(self):
+        """测试商户不共用连接池"""
+        from wechat_django.transport import get_session
+
+        pay_session = self.app.pay.client._http
+        self.assertIsNot(pay_session, get_session())
+        self.assertIsNot(pay_session, self.app_sub.pay.client._http)
+
     def test_client_cert(self):
         """测试请求时证书是否正确使用"""
         pay = self.app_nocert.pay
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+"""微信接口调用的限流及每日调用量统计
+
+在公众号的configurations["RATELIMITS"]中按接口配置每秒调用数(rate),突发数
+(burst,默认同rate)及每日调用量(daily),接口以路径或其结尾部分表示
+
+    app.configurations["RATELIMITS"] = {
+        "user/info/batchget": {"rate": 10, "burst": 20},
+        "message/custom/send": {"rate": 50, "daily": 500000}
+    }
+
+计数记录于django cache,多个worker共享限额.超出限额的调用等待至多
+WECHAT_CLIENTRATELIMITWAIT秒,批量任务在throttle()中等待至限额恢复;
+每日调用量用尽时抛出APILimitedException
+"""
+
+from __future__ import unicode_literals
+
+from collections import Counter
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+from django.core.cache import cache
+from django.utils import timezone
+from wechatpy.exceptions import APILimitedException
+
+from . import settings
+from .utils.writer import BatchWriter
+
+__all__ = ("acquire", "daily_usage", "get_limit", "RateLimit", "throttle")
+
+
+class RateLimit(object):
+    """
+    :param rate: 每秒调用数,为0时不限制速率
+    :param burst: 突发调用数,默认同rate
+    :param daily: 每日调用量,为0时不限制
+    """
+
+    def __init__(self, rate=0, burst=None, daily=0):
+        self.rate = rate
+        self.burst = burst or rate
+        self.daily = daily
+
+    @property
+    def window(self):
+        """以burst/rate秒为窗口,每个窗口至多调用burst次"""
+        return float(self.burst) / self.rate
+
+
+def get_limit(app, endpoint):
+    """公众号接口的限额,未配置时返回None
+
+    :type app: wechat_django.models.WeChatApp
+    :rtype: wechat_django.ratelimit.RateLimit
+    """
+    for key, conf in (app.configurations.get("RATELIMITS") or {}).items():
+        key = "/" + key.strip("/")
+        if endpoint == key or endpoint.endswith(key):
+            return RateLimit(**conf)
+
+
+_local = threading.local()
+
+
+@contextmanager
+def throttle():
+    """批量任务中超出速率限额的调用等待至限额恢复,而非等待超时后失败
+
+        with throttle():
+            for openids in chunks:
+                app.client.user.get_batch(openids)
+    """
+    throttled = getattr(_local, "throttled", False)
+    _local.throttled = True
+    try:
+        yield
+    finally:
+        _local.throttled = throttled
+
+
+def acquire(app, endpoint, limit):
+    """取得一次调用的限额,记录每日调用量
+
+    :type app: wechat_django.models.WeChatApp
+    :type limit: wechat_django.ratelimit.RateLimit
+    :raises: wechatpy.exceptions.APILimitedException
+    """
+    if limit and limit.rate:
+        deadline = None if getattr(_local, "throttled", False)\
+            else time.time() + settings.CLIENTRATELIMITWAIT
+        while True:
+            wait = _acquire_window(app.name, endpoint, limit)
+            if not wait:
+                break
+            if deadline is not None and time.time() + wait > deadline:
+                raise APILimitedException(
+                    45011, "rate limit exceeded: " + endpoint)
+            time.sleep(wait)
+
+    if limit and limit.daily:
+        key = _usage_key(app.name, endpoint, timezone.localdate())
+        _index(app.name, endpoint)
+        if _incr(key, 1, 2 * 86400) > limit.daily:
+            cache.decr(key)
+            raise APILimitedException(
+                45009, "daily quota exceeded: " + endpoint)
+    else:
+        usage_writer.put((app.name, endpoint, timezone.localdate()))
+
+
+def daily_usage(app, date=None):
+    """公众号各接口当日调用量
+
+        {"/cgi-bin/message/custom/send": 120}
+    """
+    date = date or timezone.localdate()
+    endpoints = cache.get(_index_key(app.name, date)) or []
+    usages = cache.get_many(
+        [_usage_key(app.name, endpoint, date) for endpoint in endpoints])
+    return {
+        endpoint: usages.get(_usage_key(app.name, endpoint, date), 0)
+        for endpoint in endpoints
+    }
+
+
+def _acquire_window(appname, endpoint, limit):
+    """返回需等待的秒数,0为已取得
+
+    django cache只提供原子的add及incr,以固定窗口近似令牌桶
+    """
+    now = time.time()
+    slot = int(now // limit.window)
+    key = "wx:rl:{0}:{1}:{2}".format(appname, endpoint, slot)
+    if _incr(key, 1, int(limit.window) + 1) <= limit.burst:
+        return 0
+    return (slot + 1) * limit.window - now
+
+
+def _incr(key, delta, timeout):
+    cache.add(key, 0, timeout)
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # 计数在add与incr之间过期
+        cache.add(key, delta, timeout)
+        return delta
+
+
+def _usage_key(appname, endpoint, date):
+    return "wx:q:{0}:{1}:{2:%Y%m%d}".format(appname, endpoint, date)
+
+
+def _index_key(appname, date):
+    return "wx:q:{0}:{1:%Y%m%d}".format(appname, date)
+
+
+_indexed = dict()
+
+
+def _index(appname, endpoint, date=None):
+    """记录公众号当日调用过的接口"""
+    date = date or timezone.localdate()
+    indexed = _indexed.get(date)
+    if indexed is None:
+        # 只保留当日已记录的接口
+        _indexed.clear()
+        indexed = _indexed[date] = set()
+    if (appname, endpoint) in indexed:
+        return
+    key = _index_key(appname, date)
+    endpoints = cache.get(key) or []
+    if endpoint not in endpoints:
+        # 非原子操作 并发时遗漏的接口在之后的写入中补上
+        cache.set(key, endpoints + [endpoint], 2 * 86400)
+    else:
+        indexed.add((appname, endpoint))
+
+
+def _write_usages(items):
+    for (appname, endpoint, date), count in Counter(items).items():
+        _index(appname, endpoint, date)
+        _incr(_usage_key(appname, endpoint, date), count, 2 * 86400)
+
+
+usage_writer = BatchWriter(
+    _write_usages,
+    max_size=settings.CLIENTUSAGEBUFFERSIZE,
+    logger=logging.getLogger("wechat.api")
+)
+"""未限制每日调用量接口的调用量缓冲写入"""
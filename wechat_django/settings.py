@@ -11,6 +11,82 @@ PATCHADMINSITE = getattr(settings, "WECHAT_PATCHADMINSITE", True)
 SESSIONSTORAGE = getattr(
     settings, "WECHAT_SESSIONSTORAGE", "django.core.cache.cache")
 
+APPCACHE = getattr(settings, "WECHAT_APPCACHE", True)
+
+APPCACHEVERSION = getattr(settings, "WECHAT_APPCACHEVERSION", True)
+
+CLIENTMAXCONNECTIONS = getattr(settings, "WECHAT_CLIENTMAXCONNECTIONS", 10)
+
+CLIENTHOSTMAXCONNECTIONS = getattr(
+    settings, "WECHAT_CLIENTHOSTMAXCONNECTIONS", {})
+
+CLIENTPOOLCONNECTIONS = getattr(settings, "WECHAT_CLIENTPOOLCONNECTIONS", 10)
+
+CLIENTPOOLTIMEOUT = getattr(settings, "WECHAT_CLIENTPOOLTIMEOUT", 10)
+
+CLIENTRETRIES = getattr(settings, "WECHAT_CLIENTRETRIES", 2)
+
+CLIENTTOKENREFRESHAHEAD = getattr(
+    settings, "WECHAT_CLIENTTOKENREFRESHAHEAD", 300)
+
+CLIENTTOKENREFRESHINTERVAL = getattr(
+    settings, "WECHAT_CLIENTTOKENREFRESHINTERVAL", 60)
+
+CLIENTTOKENLOCKTIMEOUT = getattr(settings, "WECHAT_CLIENTTOKENLOCKTIMEOUT", 10)
+
+CLIENTFREQRETRIES = getattr(settings, "WECHAT_CLIENTFREQRETRIES", 2)
+
+CLIENTFREQBACKOFF = getattr(settings, "WECHAT_CLIENTFREQBACKOFF", 0.5)
+
+CLIENTBREAKERTHRESHOLD = getattr(settings, "WECHAT_CLIENTBREAKERTHRESHOLD", 5)
+
+CLIENTBREAKERCOOLDOWN = getattr(settings, "WECHAT_CLIENTBREAKERCOOLDOWN", 60)
+
+CLIENTRATELIMITWAIT = getattr(settings, "WECHAT_CLIENTRATELIMITWAIT", 5)
+
+CLIENTUSAGEBUFFERSIZE = getattr(settings, "WECHAT_CLIENTUSAGEBUFFERSIZE", 100)
+
 MESSAGETIMEOFFSET = getattr(settings, "WECHAT_MESSAGETIMEOFFSET", 180)
 
 MESSAGENOREPEATNONCE = getattr(settings, "WECHAT_MESSAGENOREPEATNONCE", True)
+
+MESSAGEDEADLINE = getattr(settings, "WECHAT_MESSAGEDEADLINE", 4.5)
+
+MESSAGEFORWARDMAXCONNECTIONS = getattr(
+    settings, "WECHAT_MESSAGEFORWARDMAXCONNECTIONS", 10)
+
+MESSAGEFORWARDWORKERS = getattr(settings, "WECHAT_MESSAGEFORWARDWORKERS", 8)
+
+MESSAGEASYNCWORKERS = getattr(settings, "WECHAT_MESSAGEASYNCWORKERS", 8)
+
+MESSAGEREPLYTIMEOUT = getattr(settings, "WECHAT_MESSAGEREPLYTIMEOUT", 0)
+
+MESSAGEREPLYWORKERS = getattr(settings, "WECHAT_MESSAGEREPLYWORKERS", 10)
+
+MESSAGELATEREPLYDEADLINE = getattr(
+    settings, "WECHAT_MESSAGELATEREPLYDEADLINE", 30)
+
+MESSAGEREPLYWAITTIMEOUT = getattr(
+    settings, "WECHAT_MESSAGEREPLYWAITTIMEOUT", 4)
+
+MESSAGEREGEXCACHESIZE = getattr(settings, "WECHAT_MESSAGEREGEXCACHESIZE", 1024)
+
+MESSAGESENDWORKERS = getattr(settings, "WECHAT_MESSAGESENDWORKERS", 4)
+
+MESSAGEREPLYALLINORDER = getattr(
+    settings, "WECHAT_MESSAGEREPLYALLINORDER", False)
+
+MESSAGESUBSCRIBEBUFFERSIZE = getattr(
+    settings, "WECHAT_MESSAGESUBSCRIBEBUFFERSIZE", 100)
+
+MESSAGETIMING = getattr(settings, "WECHAT_MESSAGETIMING", False)
+
+MESSAGETIMINGSINKS = getattr(
+    settings, "WECHAT_MESSAGETIMINGSINKS", ("wechat_django.timing.registry",))
+
+MESSAGELOGBUFFERSIZE = getattr(settings, "WECHAT_MESSAGELOGBUFFERSIZE", 100)
+
+USERREFRESHBUFFERSIZE = getattr(settings, "WECHAT_USERREFRESHBUFFERSIZE", 100)
+
+MESSAGELOGFLUSHINTERVAL = getattr(
+    settings, "WECHAT_MESSAGELOGFLUSHINTERVAL", 1)
@@ -4,11 +4,14 @@ from __future__ import unicode_literals
 from django.dispatch import Signal
 
 
-message_received = Signal(["message_info"])
+message_received = Signal(["message_info", "timing"])
 """收到微信推送消息"""
 
-message_handled = Signal(["message_info", "reply"])
+message_handled = Signal(["message_info", "reply", "timing"])
 """微信推送消息处理成功(不包括成功)"""
 
 message_error = Signal(["message_info", "exc"])
 """微信推送消息处理异常"""
+
+message_timed = Signal(["message_info", "timing"])
+"""微信推送消息处理完成,携带各阶段耗时,需开启WECHAT_MESSAGETIMING"""
@@ -19,8 +19,10 @@ class WeChatInfo(object):
         :rtype: wechat_django.models.WeChatApp
         """
         if not hasattr(self, "_app"):
+            from wechat_django.models.appcache import get_app
+
             try:
-                self._app = self.app_queryset.get_by_name(self.appname)
+                self._app = get_app(self.app_queryset, self.appname)
             except self.app_queryset.model.DoesNotExist:
                 raise Http404()
         return self._app
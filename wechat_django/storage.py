@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""两级SessionStorage
+
+在共享缓存(django cache,redis等)前加一层进程内缓存,accesstoken,jsapi ticket
+及第三方平台component token等在进程内缓存至多max_age秒,且不超过其剩余有效期,
+省去每次调用微信接口前对共享缓存的访问
+
+    WECHAT_SESSIONSTORAGE = "wechat_django.storage.two_tier_storage"
+
+使用其他共享缓存时,自行创建实例并配置其路径
+
+    two_tier_redis = TwoTierStorage(RedisStorage(redis))
+"""
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import threading
+import time
+
+from django.core.cache import cache
+from wechatpy.session import SessionStorage
+
+__all__ = ("TwoTierStorage", "two_tier_storage")
+
+
+class TwoTierStorage(SessionStorage):
+    """进程内缓存+共享缓存的SessionStorage
+
+    :param shared: 共享的SessionStorage或django cache,默认为django cache
+    :param max_age: 进程内缓存秒数,其他进程写入的值至多延迟该时间可见
+    :param max_size: 进程内缓存数量上限
+    """
+
+    def __init__(self, shared=None, max_age=30, max_size=1000):
+        self.shared = cache if shared is None else shared
+        self.max_age = max_age
+        self.max_size = max_size
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            item = self._local.get(key)
+            if item and item[1] > now:
+                return item[0]
+        value = self.shared.get(key)
+        if value is None:
+            self.invalidate(key)
+            return default
+        self._cache(key, value, now + self.max_age)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.shared.set(key, value, ttl)
+        max_age = min(self.max_age, ttl) if ttl else self.max_age
+        self._cache(key, value, time.time() + max_age)
+
+    def delete(self, key):
+        self.shared.delete(key)
+        self.invalidate(key)
+
+    def invalidate(self, *keys):
+        """只清除进程内缓存,如接口返回accesstoken失效时"""
+        with self._lock:
+            for key in keys:
+                self._local.pop(key, None)
+
+    def clear(self):
+        """清除所有进程内缓存"""
+        with self._lock:
+            self._local.clear()
+
+    def _cache(self, key, value, expires):
+        with self._lock:
+            # 不超过值记录于{key}_expires_at的剩余有效期
+            expires_at = self._local.get(key + "_expires_at")
+            if expires_at and isinstance(expires_at[0], (int, float)):
+                expires = min(expires, expires_at[0])
+            self._local.pop(key, None)
+            self._local[key] = (value, expires)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+
+
+two_tier_storage = TwoTierStorage()
+"""以django cache为共享缓存的两级SessionStorage"""
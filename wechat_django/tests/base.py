@@ -8,6 +8,7 @@ try:
 except ImportError:
     import mock
 
+from django.core.cache import cache
 from django.test import RequestFactory, TestCase
 
 from ..constants import AppType
@@ -53,6 +54,8 @@ class WeChatTestCase(WeChatTestCaseBase):
             type=AppType.MINIPROGRAM)
 
     def setUp(self):
+        # 测试间数据库回滚 清理进程及缓存中与数据库相关的数据
+        cache.clear()
         self.app = WeChatApp.objects.get_by_name("test")
         self.another_app = WeChatApp.objects.get_by_name("test1")
         self.miniprogram = WeChatApp.objects.get_by_name("miniprogram")
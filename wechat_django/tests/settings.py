@@ -70,3 +70,9 @@ ROOT_URLCONF = "wechat_django.tests.urls"
 logging.disable(logging.CRITICAL)
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+# 缓冲写入在当前线程同步进行 避免后台线程与测试的数据库事务及清理交错
+WECHAT_CLIENTUSAGEBUFFERSIZE = 0
+WECHAT_MESSAGELOGBUFFERSIZE = 0
+WECHAT_MESSAGESUBSCRIBEBUFFERSIZE = 0
+WECHAT_USERREFRESHBUFFERSIZE = 0
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import CommandError
+from django.urls import reverse
+from django.utils.http import urlencode
+from wechatpy.replies import deserialize_reply
+
+from .. import settings
+from ..management.commands.loadtest import Command, MessageFactory
+from ..models import MessageHandler, Reply, Rule, WeChatApp
+from ..parser import parse_envelope
+from .base import WeChatTestCase
+
+
+class LoadTestCommandTestCase(WeChatTestCase):
+    def setUp(self):
+        super(LoadTestCommandTestCase, self).setUp()
+        MessageHandler.objects.create_handler(
+            app=self.app,
+            rules=[Rule(type=Rule.Type.EQUAL, pattern="abc")],
+            replies=[Reply(type=Reply.MsgType.TEXT, content="text")])
+        MessageHandler.objects.create_handler(
+            app=self.app,
+            rules=[Rule(type=Rule.Type.EVENTKEY,
+                        event=MessageHandler.EventType.CLICK, key="menu")],
+            replies=[Reply(type=Reply.MsgType.TEXT, content="click")])
+        self._nonce = settings.MESSAGENOREPEATNONCE
+        settings.MESSAGENOREPEATNONCE = True
+
+    def tearDown(self):
+        settings.MESSAGENOREPEATNONCE = self._nonce
+        super(LoadTestCommandTestCase, self).tearDown()
+
+    def test_messages(self):
+        """生成的明文及加密消息可被Handler处理,重试的消息原样重发"""
+        command = Command()
+        self.assertEqual(command.get_keywords(self.app), ["abc"])
+        self.assertEqual(command.get_menu_keys(self.app), ["menu"])
+        self.assertEqual(command.parse_mix("text=3,retry=1,click=0"),
+                         dict(text=3, retry=1))
+        self.assertRaises(CommandError, command.parse_mix, "foo=1")
+        self.assertRaises(CommandError, command.parse_mix, "text")
+
+        for seed, encoding_mode in enumerate((WeChatApp.EncodingMode.PLAIN,
+                                              WeChatApp.EncodingMode.SAFE)):
+            self.app.encoding_mode = encoding_mode
+            self.app.encoding_aes_key = "a" * 43
+            self.app.save()
+            app = WeChatApp.objects.get_by_name(self.app.name)
+            factory = MessageFactory(app, ["abc"], ["menu"], seed=seed)
+            replies = dict()
+            for kind, content in (("text", "text"), ("click", "click")):
+                query, body = factory.build(kind)
+                self.assertEqual("msg_signature" in query, bool(app.crypto))
+                resp = self.post(query, body)
+                self.assertEqual(resp.status_code, 200)
+                replies[query["nonce"]] = resp.content
+                self.assertEqual(self.reply(app, resp, query).content,
+                                 content)
+
+            # 原样重发的消息由防重放处理 返回首次处理的回复
+            query, body = factory.build("retry")
+            resp = self.post(query, body)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.content, replies[query["nonce"]])
+
+    def test_stub(self):
+        """桩服务期间公众号接口指向桩服务,结束后还原配置"""
+        command = Command()
+        self.app.client.session.set(self.app.client.access_token_key, "real")
+        server = command.start_stub(self.app, "127.0.0.1:0")
+        try:
+            app = WeChatApp.objects.get_by_name(self.app.name)
+            self.assertTrue(app.configurations["API_BASE_URL"].startswith(
+                "http://127.0.0.1:"))
+            self.assertEqual(app.client.API_BASE_URL,
+                             app.configurations["API_BASE_URL"])
+            self.assertEqual(app.client.access_token, "loadtest")
+            data = app.client.user.get_batch(["openid"])
+            self.assertEqual(data[0]["openid"], "openid")
+            self.assertEqual(app.client.menu.delete()["errcode"], 0)
+            stub_key = app.client.access_token_key
+        finally:
+            command.stop_stub(self.app, server)
+        app = WeChatApp.objects.get_by_name(self.app.name)
+        self.assertNotIn("API_BASE_URL", app.configurations)
+        self.assertNotIn("LOADTEST_STUB", app.configurations)
+        # 桩服务的accesstoken不覆盖真实的accesstoken 结束后清除
+        self.assertEqual(app.client.access_token, "real")
+        self.assertIsNone(app.client.session.get(stub_key))
+
+    def test_interrupted_stub(self):
+        """进程被强行终止未还原的配置在下次压测前还原"""
+        self.app.configurations["API_BASE_URL"] = "http://proxy/cgi-bin/"
+        self.app.save()
+        command = Command()
+        server = command.start_stub(self.app, "127.0.0.1:0")
+        server.shutdown()
+        server.server_close()
+
+        app = WeChatApp.objects.get_by_name(self.app.name)
+        self.assertTrue(command.restore_stub(app))
+        app = WeChatApp.objects.get_by_name(self.app.name)
+        self.assertEqual(app.configurations["API_BASE_URL"],
+                         "http://proxy/cgi-bin/")
+        self.assertNotIn("ACCESSTOKEN_URL", app.configurations)
+        self.assertNotIn("ACCESSTOKEN_KEY", app.configurations)
+        self.assertFalse(command.restore_stub(app))
+
+    def post(self, query, body):
+        url = reverse("wechat_django:handler",
+                      kwargs=dict(appname=self.app.name))
+        return self.client.generic("POST", url + "?" + urlencode(query),
+                                   body, content_type="text/xml")
+
+    def reply(self, app, resp, query):
+        xml = resp.content
+        if app.crypto:
+            envelope = parse_envelope(xml)
+            xml = app.crypto.decrypt_message(
+                xml, envelope["MsgSignature"], envelope["TimeStamp"],
+                envelope["Nonce"])
+        return deserialize_reply(xml)
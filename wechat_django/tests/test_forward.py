@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+from asgiref.sync import async_to_sync
+from httmock import response
+from requests.exceptions import HTTPError, Timeout
+
+from .. import forward as forward_module
+from ..forward import forward, forward_async, forward_stats, get_upstream
+from .base import mock, WeChatTestCase
+from .interceptors import common_interceptor
+
+
+class ForwardTestCase(WeChatTestCase):
+    def setUp(self):
+        super(ForwardTestCase, self).setUp()
+        self.upstreams = mock.patch.dict(forward_module._upstreams, clear=True)
+        self.upstreams.start()
+
+    def tearDown(self):
+        self.upstreams.stop()
+        super(ForwardTestCase, self).tearDown()
+
+    def test_forward(self):
+        """测试转发"""
+        def callback(url, request):
+            if url.netloc == "bad.example.com":
+                return response(500)
+            # 失败的转发先行返回
+            time.sleep(0.05)
+            return response(content=url.netloc)
+
+        good = "http://good.example.com/debug"
+        bad = "http://bad.example.com/debug"
+        with common_interceptor(callback):
+            resp = forward([good], "xml", deadline=time.time() + 1)
+            self.assertEqual(resp.content, b"good.example.com")
+            # 同一host共用连接池
+            self.assertIs(get_upstream(good), get_upstream(good + "?a=1"))
+
+            self.assertRaises(HTTPError, forward, [bad], "xml")
+            # 多个转发目标时取首个成功的响应
+            resp = forward([bad, good], "xml")
+            self.assertEqual(resp.content, b"good.example.com")
+            self.assertRaises(HTTPError, forward, [bad, bad], "xml")
+
+            # 异步转发
+            forward_sync = async_to_sync(forward_async)
+            resp = forward_sync([good], "xml", deadline=time.time() + 1)
+            self.assertEqual(resp.content, b"good.example.com")
+            resp = forward_sync([bad, good], "xml")
+            self.assertEqual(resp.content, b"good.example.com")
+            self.assertRaises(HTTPError, forward_sync, [bad], "xml")
+
+        stats = forward_stats()
+        self.assertEqual(stats["good.example.com"]["count"], 4)
+        self.assertEqual(stats["good.example.com"]["errors"], 0)
+        self.assertEqual(sum(stats["good.example.com"]["buckets"].values()),
+                         4)
+        self.assertEqual(stats["bad.example.com"]["count"], 6)
+        self.assertEqual(stats["bad.example.com"]["errors"], 6)
+
+    def test_deadline(self):
+        """测试以剩余时间为超时时间"""
+        url = "http://example.com/debug"
+        deadline = time.time() + 2
+        upstream = get_upstream(url)
+        with mock.patch.object(upstream.session, "post") as post:
+            post.return_value = mock.MagicMock()
+            forward([url], "xml", deadline=deadline)
+            timeout = post.call_args[1]["timeout"]
+            self.assertTrue(0 < timeout <= 2)
+
+        # 并发连接数超出上限时等待至截止时间
+        for _ in range(forward_module.settings.MESSAGEFORWARDMAXCONNECTIONS):
+            upstream._semaphore.acquire()
+        self.assertRaises(Timeout, forward, [url], "xml",
+                          deadline=time.time() + 0.05)
+
+    def test_fork(self):
+        """测试fork后的子进程重新创建转发及回复线程池"""
+        from .. import handler as handler_module
+
+        for get_pool in (forward_module._get_executor,
+                         handler_module._get_replier):
+            pool = get_pool()
+            self.assertIs(get_pool(), pool)
+            pid = forward_module.os.getpid() + 1
+            with mock.patch("os.getpid", return_value=pid):
+                child_pool = get_pool()
+                self.assertIsNot(child_pool, pool)
+                self.assertIs(get_pool(), child_pool)
+            # 恢复为当前进程的线程池
+            self.assertIsNot(get_pool(), child_pool)
@@ -1,13 +1,23 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import threading
+import time
+
+from django.core.cache import cache
 from django.test import override_settings
 from django.urls import reverse
+from httmock import HTTMock, response, urlmatch
+from six.moves.urllib.parse import parse_qs
 from wechatpy.client import WeChatClient as _Client
+from wechatpy.exceptions import APILimitedException, WeChatClientException
 from wechatpy.client.api import WeChatWxa
 
+from .. import client as client_module
+from ..client import api_stats, TokenRefresher, WeChatJSAPI
 from ..models import WeChatApp
 from .. import settings
+from ..sites.wechat import WeChatInfo
 from .base import mock, WeChatTestCase
 from .interceptors import wechatapi, wechatapi_accesstoken, wechatapi_error
 
@@ -46,6 +56,169 @@ class AppTestCase(WeChatTestCase):
             delattr(self.app, "_client")
             del self.app.configurations["ACCESSTOKEN_URL"]
 
+    def test_accesstoken_single_flight(self):
+        """测试accesstoken单飞刷新"""
+        client = self.app.client
+        key = client.access_token_key
+        calls = []
+
+        def fetch(self, url, params):
+            calls.append(url)
+            time.sleep(0.1)
+            self.expires_at = int(time.time()) + 7200
+            self.session.set(key, "token{0}".format(len(calls)), 7200)
+            return dict(access_token="token", expires_in=7200)
+
+        with mock.patch.object(_Client, "_fetch_access_token",
+                               autospec=True, side_effect=fetch):
+            # 并发获取只请求一次
+            tokens = []
+            threads = [
+                threading.Thread(
+                    target=lambda: tokens.append(client.access_token))
+                for _ in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(tokens, ["token1"] * 5)
+            self.assertEqual(len(calls), 1)
+            self.assertGreater(
+                client.session.get(key + "_expires_at"), time.time() + 7000)
+
+            # 临近过期 其他worker刷新中时使用旧token
+            client.session.set(key + "_expires_at", int(time.time()) + 60)
+            cache.set("wx:l:" + key, 1)
+            self.assertEqual(client.access_token, "token1")
+            self.assertEqual(len(calls), 1)
+
+            # 旧token已过期 等待其他worker刷新完成
+            client.session.delete(key)
+
+            def refreshed():
+                time.sleep(0.1)
+                client.session.set(key, "refreshed")
+                client.session.set(key + "_expires_at",
+                                   int(time.time()) + 7200)
+                cache.delete("wx:l:" + key)
+
+            threading.Thread(target=refreshed).start()
+            self.assertEqual(client.access_token, "refreshed")
+            self.assertEqual(len(calls), 1)
+
+            # 临近过期时提前刷新
+            client.session.set(key + "_expires_at", int(time.time()) + 60)
+            self.assertEqual(client.access_token, "token2")
+            self.assertEqual(len(calls), 2)
+
+    def test_jsapi_ticket(self):
+        """测试jsapi ticket单飞刷新"""
+        client = self.app.client
+        ticket_key = "{0}_jsapi_ticket".format(client.appid)
+        result = dict(ticket="ticket", expires_in=7200)
+        with mock.patch.object(WeChatJSAPI, "get_ticket",
+                               return_value=result) as get_ticket:
+            self.assertEqual(client.jsapi.get_jsapi_ticket(), "ticket")
+            self.assertEqual(client.jsapi.get_jsapi_ticket(), "ticket")
+            self.assertEqual(get_ticket.call_count, 1)
+
+            client.session.set(ticket_key + "_expires_at",
+                               int(time.time()) + 60)
+            cache.set("wx:l:" + ticket_key, 1)
+            self.assertEqual(client.jsapi.get_jsapi_ticket(), "ticket")
+            self.assertEqual(get_ticket.call_count, 1)
+            cache.delete("wx:l:" + ticket_key)
+
+            # 后台刷新用过的ticket
+            client.session.set(client.access_token_key, "token")
+            refresher = TokenRefresher(3600)
+            refresher.register(client)
+            refresher.refresh()
+            self.assertEqual(get_ticket.call_count, 2)
+            self.assertTrue(refresher._thread.is_alive())
+
+    def test_invalid_token_retry(self):
+        """测试accesstoken失效时刷新后重试一次"""
+        tokens = []
+
+        @urlmatch(netloc=r"api\.weixin\.qq\.com$",
+                  path="/cgi-bin/message/custom/send")
+        def send(url, request):
+            token = parse_qs(url.query)["access_token"][0]
+            tokens.append(token)
+            errcode = 0 if token == valid else 40001
+            return response(200, dict(errcode=errcode, errmsg=""),
+                            {"Content-Type": "application/json"})
+
+        client = self.app.client
+        endpoint = "/cgi-bin/message/custom/send"
+        with mock.patch.dict(client_module._breakers, clear=True),\
+                HTTMock(send), wechatapi_accesstoken():
+            valid = "ACCESS_TOKEN"
+            client.session.set(client.access_token_key, "revoked")
+            self.assertEqual(
+                client.message.send_text("openid", "abc")["errcode"], 0)
+            self.assertEqual(tokens, ["revoked", "ACCESS_TOKEN"])
+            self.assertEqual(
+                api_stats()["test"][endpoint]["token_retries"], 1)
+
+            # 只重试一次
+            valid = "another"
+            tokens[:] = []
+            self.assertRaises(WeChatClientException,
+                              client.message.send_text, "openid", "abc")
+            self.assertEqual(tokens, ["ACCESS_TOKEN", "ACCESS_TOKEN"])
+
+    def test_freq_limit(self):
+        """测试调用频率超限时退避重试及熔断"""
+        calls = []
+        errcode = [45009]
+
+        @urlmatch(netloc=r"api\.weixin\.qq\.com$",
+                  path="/cgi-bin/message/custom/send")
+        def send(url, request):
+            calls.append(url)
+            return response(200, dict(errcode=errcode[0], errmsg=""),
+                            {"Content-Type": "application/json"})
+
+        client = self.app.client
+        client.session.set(client.access_token_key, "token")
+        endpoint = "/cgi-bin/message/custom/send"
+        with mock.patch.dict(client_module._breakers, clear=True),\
+                mock.patch.object(settings, "CLIENTFREQRETRIES", 2),\
+                mock.patch.object(settings, "CLIENTBREAKERTHRESHOLD", 5),\
+                mock.patch.object(time, "sleep") as sleep, HTTMock(send):
+            # 重试2次后抛出
+            self.assertRaises(APILimitedException,
+                              client.message.send_text, "openid", "abc")
+            self.assertEqual(len(calls), 3)
+            self.assertEqual(sleep.call_count, 2)
+            self.assertLessEqual(sleep.call_args_list[1][0][0], 1)
+
+            # 连续超限5次后熔断 熔断期间不请求
+            self.assertRaises(APILimitedException,
+                              client.message.send_text, "openid", "abc")
+            self.assertEqual(len(calls), 5)
+            self.assertRaises(APILimitedException,
+                              client.message.send_text, "openid", "abc")
+            self.assertEqual(len(calls), 5)
+            stats = api_stats()["test"][endpoint]
+            self.assertEqual(stats["limit_retries"], 3)
+            self.assertEqual(stats["trips"], 1)
+            self.assertEqual(stats["rejections"], 1)
+            self.assertTrue(stats["open"])
+
+            # 熔断结束后成功调用复位
+            errcode[0] = 0
+            with mock.patch.object(time, "time",
+                                   return_value=time.time() + 61):
+                self.assertEqual(
+                    client.message.send_text("openid", "abc")["errcode"], 0)
+            stats = api_stats()["test"][endpoint]
+            self.assertEqual(stats["failures"], 0)
+            self.assertFalse(stats["open"])
+
     def test_miniprogram_auth(self):
         """测试小程序授权"""
         openid = "mini_openid"
@@ -89,6 +262,37 @@ class AppTestCase(WeChatTestCase):
             self.assertEqual(user.sessions.count(), 1)
             self.assertEqual(user.session.session_key, session_key)
 
+    def test_app_cache(self):
+        """测试公众号进程内缓存"""
+        def get_app(name="test"):
+            return WeChatInfo(_appname=name).app
+
+        app = get_app()
+        client = app.client
+        with self.assertNumQueries(0):
+            self.assertIs(get_app(), app)
+            self.assertIs(get_app().client, client)
+        self.assertIsNot(get_app("test1"), app)
+
+        # 公众号变更后失效
+        self.app.desc = "changed"
+        self.app.save()
+        another = get_app()
+        self.assertIsNot(another, app)
+        self.assertEqual(another.desc, "changed")
+
+        # 其他进程使公众号失效
+        cache.set("wx:app:v:test", "other")
+        self.assertIsNot(get_app(), another)
+
+        # 自定义查询集合不缓存
+        queryset = WeChatApp.objects.filter(type=self.app.type)
+        info = WeChatInfo(_appname="test", _app_queryset=queryset)
+        self.assertIsNot(info.app, get_app())
+
+        with mock.patch.object(settings, "APPCACHE", False):
+            self.assertIsNot(get_app(), get_app())
+
     def test_build_url(self):
         """测试url构建"""
         def assertUrlCorrect(hostname, urlname, request=None, secure=False, kwargs=None):
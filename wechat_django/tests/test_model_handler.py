@@ -4,12 +4,15 @@ from __future__ import unicode_literals
 from datetime import timedelta
 import time
 
+from django.core.cache import cache
 from django.urls import reverse
 from django.utils import timezone
 from wechatpy import messages
 
 from ..handler import Handler, message_handler
 from ..models import MessageHandler, Rule, WeChatUser
+from ..models import user as user_module
+from ..utils.writer import BatchWriter
 from .base import mock, WeChatTestCase
 
 
@@ -23,11 +26,28 @@ def app_only_handler(message):
     return "success"
 
 
+@message_handler
+async def async_handler(message):
+    return "success"
+
+
 def forbidden_handler(message):
     return ""
 
 
 class HandlerTestCase(WeChatTestCase):
+    def setUp(self):
+        super(HandlerTestCase, self).setUp()
+        # 关注状态直接写入
+        self.writer = mock.patch.object(
+            user_module, "subscription_writer",
+            BatchWriter(WeChatUser._write_subscriptions, max_size=0))
+        self.writer.start()
+
+    def tearDown(self):
+        self.writer.stop()
+        super(HandlerTestCase, self).tearDown()
+
     def test_available(self):
         """测试handler有效性"""
         rule = dict(type=Rule.Type.ALL)
@@ -49,6 +69,102 @@ class HandlerTestCase(WeChatTestCase):
         self.assertEqual(len(matches), 1)
         self.assertEqual(matches[0], handler_available)
 
+    def test_matches_expire(self):
+        """测试匹配表失效"""
+        msg_info = self._msg2info(messages.TextMessage(dict(Content="abc")))
+        self.assertIsNone(MessageHandler.matches(msg_info))
+
+        handler = self._create_handler(
+            dict(type=Rule.Type.EQUAL, pattern="abc"))
+        self.assertEqual(MessageHandler.matches(msg_info)[0], handler)
+
+        # 修改规则
+        rule = handler.rules.first()
+        rule._content["pattern"] = "abcd"
+        rule.save()
+        self.assertIsNone(MessageHandler.matches(msg_info))
+
+        # 新增高优先级处理器
+        rule._content["pattern"] = "abc"
+        rule.save()
+        high_handler = self._create_handler(
+            dict(type=Rule.Type.CONTAIN, pattern="b"), weight=10)
+        self.assertEqual(MessageHandler.matches(msg_info)[0], high_handler)
+
+        # 禁用处理器
+        high_handler.enabled = False
+        high_handler.save()
+        self.assertEqual(MessageHandler.matches(msg_info)[0], handler)
+
+        # 删除处理器
+        handler.delete()
+        self.assertIsNone(MessageHandler.matches(msg_info))
+
+        # 返回的处理器绑定当前app
+        matched = MessageHandler.matches(self._msg2info(
+            messages.TextMessage(dict(Content="b")), app=self.app))
+        self.assertIsNone(matched)
+        high_handler.enabled = True
+        high_handler.save()
+        matched = MessageHandler.matches(msg_info)[0]
+        self.assertIs(matched.app, self.app)
+
+    def test_matches_contain(self):
+        """测试包含规则按处理器优先级匹配"""
+        low = self._create_handler(
+            [dict(type=Rule.Type.CONTAIN, pattern="he")], weight=-1)
+        high = self._create_handler(
+            [dict(type=Rule.Type.CONTAIN, pattern="hers"),
+             dict(type=Rule.Type.CONTAIN, pattern="某中文")], weight=1)
+        middle = self._create_handler(
+            [dict(type=Rule.Type.EQUAL, pattern="ushers")])
+
+        def match(content):
+            msg_info = self._msg2info(
+                messages.TextMessage(dict(Content=content)))
+            matches = MessageHandler.matches(msg_info)
+            return matches and matches[0]
+
+        self.assertEqual(match("ushers"), high)
+        self.assertEqual(match("这是某中文"), high)
+        self.assertEqual(match("she"), low)
+        self.assertIsNone(match("abc"))
+        high.enabled = False
+        high.save()
+        self.assertEqual(match("ushers"), middle)
+        self.assertEqual(match("ushersa"), low)
+
+    def test_matches_regex(self):
+        """测试正则规则按处理器优先级匹配"""
+        low = self._create_handler(
+            [dict(type=Rule.Type.REGEX, pattern=r"^\d+")], weight=-1)
+        high = self._create_handler(
+            [dict(type=Rule.Type.REGEX, pattern=r"[a-c]{2}$")], weight=1)
+        # 不可合并的正则
+        unmerged = self._create_handler(
+            [dict(type=Rule.Type.REGEX, pattern=r"(x)\1")])
+
+        def match(content):
+            msg_info = self._msg2info(
+                messages.TextMessage(dict(Content=content)))
+            matches = MessageHandler.matches(msg_info)
+            return matches and matches[0]
+
+        self.assertEqual(match("123ab"), high)
+        self.assertEqual(match("123a"), low)
+        self.assertEqual(match("123xx"), unmerged)
+        self.assertEqual(match("xxab"), high)
+        self.assertIsNone(match("abc1"))
+        high.enabled = False
+        high.save()
+        self.assertEqual(match("123ab"), low)
+
+        # 非法正则在保存时拒绝
+        rule = Rule(type=Rule.Type.REGEX, pattern="(", handler=low)
+        self.assertRaises(ValueError, rule.save)
+        self.assertRaises(ValueError, self._create_handler,
+                          [dict(type=Rule.Type.REGEX, pattern="[")])
+
     def test_sync(self):
         """测试同步"""
         pass
@@ -117,6 +233,56 @@ class HandlerTestCase(WeChatTestCase):
         user.refresh_from_db()
         self.assertTrue(user.subscribe)
 
+    def test_subscription_writer(self):
+        """测试关注状态合并写入"""
+        writer = BatchWriter(WeChatUser._write_subscriptions, max_size=100,
+                             interval=60)
+        existing = WeChatUser.objects.create(app=self.app, openid="existing")
+        with mock.patch.object(user_module, "subscription_writer", writer),\
+            mock.patch.object(user_module, "user_refresher") as refresher:
+            self.assertTrue(self.app.subscribe_user("existing", True, 100))
+            self.app.subscribe_user("existing", False)
+            self.assertTrue(self.app.subscribe_user("new", True, 200))
+            self.assertFalse(self.app.subscribe_user("new", True, 300))
+            self.assertTrue(
+                self.another_app.subscribe_user("new", True, 400))
+            # 写入前不入库
+            self.assertEqual(len(writer), 5)
+            self.assertFalse(self.app.users.filter(openid="new").exists())
+
+            writer.flush()
+            existing.refresh_from_db()
+            self.assertFalse(existing.subscribe)
+            self.assertEqual(existing.subscribe_time, 100)
+            user = self.app.users.get(openid="new")
+            self.assertTrue(user.subscribe)
+            self.assertEqual(user.subscribe_time, 300)
+            self.assertEqual(
+                self.another_app.users.get(openid="new").subscribe_time, 400)
+            # 新用户在后台同步
+            self.assertEqual(refresher.put.call_count, 2)
+
+            # 其他进程晚写入的较早事件不覆盖较晚的事件
+            self.app.subscribe_user("existing", True, 250)
+            self.app.subscribe_user("new", False, 250)
+            writer.flush()
+            existing.refresh_from_db()
+            self.assertFalse(existing.subscribe)
+            self.assertEqual(existing.subscribe_time, 250)
+            user.refresh_from_db()
+            self.assertTrue(user.subscribe)
+            self.assertIsNone(user.unsubscribe_time)
+            self.app.subscribe_user("new", False, 350)
+            writer.flush()
+            user.refresh_from_db()
+            self.assertFalse(user.subscribe)
+            self.assertEqual(user.unsubscribe_time, 350)
+
+            # 缓存失效时以库中数据为准
+            cache.clear()
+            self.assertFalse(self.app.subscribe_user("existing", True, 500))
+            writer.close()
+
     @mock.patch.object(Handler, "_get_appname")
     def test_first_subscribe(self, _get_appname):
         """测试首次关注"""
@@ -127,27 +293,29 @@ class HandlerTestCase(WeChatTestCase):
         openid = "first_subscribe"
         handler = Handler()
 
-        def create_subscribe_event():
+        def create_subscribe_event(create_time):
             subscribe_event_text = """
             <xml>
             <ToUserName><![CDATA[ToUser]]></ToUserName>
             <FromUserName><![CDATA[{0}]]></FromUserName>
-            <CreateTime>123456789</CreateTime>
+            <CreateTime>{1}</CreateTime>
             <MsgType><![CDATA[event]]></MsgType>
             <Event><![CDATA[subscribe]]></Event>
             </xml>
-            """.format(openid)
+            """.format(openid, create_time)
             request = self.rf().post(
                 url, subscribe_event_text, content_type="text/xml")
             return handler.initialize_request(request)
 
-        request = create_subscribe_event()
+        request = create_subscribe_event(123456789)
         self.assertEqual(handler.post(request, self.app.name), "")
+        self.assertTrue(request.wechat.first_subscribe)
         self.assertTrue(request.wechat.local_user.first_subscribe)
         self.assertTrue(request.wechat.user.first_subscribe)
 
-        request = create_subscribe_event()
+        request = create_subscribe_event(123456790)
         self.assertEqual(handler.post(request, self.app.name), "")
+        self.assertFalse(request.wechat.first_subscribe)
         self.assertFalse(request.wechat.local_user.first_subscribe)
         self.assertFalse(request.wechat.user.first_subscribe)
 
@@ -165,7 +333,8 @@ class HandlerTestCase(WeChatTestCase):
         request = handler.initialize_request(request)
         self.assertEqual(handler.post(request, self.app.name), "")
 
-        request = create_subscribe_event()
+        request = create_subscribe_event(123456791)
         self.assertEqual(handler.post(request, self.app.name), "")
+        self.assertFalse(request.wechat.first_subscribe)
         self.assertFalse(request.wechat.local_user.first_subscribe)
         self.assertFalse(request.wechat.user.first_subscribe)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import timedelta
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.db.models.query import QuerySet
+from django.utils import timezone
+from six import StringIO
+
+from ..models import MessageLog, MessageLogStat, Rule
+from .base import mock, WeChatTestCase
+
+
+class MessageLogTestCase(WeChatTestCase):
+    def setUp(self):
+        super(MessageLogTestCase, self).setUp()
+        self.user = self.app.users.create(openid="openid")
+        self.today = timezone.localdate()
+
+    def test_rollup(self):
+        """测试按日汇总"""
+        self._create_logs(3, 2)
+        self._create_logs(3, 1, type=Rule.ReceiveMsgType.EVENT)
+        self._create_logs(1, 4)
+        self._create_logs(0, 5)
+
+        stats = self.app.rollup_message_logs()
+        self.assertEqual(len(stats), 3)
+        stat = self.app.message_log_stats.get(
+            date=self.today - timedelta(3), type=Rule.ReceiveMsgType.TEXT)
+        self.assertEqual(stat.count, 2)
+        self.assertEqual(stat.direct, MessageLog.Direct.USER2APP)
+        # 今日不汇总
+        self.assertFalse(self.app.message_log_stats.filter(
+            date=self.today).exists())
+
+        # 重复汇总结果不变
+        self.app.rollup_message_logs(since=self.today - timedelta(10))
+        self.assertEqual(self.app.message_log_stats.count(), 3)
+        stat.refresh_from_db()
+        self.assertEqual(stat.count, 2)
+
+        # 从最后汇总日开始增量汇总
+        self._create_logs(1, 1)
+        self.app.rollup_message_logs()
+        self.assertEqual(self.app.message_log_stats.get(
+            date=self.today - timedelta(1)).count, 5)
+
+    def test_prune(self):
+        """测试删除及归档过期日志"""
+        self._create_logs(10, 3)
+        self._create_logs(5, 2)
+        self._create_logs(1, 1)
+
+        archive_dir = tempfile.mkdtemp()
+        try:
+            # 删除失败时不写入归档
+            with mock.patch.object(QuerySet, "delete",
+                                   side_effect=DatabaseError),\
+                    self.captureOnCommitCallbacks(execute=True):
+                self.assertRaises(DatabaseError, self.app.prune_message_logs,
+                                  self.today, archive_dir=archive_dir)
+            self.assertEqual(
+                os.listdir(os.path.join(archive_dir, self.app.name)), [])
+
+            out = StringIO()
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command("cleanmessagelogs", days=5, archive=archive_dir,
+                             batch_size=2, stdout=out)
+            # 保留包含第5天在内的日志
+            self.assertIn("test: 3 message logs archived", out.getvalue())
+
+            # 汇总保留
+            self.assertEqual(MessageLogStat.objects.filter(
+                app=self.app).count(), 3)
+            self.assertEqual(
+                set(MessageLog.objects.filter(app=self.app).values_list(
+                    "created_at__date", flat=True)),
+                {self.today - timedelta(5), self.today - timedelta(1)})
+
+            filename = os.path.join(
+                archive_dir, self.app.name,
+                "{0}.jsonl.gz".format(self.today - timedelta(10)))
+            with gzip.open(filename, "rb") as f:
+                lines = f.read().decode("utf-8").splitlines()
+            self.assertEqual(len(lines), 3)
+            log = json.loads(lines[0])
+            self.assertEqual(log["openid"], self.user.openid)
+            self.assertEqual(log["type"], Rule.ReceiveMsgType.TEXT)
+            # 多批日志并入同一归档 不留下临时文件
+            self.assertEqual(len(set(json.loads(line)["id"]
+                                     for line in lines)), 3)
+            self.assertEqual(
+                sorted(os.listdir(os.path.join(archive_dir, self.app.name))),
+                ["{0}.jsonl.gz".format(self.today - timedelta(10))])
+        finally:
+            shutil.rmtree(archive_dir)
+
+        # 不归档直接删除
+        count = self.app.prune_message_logs(self.today)
+        self.assertEqual(count, 3)
+        self.assertFalse(MessageLog.objects.filter(app=self.app).exists())
+
+    def _create_logs(self, days, count, type=Rule.ReceiveMsgType.TEXT):
+        created_at = timezone.now() - timedelta(days)
+        logs = [
+            MessageLog.objects.create(
+                app=self.app, user=self.user, type=type,
+                content=dict(content="abc"))
+            for i in range(count)
+        ]
+        # created_at为auto_now_add
+        MessageLog.objects.filter(id__in=[log.id for log in logs]).update(
+            created_at=created_at)
+        return logs
@@ -4,17 +4,23 @@ from __future__ import unicode_literals
 import json
 import time
 
+from asgiref.sync import async_to_sync
 from django.test import RequestFactory
 from django.utils.http import urlencode
 from httmock import response
 from requests.exceptions import HTTPError
 from six.moves.urllib.parse import parse_qsl
 from wechatpy import messages, parse_message, replies
+from wechatpy.replies import deserialize_reply
 from wechatpy.utils import check_signature, WeChatSigner
 
+from .. import settings
 from ..exceptions import MessageHandleError
 from ..handler import Handler, WeChatMessageInfo
-from ..models import MessageHandler, Reply
+from ..models import Material, MessageHandler, Reply
+from ..models.reply import PrerenderedReply
+from ..models import messagehandler
+from ..utils.executor import SerialExecutor
 
 from .base import mock, WeChatTestCase
 from .interceptors import (common_interceptor, wechatapi,
@@ -96,6 +102,64 @@ class ReplyTestCase(WeChatTestCase):
         # 测试图文回复
         pass
 
+    def test_prerender(self):
+        """测试静态回复预渲染"""
+        message = messages.TextMessage(dict(
+            FromUserName="openid",
+            ToUserName="gh_id",
+            content="xyz"
+        ))
+
+        def assertRendered(reply):
+            expected = super(PrerenderedReply, reply).render()
+            self.assertIsNotNone(reply._template.render(reply))
+            self.assertEqual(reply.render(), expected)
+
+        for kwargs in (
+            dict(type=Reply.MsgType.TEXT, content="{a} %s ]]> {{b}}"),
+            dict(type=Reply.MsgType.IMAGE, media_id="media_id"),
+            dict(type=Reply.MsgType.VOICE, media_id="media_id"),
+            dict(type=Reply.MsgType.VIDEO, media_id="media_id", title="t"),
+            dict(type=Reply.MsgType.MUSIC, thumb_media_id="media_id")):
+            reply = Reply(**kwargs).normal_reply(message)
+            assertRendered(reply)
+
+        # 修改回复内容后按原方式渲染
+        reply = Reply(type=Reply.MsgType.TEXT, content="a").normal_reply(
+            message)
+        reply.content = "b"
+        self.assertIsNone(reply._template.render(reply))
+        self.assertEqual(deserialize_reply(reply.render()).content, "b")
+
+        # 图文回复
+        material = self.app.materials.create(
+            type=Material.Type.NEWS, media_id="news")
+        material.articles.create(
+            title="title", thumb_media_id="thumb", content="content",
+            url="url", content_source_url="", index=0, thumb_url="thumb_url")
+        handler = self._create_handler(replies=dict(
+            type=Reply.MsgType.NEWS, media_id="news"))
+        message_info = self._wrap_message(message)
+        reply = handler.reply(message_info)
+        assertRendered(reply)
+        self.assertEqual(reply.articles[0]["image"], "thumb_url")
+
+        # 缓存于匹配表中 不再查询数据库
+        handler, = MessageHandler.matches(message_info)
+        handler.reply(message_info)
+        with self.assertNumQueries(0):
+            handler, = MessageHandler.matches(message_info)
+            reply = handler.reply(message_info)
+            assertRendered(reply)
+
+        # 素材变更后失效
+        article = material.articles.get()
+        article.title = "changed"
+        article.save()
+        handler, = MessageHandler.matches(message_info)
+        reply = handler.reply(message_info)
+        self.assertEqual(reply.articles[0]["title"], "changed")
+
     def test_multireply(self):
         """测试多回复"""
         reply1 = "abc"
@@ -134,13 +198,89 @@ class ReplyTestCase(WeChatTestCase):
             data = json.loads(request.body.decode())
             self.assertEqual(data["text"]["content"], reply1)
             self.assertEqual(data["touser"], sender)
-        with wechatapi_accesstoken(), wechatapi(api, dict(errcode=0, errmsg=""), callback):
+        with wechatapi_accesstoken(), wechatapi(api, dict(errcode=0, errmsg=""), callback),\
+            mock.patch.object(messagehandler, "sender", SerialExecutor(0)):
             reply = handler_all.reply(message)
             self.assertEqual(reply.type, Reply.MsgType.TEXT)
             self.assertEqual(reply.target, sender)
             self.assertEqual(reply.content, reply2)
             self.assertEqual(counter["calls"], 1)
 
+        # 客服消息在后台发送
+        with mock.patch.object(messagehandler, "sender") as executor:
+            reply = handler_all.reply(message)
+            self.assertEqual(reply.content, reply2)
+            self.assertEqual(executor.submit.call_count, 1)
+            key, func, message_info, send_replies = \
+                executor.submit.call_args[0]
+            self.assertEqual(key, (self.app.id, sender))
+            self.assertEqual([r.content["content"] for r in send_replies],
+                             [reply1])
+
+    def test_multireply_in_order(self):
+        """测试回复全部时所有回复依次以客服消息发送"""
+        replies = [dict(type=Reply.MsgType.TEXT, content=str(i))
+                   for i in range(3)]
+        handler = self._create_handler(
+            replies=replies, strategy=MessageHandler.ReplyStrategy.REPLYALL)
+        message = self._msg2info(messages.TextMessage(dict(
+            FromUserName="openid",
+            content="xyz"
+        )), request=None)
+
+        with mock.patch.object(settings, "MESSAGEREPLYALLINORDER", True),\
+            mock.patch.object(messagehandler, "sender") as executor:
+            self.assertFalse(handler.reply(message))
+            send_replies = executor.submit.call_args[0][3]
+            self.assertEqual([r.content["content"] for r in send_replies],
+                             ["0", "1", "2"])
+
+    def test_multireply_terminal(self):
+        """测试回复全部时发送异常中断其他回复"""
+        replies = [dict(type=Reply.MsgType.TEXT, content=str(i))
+                   for i in range(3)]
+        handler = self._create_handler(
+            replies=replies, strategy=MessageHandler.ReplyStrategy.REPLYALL)
+        message = self._msg2info(messages.TextMessage(dict(
+            FromUserName="openid",
+            content="xyz"
+        )), request=None)
+
+        with mock.patch.object(messagehandler, "sender", SerialExecutor(0)),\
+            mock.patch.object(MessageHandler, "handlerlog"),\
+            mock.patch.object(Reply, "send") as send:
+            send.side_effect = Exception()
+            handler.reply(message)
+            self.assertEqual(send.call_count, 2)
+
+            send.reset_mock()
+            handler.flags = MessageHandler.Flag.TERMINALONEXCEPTION
+            handler.reply(message)
+            self.assertEqual(send.call_count, 1)
+
+    def test_multireply_app(self):
+        """测试匹配表中共享的回复以当前app的client发送"""
+        from ..models import WeChatApp
+
+        replies = [dict(type=Reply.MsgType.TEXT, content=str(i))
+                   for i in range(3)]
+        self._create_handler(
+            replies=replies, strategy=MessageHandler.ReplyStrategy.REPLYALL)
+        message = messages.TextMessage(dict(
+            FromUserName="openid",
+            content="xyz"
+        ))
+        # 以旧的app构建匹配表
+        MessageHandler.matches(self._msg2info(message, request=None))
+
+        app = WeChatApp.objects.get(pk=self.app.pk)
+        app._client = mock.MagicMock()
+        message_info = self._msg2info(message, app=app, request=None)
+        with mock.patch.object(messagehandler, "sender", SerialExecutor(0)):
+            handler = MessageHandler.matches(message_info)[0]
+            handler.reply(message_info)
+        self.assertEqual(app._client.message.send_text.call_count, 2)
+
     def test_custom(self):
         """测试自定义回复"""
         from ..models import WeChatApp
@@ -164,6 +304,17 @@ class ReplyTestCase(WeChatTestCase):
         self.assertIsInstance(reply, replies.TextReply)
         self.assertEqual(reply.content, success_reply)
 
+        # 测试异步的自定义回复
+        handler = _get_handler("async_handler")
+        reply = handler.reply(message)
+        self.assertIsInstance(reply, replies.TextReply)
+        self.assertEqual(reply.content, success_reply)
+        with mock.patch.object(settings, "MESSAGEASYNCWORKERS", 0):
+            reply = async_to_sync(handler.reply_async)(message)
+        self.assertIsInstance(reply, replies.TextReply)
+        self.assertEqual(reply.content, success_reply)
+        self.assertEqual(reply.target, sender)
+
         # 测试未加装饰器的自定义回复
         handler = _get_handler("forbidden_handler")
         self.assertRaises(MessageHandleError, lambda: handler.reply(message))
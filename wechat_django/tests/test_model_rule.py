@@ -3,9 +3,10 @@ from __future__ import unicode_literals
 
 from wechatpy import events, messages
 
-from ..handler import message_rule
+from .. import handler as handler_module
+from ..handler import get_program, message_rule
 from ..models import MessageHandler, Rule, WeChatApp
-from .base import WeChatTestCase
+from .base import mock, WeChatTestCase
 
 
 def undecorated_rule(message_info):
@@ -167,6 +168,28 @@ class HandlerTestCase(WeChatTestCase):
         self.assertEqual(len(matches), 1)
         self.assertEqual(matches[0].id, handler4.id)
 
+    def test_program_registry(self):
+        """测试自定义规则注册表"""
+        path = "wechat_django.tests.test_model_rule.debug_rule"
+        self.assertIs(get_program(path), debug_rule)
+
+        # 未装饰的程序导入后缓存
+        path = "wechat_django.tests.test_model_rule.undecorated_rule"
+        self.assertIs(get_program(path), undecorated_rule)
+        with mock.patch.object(handler_module, "import_string") as func:
+            self.assertIs(get_program(path), undecorated_rule)
+            self.assertFalse(func.called)
+
+        # 不存在的程序只尝试导入一次
+        path = "wechat_django.tests.test_model_rule.not_exists_rule"
+        message_info = self._msg2info(messages.TextMessage(dict()))
+        rule = Rule(type=Rule.Type.CUSTOM, program=path)
+        self.assertFalse(rule.match(message_info))
+        with mock.patch.object(handler_module, "import_string") as func:
+            self.assertFalse(rule.match(message_info))
+            self.assertIsNone(get_program(path))
+            self.assertFalse(func.called)
+
     def assertMatch(self, rule, message):
         self.assertTrue(rule._match(message))
 
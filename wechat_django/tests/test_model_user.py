@@ -6,6 +6,7 @@ import json
 from wechatpy.exceptions import InvalidSignatureException
 
 from ..models import Session, WeChatUser
+from ..models import user as user_module
 from .base import mock, WeChatTestCase
 
 
@@ -26,6 +27,34 @@ class UserTestCase(WeChatTestCase):
         """测试更新用户"""
         pass
 
+    def test_lazy_user(self):
+        """测试惰性加载用户"""
+        openid = "lazy_user"
+        with mock.patch.object(user_module, "user_refresher") as refresher:
+            with self.assertNumQueries(0):
+                user = self.app.lazy_user_by_openid(openid)
+                self.assertEqual(user.openid, openid)
+                self.assertEqual(user.app, self.app)
+                user.first_subscribe = True
+                self.assertTrue(user.first_subscribe)
+
+            # 库中不存在的用户创建后在后台同步
+            self.assertIsNone(user.nickname)
+            self.assertTrue(user.id)
+            self.assertCallArgsEqual(refresher.put, ((self.app, openid),))
+
+            # 已知用户不再同步
+            refresher.put.reset_mock()
+            another = self.app.lazy_user_by_openid(openid)
+            self.assertEqual(another.id, user.id)
+            self.assertFalse(refresher.put.called)
+
+        # 同步失败不抛出异常
+        with mock.patch.object(WeChatUser, "fetch_users") as fetch_users:
+            fetch_users.side_effect = Exception()
+            WeChatUser._refresh_users([(self.app, openid)])
+            self.assertCallArgsEqual(fetch_users, (self.app, [openid]))
+
     def test_miniprogram_messages(self):
         """测试小程序消息解析"""
         self.app.appid = "wx4f4bc4dec97d474b"
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from wechatpy import parse_message as wechatpy_parse_message
+import xmltodict
+
+from ..parser import parse_envelope, parse_message
+from .base import WeChatTestCase
+
+
+class ParserTestCase(WeChatTestCase):
+    def test_parse_message(self):
+        """测试与wechatpy解析结果一致"""
+        messages = (
+            # 文本
+            """<xml><ToUserName><![CDATA[to]]></ToUserName>
+            <FromUserName><![CDATA[from]]></FromUserName>
+            <CreateTime>1348831860</CreateTime>
+            <MsgType><![CDATA[text]]></MsgType>
+            <Content><![CDATA[ 中文 <a> ]]></Content>
+            <MsgId>1234567890123456</MsgId></xml>""",
+            # 空内容
+            """<xml><FromUserName>from</FromUserName>
+            <MsgType>text</MsgType><Content><![CDATA[]]></Content></xml>""",
+            # 扫码关注
+            """<xml><FromUserName><![CDATA[from]]></FromUserName>
+            <MsgType><![CDATA[event]]></MsgType>
+            <Event><![CDATA[subscribe]]></Event>
+            <EventKey><![CDATA[qrscene_123123]]></EventKey></xml>""",
+            # 点击菜单
+            """<xml><FromUserName><![CDATA[from]]></FromUserName>
+            <MsgType><![CDATA[event]]></MsgType>
+            <Event><![CDATA[CLICK]]></Event>
+            <EventKey><![CDATA[key]]></EventKey></xml>""",
+            # 设备事件
+            """<xml><MsgType><![CDATA[device_event]]></MsgType>
+            <Event><![CDATA[bind]]></Event></xml>""",
+            # 未知消息
+            """<xml><MsgType><![CDATA[unknown]]></MsgType></xml>""",
+            # 嵌套节点
+            """<xml><FromUserName><![CDATA[from]]></FromUserName>
+            <MsgType><![CDATA[event]]></MsgType>
+            <Event><![CDATA[scancode_push]]></Event>
+            <EventKey><![CDATA[key]]></EventKey>
+            <ScanCodeInfo><ScanType><![CDATA[qrcode]]></ScanType>
+            <ScanResult><![CDATA[1]]></ScanResult></ScanCodeInfo></xml>""",
+        )
+        for xml in messages:
+            expected = wechatpy_parse_message(xml)
+            for raw in (xml, xml.encode("utf-8")):
+                message = parse_message(raw)
+                self.assertIs(type(message), type(expected))
+                self.assertEqual(message._data, expected._data)
+        self.assertIsNone(parse_envelope(messages[-1]))
+
+        # 无法解析的消息抛出与wechatpy一致的异常
+        self.assertRaises(xmltodict.expat.ExpatError, parse_message, "<xml>")
+        self.assertIsNone(parse_message(""))
+
+    def test_parse_envelope(self):
+        """测试平铺消息解析"""
+        self.assertEqual(
+            parse_envelope("<xml><Encrypt><![CDATA[abc]]></Encrypt></xml>"),
+            dict(Encrypt="abc"))
+        # 不解析DTD
+        xml = """<?xml version="1.0"?>
+        <!DOCTYPE xml [<!ENTITY a "abc">]>
+        <xml><Content>&a;</Content></xml>"""
+        self.assertIsNone(parse_envelope(xml))
+        # 属性及重复节点
+        self.assertIsNone(parse_envelope("<xml><a b='1'>1</a></xml>"))
+        self.assertIsNone(parse_envelope("<xml><a>1</a><a>2</a></xml>"))
+        self.assertIsNone(parse_envelope("<root><a>1</a></root>"))
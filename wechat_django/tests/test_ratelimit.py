@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+from django.contrib.admin import site
+from wechatpy.exceptions import APILimitedException
+
+from .. import ratelimit, settings
+from ..models import Template, WeChatApp
+from ..ratelimit import acquire, daily_usage, get_limit, RateLimit, throttle
+from ..utils.writer import BatchWriter
+from .base import mock, WeChatTestCase
+from .interceptors import wechatapi
+
+
+class RateLimitTestCase(WeChatTestCase):
+    endpoint = "/cgi-bin/message/custom/send"
+
+    def setUp(self):
+        super(RateLimitTestCase, self).setUp()
+        ratelimit._indexed.clear()
+        writer = BatchWriter(ratelimit._write_usages, max_size=0)
+        self.writer = mock.patch.object(ratelimit, "usage_writer", writer)
+        self.writer.start()
+
+    def tearDown(self):
+        self.writer.stop()
+        super(RateLimitTestCase, self).tearDown()
+
+    def test_get_limit(self):
+        """测试按接口路径或其结尾部分匹配限额"""
+        self.app.configurations["RATELIMITS"] = {
+            "message/custom/send": dict(rate=10, daily=100),
+            "/cgi-bin/user/info/batchget": dict(rate=2, burst=4)
+        }
+        limit = get_limit(self.app, self.endpoint)
+        self.assertEqual((limit.rate, limit.burst, limit.daily), (10, 10, 100))
+        limit = get_limit(self.app, "/cgi-bin/user/info/batchget")
+        self.assertEqual((limit.burst, limit.window), (4, 2))
+        self.assertIsNone(get_limit(self.app, "/cgi-bin/user/info"))
+
+    def test_rate(self):
+        """测试超出速率限额时等待"""
+        # django cache的过期时间亦依赖time.time
+        start = float(int(time.time()))
+        now = [start]
+
+        def sleep(seconds):
+            now[0] += seconds
+
+        limit = RateLimit(rate=2)
+        with mock.patch.object(time, "time", side_effect=lambda: now[0]),\
+                mock.patch.object(time, "sleep", side_effect=sleep):
+            acquire(self.app, self.endpoint, limit)
+            acquire(self.app, self.endpoint, limit)
+            # 窗口内超出限额 等待至下一窗口
+            now[0] += 0.5
+            acquire(self.app, self.endpoint, limit)
+            self.assertEqual(now[0], start + 1)
+
+            with mock.patch.object(settings, "CLIENTRATELIMITWAIT", 0):
+                acquire(self.app, self.endpoint, limit)
+                self.assertRaises(APILimitedException, acquire, self.app,
+                                  self.endpoint, limit)
+                # 批量任务等待至限额恢复
+                with throttle():
+                    acquire(self.app, self.endpoint, limit)
+                self.assertEqual(now[0], start + 2)
+
+        self.assertEqual(daily_usage(self.app), {self.endpoint: 5})
+
+    def test_template(self):
+        """测试发送模板消息时等待速率限额,每日调用量用尽时抛出异常"""
+        endpoint = "/cgi-bin/message/template/send"
+        self.app.configurations["RATELIMITS"] = {
+            "message/template/send": dict(rate=1, daily=2)
+        }
+        self.app.save()
+        app = WeChatApp.objects.get_by_name(self.app.name)
+        app.client.session.set(app.client.access_token_key, "token")
+        template = Template(app=app, template_id="id")
+
+        start = float(int(time.time()))
+        now = [start]
+
+        def sleep(seconds):
+            now[0] += seconds
+
+        success = dict(errcode=0, errmsg="", msgid=1)
+        with mock.patch.object(time, "time", side_effect=lambda: now[0]),\
+                mock.patch.object(time, "sleep", side_effect=sleep),\
+                mock.patch.object(settings, "CLIENTRATELIMITWAIT", 0),\
+                wechatapi(endpoint, success, lambda *args: calls.append(1)):
+            calls = []
+            template.send("openid", first="first")
+            # 窗口内超出限额 等待至下一窗口而非失败
+            template.send("openid", first="first")
+            self.assertEqual(now[0], start + 1)
+            self.assertRaises(APILimitedException, template.send, "openid",
+                              first="first")
+            self.assertEqual(len(calls), 2)
+
+    def test_daily(self):
+        """测试每日调用量"""
+        self.app.configurations["RATELIMITS"] = {
+            "message/custom/send": dict(daily=2)
+        }
+        self.app.save()
+        app = WeChatApp.objects.get_by_name(self.app.name)
+        client = app.client
+        client.session.set(client.access_token_key, "token")
+        success = dict(errcode=0, errmsg="")
+        with wechatapi(self.endpoint, success, lambda *args: calls.append(1)),\
+                wechatapi("/cgi-bin/user/info", dict(openid="openid")):
+            calls = []
+            client.message.send_text("openid", "abc")
+            client.message.send_text("openid", "abc")
+            client.user.get("openid")
+            self.assertRaises(APILimitedException,
+                              client.message.send_text, "openid", "abc")
+            self.assertEqual(len(calls), 2)
+
+        usage = daily_usage(app)
+        self.assertEqual(usage, {self.endpoint: 2, "/cgi-bin/user/info": 1})
+
+        html = site._registry[WeChatApp].api_usage(app)
+        self.assertIn(self.endpoint, html)
+        self.assertIn("<td>2</td><td>2</td>", html)
+        self.assertEqual(
+            site._registry[WeChatApp].api_usage(self.another_app), "-")
@@ -10,8 +10,8 @@ from django.test.utils import override_settings
 from django.urls import reverse
 import six
 from six.moves.urllib.parse import urlencode
-from wechatpy.client.api import WeChatJSAPI
 
+from ..client import WeChatJSAPI
 from ..models import WeChatApp
 from ..sites.wechat import WeChatSite, WeChatView, wechat_view
 from .base import mock, WeChatTestCase
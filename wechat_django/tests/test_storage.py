@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+from django.core.cache import cache
+import requests
+from wechatpy.exceptions import WeChatClientException
+
+from .. import settings
+from ..client import WeChatClient
+from ..storage import two_tier_storage, TwoTierStorage
+from .base import mock, WeChatTestCase
+
+
+class TwoTierStorageTestCase(WeChatTestCase):
+    def test_storage(self):
+        """进程内缓存命中时不访问共享缓存"""
+        storage = TwoTierStorage(max_age=60, max_size=2)
+        with mock.patch.object(cache, "get", wraps=cache.get) as get:
+            storage.set("key", "value", 7200)
+            self.assertEqual(cache.get("key"), "value")
+            get.reset_mock()
+            self.assertEqual(storage.get("key"), "value")
+            self.assertEqual(get.call_count, 0)
+
+            # 其他进程写入的值在进程内缓存过期后可见
+            cache.set("key", "another")
+            self.assertEqual(storage.get("key"), "value")
+            with mock.patch.object(time, "time",
+                                   return_value=time.time() + 61):
+                self.assertEqual(storage.get("key"), "another")
+            self.assertEqual(get.call_count, 1)
+
+            # 未命中不缓存
+            self.assertEqual(storage.get("missing", "default"), "default")
+            cache.set("missing", "value")
+            self.assertEqual(storage.get("missing"), "value")
+
+        # 不超过剩余有效期
+        storage.set("token_expires_at", time.time() + 5)
+        cache.set("token", "token")
+        self.assertEqual(storage.get("token"), "token")
+        cache.delete("token")
+        with mock.patch.object(time, "time", return_value=time.time() + 6):
+            self.assertIsNone(storage.get("token"))
+
+        # 进程内缓存数量上限
+        storage.set("a", 1)
+        storage.set("b", 2)
+        storage.set("c", 3)
+        self.assertEqual(list(storage._local), ["b", "c"])
+
+        storage.delete("c")
+        self.assertIsNone(storage.get("c"))
+        self.assertIsNone(cache.get("c"))
+
+    def test_invalid_token(self):
+        """接口返回accesstoken失效时清除进程内缓存"""
+        two_tier_storage.clear()
+        with mock.patch.object(settings, "SESSIONSTORAGE",
+                               "wechat_django.storage.two_tier_storage"):
+            client = WeChatClient(self.app)
+        self.assertIs(client.session, two_tier_storage)
+
+        key = client.access_token_key
+        client.session.set(key, "old", 7200)
+        # 其他进程刷新了accesstoken
+        cache.set(key, "new", 7200)
+        self.assertEqual(client.access_token, "old")
+
+        res = requests.Response()
+        res.status_code = 200
+        res._content = b'{"errcode": 40001, "errmsg": "invalid credential"}'
+        self.assertRaises(WeChatClientException, client._handle_result, res)
+        self.assertEqual(client.access_token, "new")
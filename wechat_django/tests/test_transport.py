@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+
+import requests
+from six.moves import BaseHTTPServer
+
+from ..management.commands.loadtest import StubServer
+from ..oauth import WeChatOAuthClient
+from ..transport import get_session, pool_stats, PooledAdapter
+from .base import WeChatTestCase
+
+
+class ResetHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """首次请求/reset时不响应直接断开连接"""
+    protocol_version = "HTTP/1.1"
+    resets = 0
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.respond()
+
+    def respond(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        length and self.rfile.read(length)
+        if self.path == "/reset" and not type(self).resets:
+            type(self).resets += 1
+            self.close_connection = True
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TransportTestCase(WeChatTestCase):
+    def setUp(self):
+        super(TransportTestCase, self).setUp()
+        ResetHandler.resets = 0
+        self.server = StubServer(("127.0.0.1", 0), ResetHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:{0}".format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super(TransportTestCase, self).tearDown()
+
+    def test_shared_session(self):
+        """所有client共用一个连接池"""
+        session = get_session()
+        self.assertIs(self.app.client._http, session)
+        self.assertIs(self.another_app.client._http, session)
+        self.assertIs(WeChatOAuthClient(self.app)._http, session)
+        self.assertIsInstance(session.get_adapter("https://"), PooledAdapter)
+        self.assertIsInstance(pool_stats(), dict)
+
+    def test_stats(self):
+        """连接复用及连接池状态"""
+        session = self.session(PooledAdapter(max_connections=2))
+        for _ in range(3):
+            self.assertEqual(session.get(self.url + "/").content, b"ok")
+        stats = session.get_adapter(self.url).stats()["127.0.0.1"]
+        self.assertEqual(stats, dict(max_connections=2, in_use=0, idle=1,
+                                     created=1, requests=3, errors=0))
+
+    def test_max_connections(self):
+        """超出host最大连接数时等待超时"""
+        adapter = PooledAdapter(
+            max_connections=5, host_max_connections={"127.0.0.1": 1},
+            pool_timeout=0.01)
+        session = self.session(adapter)
+        host = adapter._get_host("127.0.0.1")
+        self.assertEqual(host.max_connections, 1)
+        host.semaphore.acquire()
+        try:
+            self.assertRaises(requests.exceptions.ConnectTimeout,
+                              session.get, self.url + "/")
+        finally:
+            host.semaphore.release()
+        self.assertEqual(session.get(self.url + "/").content, b"ok")
+        stats = adapter.stats()["127.0.0.1"]
+        self.assertEqual(stats["requests"], 2)
+        self.assertEqual(stats["errors"], 1)
+
+    def test_wait_without_timeout(self):
+        """未设置超时的请求等待空闲连接不限时"""
+        adapter = PooledAdapter(
+            max_connections=1, host_max_connections={"127.0.0.1": 1})
+        self.assertIsNone(adapter._acquire_timeout(None))
+        self.assertEqual(adapter._acquire_timeout((1, 5)), 1)
+        session = self.session(adapter)
+        host = adapter._get_host("127.0.0.1")
+        host.semaphore.acquire()
+        timer = threading.Timer(0.1, host.semaphore.release)
+        timer.start()
+        try:
+            self.assertEqual(session.get(self.url + "/").content, b"ok")
+        finally:
+            timer.join()
+
+    def test_retry(self):
+        """连接被重置时仅重试幂等请求"""
+        session = self.session(PooledAdapter(retries=1))
+        self.assertEqual(session.get(self.url + "/reset").content, b"ok")
+        self.assertEqual(ResetHandler.resets, 1)
+
+        ResetHandler.resets = 0
+        self.assertRaises(requests.exceptions.ConnectionError,
+                          session.post, self.url + "/reset", b"data")
+        self.assertEqual(session.post(self.url + "/reset", b"data").content,
+                         b"ok")
+
+    def session(self, adapter):
+        session = requests.Session()
+        session.mount("http://", adapter)
+        return session
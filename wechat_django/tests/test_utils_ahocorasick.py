@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import random
+
+from ..utils.ahocorasick import Automaton
+from .base import WeChatTestCase
+
+
+class UtilAhoCorasickTestCase(WeChatTestCase):
+    def test_iter(self):
+        """测试多模式串匹配"""
+        automaton = Automaton()
+        for pattern in ("he", "she", "his", "hers", "某中文"):
+            automaton.add(pattern, pattern)
+        automaton.build()
+        self.assertEqual(len(automaton), 5)
+
+        self.assertEqual(set(automaton.iter("ushers")), {"he", "she", "hers"})
+        self.assertEqual(set(automaton.iter("ahishe")), {"his", "she", "he"})
+        self.assertEqual(set(automaton.iter("这是某中文内容")), {"某中文"})
+        self.assertEqual(set(automaton.iter("某中")), set())
+        self.assertEqual(set(automaton.iter("")), set())
+
+        # 空模式串总是匹配
+        automaton.add("", "")
+        self.assertEqual(set(automaton.iter("abc")), {""})
+
+    def test_consistency(self):
+        """测试与逐条匹配结果一致"""
+        rnd = random.Random(0)
+        patterns = [
+            "".join(rnd.choice("abc") for _ in range(rnd.randint(1, 4)))
+            for _ in range(50)
+        ]
+        automaton = Automaton()
+        for i, pattern in enumerate(patterns):
+            automaton.add(pattern, i)
+        automaton.build()
+
+        for _ in range(100):
+            text = "".join(rnd.choice("abcd") for _ in range(20))
+            expected = {i for i, p in enumerate(patterns) if p in text}
+            self.assertEqual(set(automaton.iter(text)), expected)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+import time
+
+from ..utils.executor import SerialExecutor
+from .base import WeChatTestCase
+
+
+class UtilExecutorTestCase(WeChatTestCase):
+    def test_serial(self):
+        """测试同一key的任务依次执行"""
+        executor = SerialExecutor(4)
+        results = dict(a=[], b=[])
+        done = threading.Event()
+
+        def task(key, value):
+            time.sleep(0.01)
+            results[key].append(value)
+            if len(results["a"]) + len(results["b"]) == 20:
+                done.set()
+
+        try:
+            for i in range(10):
+                executor.submit("a", task, "a", i)
+                executor.submit("b", task, "b", i)
+            self.assertTrue(done.wait(5))
+            self.assertEqual(results["a"], list(range(10)))
+            self.assertEqual(results["b"], list(range(10)))
+        finally:
+            executor.shutdown()
+
+    def test_sync(self):
+        """测试不启用线程池时在当前线程执行"""
+        executor = SerialExecutor(0)
+        thread = []
+        executor.submit("a", lambda: thread.append(threading.current_thread()))
+        self.assertEqual(thread, [threading.current_thread()])
+
+        # 异常不抛出
+        executor.submit("a", lambda: 1 / 0)
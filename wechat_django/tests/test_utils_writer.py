@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+
+from ..utils.writer import BatchWriter
+from .base import WeChatTestCase
+
+
+class UtilWriterTestCase(WeChatTestCase):
+    def test_sync(self):
+        """测试不缓冲时在当前线程写入"""
+        written = []
+        writer = BatchWriter(
+            lambda items: written.append(
+                (threading.current_thread(), items)), max_size=0)
+        writer.put(1)
+        self.assertEqual(written, [(threading.current_thread(), [1])])
+
+    def test_max_pending(self):
+        """测试后台写入跟不上时在当前线程写入,缓冲不超过上限"""
+        written = []
+        blocked = threading.Event()
+        release = threading.Event()
+
+        def write(items):
+            if threading.current_thread().name == "wechat-batch-writer":
+                # 模拟阻塞的数据库
+                blocked.set()
+                release.wait(5)
+            written.extend(items)
+
+        writer = BatchWriter(write, max_size=2, interval=60, max_pending=5)
+        try:
+            writer.put(0)
+            writer.put(1)
+            self.assertTrue(blocked.wait(5))
+            for i in range(2, 7):
+                writer.put(i)
+            # 达到上限的缓冲已在当前线程写入
+            self.assertEqual(sorted(written), [2, 3, 4, 5, 6])
+            self.assertEqual(len(writer), 0)
+        finally:
+            release.set()
+            writer.close()
+            writer._thread.join(5)
+        self.assertEqual(sorted(written), list(range(7)))
@@ -1,21 +1,35 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import asyncio
+import threading
 import time
 
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.test import AsyncClient, override_settings
 from django.urls import reverse
 from django.utils.http import urlencode
+from six.moves import BaseHTTPServer
 from wechatpy.replies import deserialize_reply, TextReply
 from wechatpy.utils import WeChatSigner
 
 from .. import settings
-from ..models import MessageHandler, Reply, Rule
-from .base import WeChatTestCase
+from ..management.commands.loadtest import StubServer
+from ..models import MessageHandler, MessageLog, MsgLogFlag, Reply, Rule
+from ..models import messagelog
+from ..timing import TimingRegistry
+from ..utils.aio import run_sync
+from ..utils.writer import BatchWriter
+from .base import mock, WeChatTestCase
 
 # TODO: 应该拆解成测试各方法会比较直观
 
 
 class HandlerTestCase(WeChatTestCase):
+    url_name = "wechat_django:handler"
+    reply_method = "reply"
+
     def setUp(self):
         super(HandlerTestCase, self).setUp()
         MessageHandler.objects.create_handler(
@@ -30,8 +44,15 @@ class HandlerTestCase(WeChatTestCase):
             )]
         )
 
+        self._settings = (settings.MESSAGENOREPEATNONCE,
+                          settings.MESSAGETIMEOFFSET)
         settings.MESSAGENOREPEATNONCE = False
 
+    def tearDown(self):
+        settings.MESSAGENOREPEATNONCE, settings.MESSAGETIMEOFFSET =\
+            self._settings
+        super(HandlerTestCase, self).tearDown()
+
     def test_badrequest(self):
         """测试错误请求"""
         nonce = "123456"
@@ -72,13 +93,93 @@ class HandlerTestCase(WeChatTestCase):
         self.assertEqual(resp.status_code, 200)
         reply = deserialize_reply(resp.content)
         self.assertEqual(reply.content, self.success_reply)
+        # 签名重复的已处理消息视为微信重试
         resp = self.post(query)
+        self.assertEqual(resp.status_code, 200)
+        reply = deserialize_reply(resp.content)
+        self.assertEqual(reply.content, self.success_reply)
+        # 签名重复的其他消息
+        resp = self.post(query, msg_id=2)
         self.assertEqual(resp.status_code, 400)
         self.assertEqual(resp.content, b"")
 
         # 防重放超时正常接收
         pass
 
+    def test_retry(self):
+        """测试微信重试消息"""
+        settings.MESSAGENOREPEATNONCE = True
+        query = dict(timestamp=str(int(time.time())), nonce="123456")
+        with mock.patch.object(Reply, self.reply_method,
+                               wraps=lambda message_info: TextReply(
+                                   message=message_info.message,
+                                   content=self.success_reply)) as reply:
+            resp = self.post(dict(query))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(reply.call_count, 1)
+
+            # 重试的消息不再处理 直接返回首次回复
+            resp = self.post(dict(query, nonce="654321"))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                deserialize_reply(resp.content).content, self.success_reply)
+            self.assertEqual(reply.call_count, 1)
+
+            # 其他消息正常处理
+            resp = self.post(dict(query, nonce="654321"), msg_id=2)
+            self.assertEqual(resp.status_code, 400)
+            resp = self.post(dict(query, nonce="111111"), msg_id=2)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(reply.call_count, 2)
+
+            # 处理失败的消息可以重试
+            reply.side_effect = Exception()
+            resp = self.post(dict(query, nonce="222222"), msg_id=3)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.content, b"")
+            reply.side_effect = None
+            resp = self.post(dict(query, nonce="333333"), msg_id=3)
+            self.assertEqual(
+                deserialize_reply(resp.content).content, self.success_reply)
+            self.assertEqual(reply.call_count, 4)
+
+            # 以相同签名及nonce重试处理失败的消息
+            reply.side_effect = Exception()
+            resp = self.post(dict(query, nonce="444444"), msg_id=4)
+            self.assertEqual(resp.content, b"")
+            reply.side_effect = None
+            resp = self.post(dict(query, nonce="444444"), msg_id=4)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                deserialize_reply(resp.content).content, self.success_reply)
+            self.assertEqual(reply.call_count, 6)
+
+    def test_pending_retry(self):
+        """测试首次请求处理中时的重试消息"""
+        settings.MESSAGENOREPEATNONCE = True
+        query = dict(timestamp=str(int(time.time())), nonce="123456")
+        reply_key = "wx:m:r:{0}:{1}".format(self.app.id, 1)
+        cache.set(reply_key, 0)
+        timeout = settings.MESSAGEREPLYWAITTIMEOUT
+        try:
+            # 等待超时返回空回复
+            settings.MESSAGEREPLYWAITTIMEOUT = 0.1
+            resp = self.post(dict(query), msg_id=1)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.content, b"")
+
+            # 首次请求处理完成后返回其回复
+            settings.MESSAGEREPLYWAITTIMEOUT = 5
+            timer = threading.Timer(
+                0.2, lambda: cache.set(reply_key, "<xml>reply</xml>"))
+            timer.start()
+            resp = self.post(dict(query, nonce="654321"), msg_id=1)
+            timer.join()
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.content, b"<xml>reply</xml>")
+        finally:
+            settings.MESSAGEREPLYWAITTIMEOUT = timeout
+
     def test_request(self):
         """测试正常请求"""
         timestamp = str(int(time.time()))
@@ -101,6 +202,188 @@ class HandlerTestCase(WeChatTestCase):
         self.assertIsInstance(reply, TextReply)
         self.assertEqual(reply.content, self.success_reply)
 
+    def test_log_message(self):
+        """测试消息日志缓冲写入"""
+        self.app.flags = MsgLogFlag.LOG_MESSAGE
+        self.app.save()
+        self.app.users.create(openid=self.sender)
+
+        writer = BatchWriter(MessageLog._bulk_create, max_size=100,
+                             interval=60)
+        query = dict(timestamp=str(int(time.time())), nonce="123456")
+        with mock.patch.object(messagelog, "writer", writer):
+            resp = self.post(dict(query))
+            self.assertEqual(resp.status_code, 200)
+            resp = self.post(dict(query), "666")
+            self.assertEqual(resp.status_code, 200)
+            # 未写入前不入库
+            self.assertEqual(len(writer), 1)
+            self.assertEqual(MessageLog.objects.count(), 0)
+
+            writer.flush()
+            self.assertEqual(len(writer), 0)
+            log = MessageLog.objects.get()
+            self.assertEqual(log.app, self.app)
+            self.assertEqual(log.user.openid, self.sender)
+            self.assertEqual(log.msg_id, 1234567890123456)
+            self.assertEqual(log.content["content"], self.match_str)
+            writer.close()
+
+    def test_custom(self):
+        """测试同步及异步的自定义回复"""
+        for program in ("debug_handler", "async_handler"):
+            MessageHandler.objects.create_handler(
+                app=self.app,
+                rules=[Rule(type=Rule.Type.EQUAL, pattern=program)],
+                replies=[Reply(
+                    type=Reply.MsgType.CUSTOM,
+                    program="wechat_django.tests.test_model_handler."
+                    + program
+                )]
+            )
+            query = dict(timestamp=str(int(time.time())), nonce="123456")
+            resp = self.post(query, program)
+            self.assertEqual(resp.status_code, 200)
+            reply = deserialize_reply(resp.content)
+            self.assertEqual(reply.target, self.sender)
+            self.assertEqual(reply.content, "success")
+
+    def test_reply_timeout(self):
+        """测试超时的回复以客服消息发送"""
+        sent = threading.Event()
+
+        def reply(message_info, delay):
+            time.sleep(delay)
+            return TextReply(message=message_info.message,
+                             content=self.success_reply)
+
+        async def reply_async(message_info, delay):
+            await asyncio.sleep(delay)
+            return TextReply(message=message_info.message,
+                             content=self.success_reply)
+
+        handler = mock.MagicMock(log_message=False)
+        handler.reply = lambda message_info: reply(message_info, 0.3)
+        handler.reply_async = lambda message_info: reply_async(
+            message_info, 0.3)
+        query = dict(timestamp=str(int(time.time())), nonce="123456")
+        with mock.patch.object(settings, "MESSAGEREPLYTIMEOUT", 0.1),\
+            mock.patch.object(MessageHandler, "matches",
+                              return_value=(handler,)),\
+            mock.patch("wechatpy.client.api.WeChatMessage.send_text",
+                       side_effect=lambda **kwargs: sent.set()) as send:
+            # 超时先回复空消息
+            resp = self.post_and_wait(dict(query), sent)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.content, b"")
+            self.assertTrue(sent.is_set())
+            send.assert_called_once_with(user_id=self.sender,
+                                         content=self.success_reply)
+
+            # 未超时正常回复
+            handler.reply = lambda message_info: reply(message_info, 0)
+            handler.reply_async = lambda message_info: reply_async(
+                message_info, 0)
+            resp = self.post(dict(query))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(deserialize_reply(resp.content).content,
+                             self.success_reply)
+            self.assertEqual(send.call_count, 1)
+
+    def test_forward_reply_timeout(self):
+        """测试超出被动回复截止时间的转发仍以客服消息发送"""
+        sent = threading.Event()
+        reply_xml = TextReply(source="toUser", target=self.sender,
+                              content=self.success_reply).render()
+
+        class SlowUpstream(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                time.sleep(0.4)
+                content = reply_xml.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = StubServer(("127.0.0.1", 0), SlowUpstream)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        forward = Reply(type=Reply.MsgType.FORWARD,
+                        url="http://127.0.0.1:{0}/".format(
+                            server.server_port))
+        handler = mock.MagicMock(log_message=False)
+        handler.reply = forward.reply
+        handler.reply_async = forward.reply_async
+        query = dict(timestamp=str(int(time.time())), nonce="123456")
+        try:
+            with mock.patch.object(settings, "MESSAGEREPLYTIMEOUT", 0.1),\
+                mock.patch.object(settings, "MESSAGEDEADLINE", 0.2),\
+                mock.patch.object(MessageHandler, "matches",
+                                  return_value=(handler,)),\
+                mock.patch("wechatpy.client.api.WeChatMessage.send_text",
+                           side_effect=lambda **kwargs: sent.set()) as send:
+                resp = self.post_and_wait(dict(query), sent)
+                self.assertEqual(resp.content, b"")
+                self.assertTrue(sent.is_set())
+                send.assert_called_once_with(user_id=self.sender,
+                                             content=self.success_reply)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_timing(self):
+        """测试消息处理耗时统计"""
+        from .. import timing
+
+        query = dict(timestamp=str(int(time.time())), nonce="123456")
+        registry = TimingRegistry()
+
+        def bad_sink(app, message_info, timing):
+            raise Exception()
+
+        # 未开启时不记录
+        with mock.patch.object(timing, "_sinks", [registry]):
+            resp = self.post(dict(query))
+            self.assertEqual(resp.status_code, 200)
+            self.assertFalse(resp.has_header("Server-Timing"))
+            self.assertEqual(registry.snapshot(), {})
+
+        sinks = [bad_sink, registry]
+        with mock.patch.object(settings, "MESSAGETIMING", True),\
+            mock.patch.object(timing, "_sinks", sinks):
+            # sink异常不影响回复
+            resp = self.post(dict(query))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(deserialize_reply(resp.content).content,
+                             self.success_reply)
+            self.assertFalse(resp.has_header("Server-Timing"))
+            stats = registry.snapshot()[self.app.name]
+            for stage in ("signature", "parse", "match", "reply", "render",
+                          "total"):
+                self.assertEqual(stats[stage]["count"], 1)
+                self.assertEqual(
+                    sum(stats[stage]["buckets"].values()), 1)
+            self.assertNotIn("decrypt", stats)
+
+            with override_settings(DEBUG=True):
+                resp = self.post(dict(query), "666")
+            self.assertEqual(resp.status_code, 200)
+            header = resp["Server-Timing"]
+            self.assertIn("signature;dur=", header)
+            self.assertIn("match;dur=", header)
+            self.assertNotIn("reply", header)
+            stats = registry.snapshot()[self.app.name]
+            self.assertEqual(stats["match"]["count"], 2)
+            self.assertEqual(stats["render"]["count"], 2)
+
+            registry.clear()
+            self.assertEqual(registry.snapshot(), {})
+
     def test_echostr(self):
         """测试初次请求验证"""
         echostr = b"666666"
@@ -125,23 +408,33 @@ class HandlerTestCase(WeChatTestCase):
         )
         return signer.signature
 
-    def post(self, query, content=""):
+    def post(self, query, content="", msg_id=1234567890123456):
+        return self.client.generic(
+            "POST", *self.message(query, content, msg_id))
+
+    def post_and_wait(self, query, event, timeout=2):
+        """发送消息并等待后台任务完成"""
+        resp = self.post(query)
+        event.wait(timeout)
+        return resp
+
+    def message(self, query, content="", msg_id=1234567890123456):
         xml = """<xml>
         <ToUserName><![CDATA[toUser]]></ToUserName>
         <FromUserName><![CDATA[{sender}]]></FromUserName>
         <CreateTime>{timestamp}</CreateTime>
         <MsgType><![CDATA[text]]></MsgType>
         <Content><![CDATA[{content}]]></Content>
-        <MsgId>1234567890123456</MsgId>
+        <MsgId>{msg_id}</MsgId>
         </xml>""".format(
             sender=self.sender,
+            msg_id=msg_id,
             content=content or self.match_str,
             timestamp=query["timestamp"]
         )
         if "signature" not in query:
             query["signature"] = self.sign(query)
-        return self.client.generic("POST", self.url + "?" + urlencode(query),
-            xml)
+        return self.url + "?" + urlencode(query), xml
 
     @property
     def sender(self):
@@ -157,5 +450,38 @@ class HandlerTestCase(WeChatTestCase):
 
     @property
     def url(self):
-        return reverse(
-            "wechat_django:handler", kwargs=dict(appname=self.app.name))
+        return reverse(self.url_name, kwargs=dict(appname=self.app.name))
+
+
+class AsyncHandlerTestCase(HandlerTestCase):
+    url_name = "wechat_django:async_handler"
+    reply_method = "reply_async"
+
+    def setUp(self):
+        super(AsyncHandlerTestCase, self).setUp()
+        # 测试数据未提交 须在测试线程中访问数据库
+        self.workers = mock.patch.object(settings, "MESSAGEASYNCWORKERS", 0)
+        self.workers.start()
+
+    def tearDown(self):
+        self.workers.stop()
+        super(AsyncHandlerTestCase, self).tearDown()
+
+    def post_and_wait(self, query, event, timeout=2):
+        # 测试客户端在请求结束后关闭事件循环 须在同一事件循环中等待后台任务
+        async def post():
+            resp = await AsyncClient().generic("POST", *self.message(query))
+            deadline = time.time() + timeout
+            while not event.is_set() and time.time() < deadline:
+                await asyncio.sleep(0.01)
+            return resp
+        return async_to_sync(post)()
+
+    def test_run_sync(self):
+        """测试在有界线程池中执行同步代码"""
+        current = threading.current_thread().name
+        with mock.patch.object(settings, "MESSAGEASYNCWORKERS", 2):
+            name = async_to_sync(run_sync)(
+                lambda: threading.current_thread().name)
+        self.assertNotEqual(name, current)
+        self.assertTrue(name.startswith("wechat-async"))
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""消息处理耗时统计
+
+开启WECHAT_MESSAGETIMING后,Handler记录每条消息签名校验,防重放,解密,解析,
+匹配,回复,日志,渲染及加密各阶段的耗时,处理完成后交由WECHAT_MESSAGETIMINGSINKS
+中的各个sink处理.sink接收公众号,消息及耗时记录
+
+    def my_sink(app, message_info, timing):
+        statsd.timing("wechat.message", timing.total)
+"""
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+from django.utils.module_loading import import_string
+import six
+
+from . import settings, signals
+
+__all__ = ("emit", "log_sink", "registry", "signal_sink", "Timing",
+           "TimingRegistry")
+
+
+class Timing(object):
+    """单条消息各阶段的耗时(毫秒)"""
+
+    enabled = True
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self._start = time.time()
+
+    @property
+    def total(self):
+        return (time.time() - self._start) * 1000
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = (time.time() - start) * 1000
+            self.stages[name] = self.stages.get(name, 0) + elapsed
+
+    def server_timing(self):
+        """Server-Timing响应头"""
+        return ", ".join(
+            "{0};dur={1:.2f}".format(name, elapsed)
+            for name, elapsed in self.stages.items())
+
+    def __str__(self):
+        return " ".join(
+            "{0}={1:.2f}ms".format(name, elapsed)
+            for name, elapsed in self.stages.items())
+
+
+class NullTiming(Timing):
+    """未开启耗时统计时不做任何记录"""
+
+    enabled = False
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+
+class TimingRegistry(object):
+    """进程内的耗时统计,按公众号及阶段记录次数,总耗时,最大耗时及耗时分布"""
+
+    buckets = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+    """耗时分布的分桶上限(毫秒)"""
+
+    def __init__(self):
+        self._stats = dict()
+        self._lock = threading.Lock()
+
+    def __call__(self, app, message_info, timing):
+        stages = list(timing.stages.items())
+        stages.append(("total", timing.total))
+        with self._lock:
+            for name, elapsed in stages:
+                self._record(app.name, name, elapsed)
+
+    def snapshot(self):
+        """
+            {"appname": {"match": {"count": 10, "sum": 2.5, "max": 0.7,
+                                   "buckets": {1: 10, 5: 0, ..., "+Inf": 0}}}}
+        """
+        with self._lock:
+            return {
+                appname: {
+                    name: dict(stat, buckets=dict(
+                        zip(self.buckets + ("+Inf",), stat["buckets"])))
+                    for name, stat in stages.items()
+                }
+                for appname, stages in self._stats.items()
+            }
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+    def _record(self, appname, name, elapsed):
+        stat = self._stats.setdefault(appname, dict()).get(name)
+        if not stat:
+            stat = self._stats[appname][name] = dict(
+                count=0, sum=0., max=0.,
+                buckets=[0] * (len(self.buckets) + 1))
+        stat["count"] += 1
+        stat["sum"] += elapsed
+        stat["max"] = max(stat["max"], elapsed)
+        for i, bucket in enumerate(self.buckets):
+            if elapsed <= bucket:
+                break
+        else:
+            i = len(self.buckets)
+        stat["buckets"][i] += 1
+
+
+registry = TimingRegistry()
+"""默认的进程内耗时统计sink"""
+
+
+def log_sink(app, message_info, timing):
+    """以debug级别记录耗时日志"""
+    app.logger("handler").debug(
+        "message timing: total=%.2fms %s", timing.total, timing)
+
+
+def signal_sink(app, message_info, timing):
+    """发送message_timed信号"""
+    signals.message_timed.send(app.staticname, message_info=message_info,
+                               timing=timing)
+
+
+_sinks = None
+
+
+def get_sinks():
+    global _sinks
+    if _sinks is None:
+        _sinks = [
+            import_string(sink) if isinstance(sink, six.string_types)
+            else sink
+            for sink in settings.MESSAGETIMINGSINKS
+        ]
+    return _sinks
+
+
+def emit(app, message_info, timing):
+    """将耗时记录交由各sink处理,sink异常不影响消息处理"""
+    for sink in get_sinks():
+        try:
+            sink(app, message_info, timing)
+        except Exception:
+            logging.getLogger("wechat.handler").warning(
+                "timing sink %r failed", sink, exc_info=True)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+"""微信接口请求的共享连接池
+
+进程内所有WeChatClient及WeChatOAuthClient共用一个requests.Session,复用到
+微信服务器的keep-alive连接及TLS会话.每个host的并发连接数受
+WECHAT_CLIENTMAXCONNECTIONS限制,幂等的GET请求在连接被重置时重试.
+WeChatPayClient的请求带有商户证书,不使用共享的连接池
+
+    from wechat_django.transport import pool_stats
+    pool_stats()
+"""
+
+from __future__ import unicode_literals
+
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from six.moves import http_cookiejar
+from six.moves.urllib.parse import urlsplit
+from urllib3.util.retry import Retry
+
+from . import settings
+
+__all__ = ("get_session", "pool_stats", "PooledAdapter")
+
+
+class _Host(object):
+    def __init__(self, max_connections):
+        self.max_connections = max_connections
+        self.semaphore = threading.BoundedSemaphore(max_connections)
+        self.in_use = 0
+        self.requests = 0
+        self.errors = 0
+
+
+class PooledAdapter(HTTPAdapter):
+    """按host限制并发连接数并记录连接池状态的HTTPAdapter
+
+    连接在send返回时归还,不适用于stream=True的请求
+    """
+
+    def __init__(self, max_connections=10, host_max_connections=None,
+                 retries=0, pool_connections=10, pool_timeout=None):
+        """
+        :param max_connections: 每个host的最大并发连接数
+        :param host_max_connections: 指定host的最大并发连接数
+        :param retries: 幂等请求连接被重置时的重试次数
+        :param pool_timeout: 等待空闲连接的超时时间,默认为请求的超时时间
+        """
+        self.max_connections = max_connections
+        self.host_max_connections = dict(host_max_connections or {})
+        self.pool_timeout = pool_timeout
+        self._hosts = dict()
+        self._lock = threading.Lock()
+        pool_maxsize = max(
+            [max_connections] + list(self.host_max_connections.values()))
+        super(PooledAdapter, self).__init__(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+            max_retries=_retry(retries))
+
+    def send(self, request, **kwargs):
+        hostname = urlsplit(request.url).hostname
+        host = self._get_host(hostname)
+        if not host.semaphore.acquire(
+                timeout=self._acquire_timeout(kwargs.get("timeout"))):
+            with self._lock:
+                host.requests += 1
+                host.errors += 1
+            raise requests.exceptions.ConnectTimeout(
+                "too many connections to {0}".format(hostname),
+                request=request)
+        with self._lock:
+            host.in_use += 1
+            host.requests += 1
+        try:
+            return super(PooledAdapter, self).send(request, **kwargs)
+        except requests.exceptions.RequestException:
+            with self._lock:
+                host.errors += 1
+            raise
+        finally:
+            with self._lock:
+                host.in_use -= 1
+            host.semaphore.release()
+
+    def stats(self):
+        """
+            {"api.weixin.qq.com": {"max_connections": 10, "in_use": 1,
+                                   "idle": 2, "created": 3,
+                                   "requests": 100, "errors": 0}}
+        """
+        with self._lock:
+            rv = {
+                hostname: dict(
+                    max_connections=host.max_connections,
+                    in_use=host.in_use,
+                    idle=0,
+                    created=0,
+                    requests=host.requests,
+                    errors=host.errors
+                )
+                for hostname, host in self._hosts.items()
+            }
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            stat = rv.get(key.key_host)
+            if not pool or not stat:
+                continue
+            # 连接池队列中以None占位未创建的连接
+            stat["idle"] += sum(1 for conn in list(pool.pool.queue) if conn)\
+                if pool.pool else 0
+            stat["created"] += pool.num_connections
+        return rv
+
+    def _get_host(self, hostname):
+        host = self._hosts.get(hostname)
+        if not host:
+            with self._lock:
+                host = self._hosts.get(hostname)
+                if not host:
+                    host = self._hosts[hostname] = _Host(
+                        self.host_max_connections.get(
+                            hostname, self.max_connections))
+        return host
+
+    def _acquire_timeout(self, timeout):
+        if self.pool_timeout is not None:
+            return self.pool_timeout
+        if isinstance(timeout, tuple):
+            timeout = timeout[0]
+        # 未设置超时的请求不限制等待时间
+        return timeout
+
+
+def _retry(retries):
+    kwargs = dict(total=retries, connect=retries, read=retries, status=0,
+                  redirect=False, raise_on_status=False)
+    # 非幂等请求仅在连接建立前出错时重试
+    try:
+        return Retry(allowed_methods=frozenset(("GET", "HEAD")), **kwargs)
+    except TypeError:  # urllib3<1.26
+        return Retry(method_whitelist=frozenset(("GET", "HEAD")), **kwargs)
+
+
+_session = None
+_pid = None
+_lock = threading.Lock()
+
+
+def get_session():
+    """进程内共享的requests.Session
+
+    :rtype: requests.Session
+    """
+    global _session, _pid
+    if not _session or _pid != os.getpid():
+        with _lock:
+            if not _session or _pid != os.getpid():
+                # fork后的子进程不能复用父进程的连接
+                _session = _create_session()
+                _pid = os.getpid()
+    return _session
+
+
+def _create_session():
+    session = requests.Session()
+    # 多个公众号共用会话 不保存cookie
+    session.cookies.set_policy(
+        http_cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    adapter = PooledAdapter(
+        max_connections=settings.CLIENTMAXCONNECTIONS,
+        host_max_connections=settings.CLIENTHOSTMAXCONNECTIONS,
+        retries=settings.CLIENTRETRIES,
+        pool_connections=settings.CLIENTPOOLCONNECTIONS,
+        pool_timeout=settings.CLIENTPOOLTIMEOUT)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def pool_stats():
+    """共享连接池中各host的最大连接数,使用中及空闲的连接数,
+    创建的连接数,请求数及错误数"""
+    if not _session:
+        return dict()
+    return _session.get_adapter("https://").stats()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""Aho-Corasick多模式串匹配"""
+
+from __future__ import unicode_literals
+
+from collections import deque
+
+
+class Automaton(object):
+    """Aho-Corasick自动机,一次扫描找出文本中包含的所有模式串
+
+        automaton = Automaton()
+        automaton.add("he", 1)
+        automaton.add("she", 2)
+        automaton.build()
+        set(automaton.iter("ushers"))  # {1, 2}
+    """
+
+    def __init__(self):
+        self._goto = [dict()]
+        self._fail = [0]
+        self._outputs = [[]]
+        # 失败链上最近的有输出的节点
+        self._links = [0]
+        self._count = 0
+        self._built = True
+
+    def __len__(self):
+        return self._count
+
+    def add(self, pattern, value):
+        """添加模式串,匹配时返回value"""
+        node = 0
+        for char in pattern:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append(dict())
+                self._fail.append(0)
+                self._outputs.append([])
+                self._links.append(0)
+            node = next_node
+        self._outputs[node].append(value)
+        self._count += 1
+        self._built = False
+
+    def build(self):
+        """计算失败指针,添加完模式串后须调用"""
+        goto, fail, outputs, links = (
+            self._goto, self._fail, self._outputs, self._links)
+        queue = deque()
+        for node in goto[0].values():
+            fail[node] = 0
+            links[node] = 0
+            queue.append(node)
+
+        while queue:
+            node = queue.popleft()
+            for char, child in goto[node].items():
+                state = fail[node]
+                while state and char not in goto[state]:
+                    state = fail[state]
+                fail[child] = goto[state].get(char, 0)
+                target = fail[child]
+                links[child] = target if outputs[target] else links[target]
+                queue.append(child)
+        self._built = True
+
+    def iter(self, text):
+        """依次返回文本中匹配的模式串对应的value,同一value可能返回多次"""
+        if not self._built:
+            self.build()
+
+        goto, fail, outputs, links = (
+            self._goto, self._fail, self._outputs, self._links)
+        # 空模式串总是匹配
+        for value in outputs[0]:
+            yield value
+
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            state = node if outputs[node] else links[node]
+            while state:
+                for value in outputs[state]:
+                    yield value
+                state = links[state]
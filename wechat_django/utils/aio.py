@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+
+from asgiref.sync import sync_to_async
+
+from .. import settings
+from .executor import close_connections
+
+try:
+    from asgiref.sync import markcoroutinefunction
+except ImportError:  # asgiref<3.8
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
+
+
+_pool = None
+_pid = None
+_lock = threading.Lock()
+
+
+def run_sync(func, *args, **kwargs):
+    """在异步视图中执行同步代码(ORM,缓存,同步的自定义业务等)
+
+    WECHAT_MESSAGEASYNCWORKERS大于0时在有界线程池中执行,数据库连接在每次
+    执行前后按CONN_MAX_AGE回收;为0时交由sync_to_async在请求的同步线程中执行
+
+        handlers = await run_sync(MessageHandler.matches, message_info)
+    """
+    if not settings.MESSAGEASYNCWORKERS:
+        return sync_to_async(func)(*args, **kwargs)
+
+    return sync_to_async(close_connections(func), thread_sensitive=False,
+                         executor=_get_pool())(*args, **kwargs)
+
+
+def _get_pool():
+    global _pool, _pid
+    if not _pool or _pid != os.getpid():
+        with _lock:
+            if not _pool or _pid != os.getpid():
+                # fork后的子进程中线程不存在 需要重新创建线程池
+                _pool = ThreadPoolExecutor(settings.MESSAGEASYNCWORKERS,
+                                           thread_name_prefix="wechat-async")
+                _pid = os.getpid()
+    return _pool
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+import logging
+import os
+import threading
+
+from django.db import close_old_connections
+
+
+class SerialExecutor(object):
+    """有界线程池,同一key的任务按提交顺序依次执行,不同key的任务并行执行
+
+        executor = SerialExecutor(max_workers=4)
+        executor.submit(openid, send, message)
+
+    :param max_workers: 线程数,为0时直接在当前线程执行
+    """
+
+    def __init__(self, max_workers=4, name="wechat-executor", logger=None):
+        self.max_workers = max_workers
+        self.name = name
+        self._logger = logger or logging.getLogger("wechat")
+        self._queues = dict()
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    def submit(self, key, func, *args, **kwargs):
+        if not self.max_workers:
+            return self._run(func, args, kwargs)
+
+        with self._lock:
+            pool = self._get_pool()
+            queue = self._queues.get(key)
+            if queue is not None:
+                # 该key已有任务在执行 由执行中的线程依次执行
+                queue.append((func, args, kwargs))
+                return
+            self._queues[key] = deque([(func, args, kwargs)])
+        pool.submit(self._drain, key)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool:
+            pool.shutdown(wait)
+
+    def _get_pool(self):
+        if not self._pool or self._pid != os.getpid():
+            # fork后的子进程中线程不存在 需要重新创建线程池
+            self._queues = dict()
+            self._pool = ThreadPoolExecutor(
+                self.max_workers, thread_name_prefix=self.name)
+            self._pid = os.getpid()
+        return self._pool
+
+    def _drain(self, key):
+        close_old_connections()
+        try:
+            while True:
+                with self._lock:
+                    queue = self._queues[key]
+                    if not queue:
+                        del self._queues[key]
+                        return
+                    func, args, kwargs = queue.popleft()
+                self._run(func, args, kwargs)
+        finally:
+            close_old_connections()
+
+    def _run(self, func, args, kwargs):
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            self._logger.error("execute %r failed" % func, exc_info=True)
+
+
+def close_connections(func):
+    """在线程池中访问数据库的函数,执行前后按CONN_MAX_AGE回收数据库连接"""
+    @wraps(func)
+    def decorated(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return decorated
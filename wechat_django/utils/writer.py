@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import atexit
+import logging
+import threading
+
+from django.db import close_old_connections
+
+
+class BatchWriter(object):
+    """缓冲写入,缓冲数量达到上限或距上次写入超过间隔时在后台线程批量写入,
+    进程退出时写入剩余数据
+
+        writer = BatchWriter(Model.objects.bulk_create, max_size=100)
+        writer.put(Model(**kwargs))
+
+    :param write: 接收一个列表的批量写入方法
+    :param max_size: 达到该数量时由后台线程写入,为0时不缓冲,直接在当前线程写入
+    :param interval: 写入间隔(秒)
+    :param max_pending: 缓冲数量的硬上限,默认为max_size的10倍.后台写入跟不上时
+                        (如数据库阻塞)在当前线程写入,缓冲不再增长
+    """
+
+    def __init__(self, write, max_size=100, interval=1.0, logger=None,
+                 max_pending=None):
+        self._write = write
+        self.max_size = max_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self._logger = logger or logging.getLogger("wechat")
+        self._buffer = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+        atexit.register(self.close)
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def put(self, item):
+        if not self.max_size or self._closed:
+            return self._write([item])
+
+        with self._cond:
+            self._buffer.append(item)
+            if not self._thread or not self._thread.is_alive():
+                # fork后的子进程中线程不存在 需要重新启动
+                self._thread = threading.Thread(
+                    target=self._run, name="wechat-batch-writer")
+                self._thread.daemon = True
+                self._thread.start()
+            elif len(self._buffer) >= self.max_size:
+                self._cond.notify()
+            full = len(self._buffer) >= (
+                self.max_pending or self.max_size * 10)
+        if full:
+            self.flush()
+
+    def flush(self):
+        """写入所有缓冲数据"""
+        with self._cond:
+            items, self._buffer = self._buffer, []
+        if items:
+            try:
+                self._write(items)
+            except Exception:
+                self._logger.error(
+                    "batch write %d items failed" % len(items), exc_info=True)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self.flush()
+
+    def _run(self):
+        while not self._closed:
+            with self._cond:
+                if len(self._buffer) < self.max_size:
+                    self._cond.wait(self.interval)
+            close_old_connections()
+            self.flush()